@@ -1,10 +1,22 @@
 from argparse import ArgumentParser
-import pandas as pd
+from google.cloud import bigquery
+from data_sources import load_a10_data
+import functools
+
+import check_cache
+import check_results
+import instrumentation
+import report_writer
+import results_sink
 
 '''This file loads one dataset (A-10 form) that originates from Black Cat.
 To run from command line, navigate to folder: 
 * To run with the default datasources, type: python a10_facilities_check.py
 * To specify data source file, type: python a10_facilities_check.py --a10_data <filepath> --a10_lastyr_data <filepath> 
+* To also write every check's results as Parquet and load them into BigQuery, add --results_dir and --results_table
+  (see results_sink.py).
+* Per-stage timings, row counts and memory are written to a10_facilities_check_metrics.json. To also save a profile,
+  add --profile cprofile (see instrumentation.py).
                                 
 Performs 3 checks:
 * Check 1. Check that sum of total facilities for each agency, across all modes, is a whole number.
@@ -19,15 +31,19 @@ def get_arguments():
     parser = ArgumentParser(description="VOMS inventory check")
     parser.add_argument('--a10_data', default="data/2021_a10_submitted_partialdata.csv")
     parser.add_argument('--a10_lastyr_data', default = "data/2020_a10_submitted_partialdata.csv")
+    results_sink.add_arguments(parser)
+    check_cache.add_arguments(parser)
+    instrumentation.add_arguments(parser, "a10_facilities_check")
 
     args = parser.parse_args()
     return args
 
 
 def facility_checks(df, this_year, last_year):
-    a10_agencies = df['Agency'].unique()
+    # The frame holds both years (see data_sources.load_a10_data()); only agencies that reported this year are checked
+    a10_agencies = df[df['year']==this_year]['Agency'].unique()
 
-    output = []
+    output = check_results.new_results()
     for agency in a10_agencies:
         
         if len(df[df['Agency']==agency]) > 0:
@@ -45,12 +61,9 @@ def facility_checks(df, this_year, last_year):
                 description = "The reported total facilities do not add up to a whole number. Please explain."
                 check_name = "Whole Number Facilities"
             
-            output_line = {"Organization": agency,
-                        "name_of_check" : check_name,
-                            "value_checked": f"Total Facilities: {total_fac}",
-                            "check_status": result,
-                            "Description": description}
-            output.append(output_line)
+            check_results.add_result(output, Organization=agency, name_of_check=check_name,
+                                     value_checked=f"Total Facilities: {total_fac}", check_status=result,
+                                     Description=description)
             
             # Non-zero check
             if total_fac != 0:
@@ -62,15 +75,12 @@ def facility_checks(df, this_year, last_year):
                 description = "There are no reported facilities. Please explain."
                 check_name = "Non-zero Facilities"
             
-            output_line = {"Organization": agency,
-                        "name_of_check" : check_name,
-                            "value_checked": f"Total Facilities: {total_fac}",
-                            "check_status": result,
-                            "Description": description}
-            output.append(output_line)
+            check_results.add_result(output, Organization=agency, name_of_check=check_name,
+                                     value_checked=f"Total Facilities: {total_fac}", check_status=result,
+                                     Description=description)
             
             ## General purpose facilities checks (all except "heavy maintenance")
-            total_gen_fac = round(df[df['Agency']==agency]
+            total_gen_fac = round(df[(df['Agency']==agency) & (df['year']==this_year)]
                             [['Under 200 Vehicles', 
                                 '200 to 300 Vehicles',
                                 'Over 300 Vehicles']].sum().sum())
@@ -91,12 +101,9 @@ def facility_checks(df, this_year, last_year):
         else:
             pass
         
-        output_line = {"Organization": agency,
-                       "name_of_check" : check_name,
-                        "value_checked": f"Gen Purpose Facilities: {total_gen_fac}",
-                        "check_status": result,
-                        "Description": description}
-        output.append(output_line)
+        check_results.add_result(output, Organization=agency, name_of_check=check_name,
+                                 value_checked=f"Gen Purpose Facilities: {total_gen_fac}", check_status=result,
+                                 Description=description)
         
         # Check whether data for both years is present, if so perform prior yr comparison.
         if (len(df[(df['Agency']==agency) & (df['year']==this_year)]) > 0) & (len(df[(df['Agency']==agency) & (df['year']==last_year)]) > 0): 
@@ -115,86 +122,72 @@ def facility_checks(df, this_year, last_year):
                 description = "Num. of general purpose facilities differs that last year - please verify or clarify."
                 check_name = "Comparison to last yr: Gen Purpose Facilities"
 
-            output_line = {"Organization": agency,
-                           "name_of_check" : check_name,
-                            "value_checked": f"{total_gen_fac} in {this_year}, {last_yr_gen_fac} in {last_year} (Gen Purpose Facilities)", 
-                            "check_status": result,
-                            "Description": description}
-            output.append(output_line)
+            check_results.add_result(output, Organization=agency, name_of_check=check_name,
+                                     value_checked=f"{total_gen_fac} in {this_year}, {last_yr_gen_fac} in {last_year} (Gen Purpose Facilities)",
+                                     check_status=result, Description=description)
 
         else:
              pass
         
-    facility_checks = pd.DataFrame(output).sort_values(by="Organization")
+    facility_checks = check_results.results_frame(output)
     return facility_checks
 
 
+def facilities_report_sheets(a10_checks):
+    """The report's sheets, for report_writer.write_report()."""
+    return [
+        {"sheet": "a10_checks_full", "data": a10_checks,
+         "subtitle": "A-10 Facilities: Validation Warnings", "subtitle_cells": "A2:C2",
+         "agency_response": True,
+         "column_widths": [(0, 0, 35), (1, 2, 22), (3, 3, 11), (4, 6, 53)]},
+        # Add some readme text to the output file for context
+        {"sheet": "readme", "text": [
+            ('A1', "Read Me", "title"),
+            ('A2', "This file runs 6 validation checks on submitted 2023-A-10 form data, based on historical NTD validation errors.", None),
+            ('A4', "Total Facilities checks", "subtitle"),
+            ('A5', '1. "Whole Number Facilities": Check that sum of total facilities for each agency, across all modes, is a whole number.', None),
+            ('A6', '2. "Non-zero Facilities" check: Check that the sum of all total facilities is not zero.', None),
+            ('A8', "General Purpose Facilities checks (all except \"heavy maintenance\")", "subtitle"),
+            ('A9', '3. "Gen  Purpose Facilities": Check whether total gen purpose facilities (all but heavy maintenance) is > 1. If so mark as "failure".', None),
+            ('A10', '4. "Multiple Gen Purpose Facilities": if > 1 reported, ask for narrative justification.', None),
+            ('A11', '5. "Comparison to last yr: Gen Purpose Facilities": Fail if the total differs from last year', None),
+            ('A12', '6. "Non-zero Gen Purpose Facilities": fail if this is reported as 0', None),
+        ]},
+    ]
+
+
+def write_facilities_report(a10_checks, filename):
+    """Write results to an Excel file, with a readme sheet"""
+    report_writer.write_report(filename, facilities_report_sheets(a10_checks))
+
+
 def main():
     #Load data:
     args = get_arguments()
-    df = pd.read_csv(args.a10_data, index_col = 0)
-    df_lastyr = pd.read_csv(args.a10_lastyr_data, index_col = 0)
-
     # this_year = datetime.datetime.now().year # uncomment after this year's reporting starts
     this_year = 2021
     last_year = this_year - 1
+    run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("a10_facilities_check", this_year=this_year, last_year=last_year, run_id=run_id)
+    timed = functools.partial(instrumentation.timed_call, metrics)
+    memo = functools.partial(check_cache.memoize, cache_dir=args.cache_dir, max_mb=args.cache_max_mb)
 
-    
-    # Run validation checks
-    a10_checks = facility_checks(df, this_year, last_year)
-
-    # Write results to an Excel file
-    with pd.ExcelWriter("reports/a10_facility_check_report.xlsx") as writer:
-        a10_checks.to_excel(writer, sheet_name="a10_checks_full", index=False, startrow=2)
-
-        workbook = writer.book
-        worksheet = writer.sheets["a10_checks_full"]
-        cell_highlight = workbook.add_format({
-            'fg_color': 'yellow',
-            'bold': True,
-            'border': 1
-        })
-        report_title = "NTD Data Validation Report"
-        title_format = workbook.add_format({
-                'bold': True,
-                'valign': 'center',
-                'align': 'left',
-                'font_color': '#1c639e',
-                'font_size': 15
-                })
-        subtitle = "A-10 Facilities: Validation Warnings"
-        subtitle_format = workbook.add_format({
-            'bold': True,
-            'align': 'left',
-            'font_color': 'black',
-            'font_size': 19
-            })
-        
-        worksheet.write('A1', report_title, title_format)
-        worksheet.merge_range('A2:C2', subtitle, subtitle_format)
-        worksheet.write('F3', 'Agency Response', cell_highlight)
-        worksheet.write('G3', 'Response Date', cell_highlight)
-        worksheet.set_column(0, 0, 35) #col A width
-        worksheet.set_column(1, 2, 22) #cols B-C width
-        worksheet.set_column(3, 3, 11) #col D width
-        worksheet.set_column(4, 6, 53) #col E-G width
-        worksheet.freeze_panes('B4')
+    with instrumentation.profiled(args.profile, args.profile_file, "a10_facilities_check"):
+        df = timed("a10", "load", load_a10_data, args.a10_data, args.a10_lastyr_data)
 
-        # Add some readme text to the output file for context
-        worksheet2 = workbook.add_worksheet("readme")
-        worksheet2.write('A1', "Read Me", title_format)
-        worksheet2.write('A2', "This file runs 6 validation checks on submitted 2023-A-10 form data, based on historical NTD validation errors.")
-        worksheet2.write('A4', "Total Facilities checks", subtitle_format)
-        worksheet2.write('A5', '1. "Whole Number Facilities": Check that sum of total facilities for each agency, across all modes, is a whole number.')
-        worksheet2.write('A6', '2. "Non-zero Facilities" check: Check that the sum of all total facilities is not zero.')
-        worksheet2.write('A8', "General Purpose Facilities checks (all except \"heavy maintenance\")", subtitle_format)
-        worksheet2.write('A9', '3. "Gen  Purpose Facilities": Check whether total gen purpose facilities (all but heavy maintenance) is > 1. If so mark as "failure".')
-        worksheet2.write('A10', '4. "Multiple Gen Purpose Facilities": if > 1 reported, ask for narrative justification.')
-        worksheet2.write('A11', '5. "Comparison to last yr: Gen Purpose Facilities": Fail if the total differs from last year')
-        worksheet2.write('A12', '6. "Non-zero Gen Purpose Facilities": fail if this is reported as 0')
-
-        print("Validation of A-10 form is complete!")
+        # Run validation checks
+        a10_checks = timed("a10_facilities", "check", memo(facility_checks, "a10_facilities"), df, this_year, last_year)
+
+        # Write results to an Excel file
+        timed("a10_report", "write", write_facilities_report, a10_checks, "reports/a10_facility_check_report.xlsx")
+
+        # Save the results as Parquet and to BigQuery, if asked to
+        if args.results_dir or args.results_table:
+            client = bigquery.Client() if args.results_table else None
+            timed("results", "write", results_sink.write_results, client, run_id, this_year, {"a10_facilities": "a10"},
+                  results_dir=args.results_dir, results_table_id=args.results_table, a10_facilities=a10_checks)
+    instrumentation.write_metrics(metrics, args.metrics_file)
+    print("Validation of A-10 form is complete!")
 
 if __name__ == "__main__":
     main()
-
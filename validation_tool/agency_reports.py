@@ -0,0 +1,135 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pandas as pd
+import tempfile
+import shutil
+import fsspec
+import os
+
+import data_sources
+import report_writer
+import validation_logging
+import rr20_service_check
+import rr20_financials_check
+import voms_inventory_check
+import a10_facilities_check
+
+'''Writes one validation report per agency, for liaisons to forward, instead of filtering the statewide reports by hand.
+Run it with: python validate.py --agency_reports
+Each agency's workbook has that agency's rows of every report in the run, with the same sheets as the statewide reports
+(reports with no rows for the agency are left out), in {output_dir}/agency_reports_{date}/.
+An index workbook there lists every agency, its file and its number of checks, fails and warnings.
+
+The combined check tables are split by Organization in one pass each. The workbooks are written in parallel,
+in a pool of worker processes. When the output is on GCS, the workers write to a local folder and the finished
+files are then uploaded concurrently, in a pool of threads.
+'''
+
+# Report: (function returning the report's sheets, names of the check tables it is made from, in argument order).
+# The names are the validate.py stages that make the tables.
+AGENCY_REPORTS = {
+    "rr20_service": (rr20_service_check.service_report_sheets, ["rr20_service_checks"]),
+    "rr20_financials": (rr20_financials_check.financials_report_sheets, ["rr20_financials_checks"]),
+    "voms": (voms_inventory_check.voms_report_sheets, ["voms_vins_all", "voms_vins_mismatched", "voms_totals"]),
+    "a10": (a10_facilities_check.facilities_report_sheets, ["a10_facilities"]),
+}
+ORG_COL = "Organization"
+UPLOAD_THREADS = 16
+
+
+def agency_filename(agency, this_date):
+    return f"{data_sources.make_name_bq_safe(agency)}_validation_report_{this_date}.xlsx"
+
+
+def split_sheets(sheets):
+    '''
+    Splits each data sheet of a report by agency. Returns {agency: sheets}, where each agency's sheets are the
+    report's sheets with only that agency's rows (text sheets, like a readme, are kept as they are).
+    '''
+    rows_by_agency = {}
+    for i, spec in enumerate(sheets):
+        if "data" in spec:
+            for agency, rows in spec["data"].groupby(ORG_COL, sort=False).indices.items():
+                rows_by_agency.setdefault(agency, {})[i] = rows
+
+    agency_sheets = {}
+    for agency, rows in rows_by_agency.items():
+        agency_sheets[agency] = [
+            {**spec, "data": spec["data"].iloc[rows[i]] if i in rows else spec["data"].iloc[:0]} if "data" in spec else spec
+            for i, spec in enumerate(sheets)]
+    return agency_sheets
+
+
+def count_statuses(sheets):
+    '''Number of checks (data rows), fails and warnings in an agency's sheets.'''
+    counts = {"checks": 0, "fail": 0, "warning": 0}
+    for spec in sheets:
+        if "data" not in spec:
+            continue
+        data = spec["data"]
+        counts["checks"] += len(data)
+        status_col = next((col for col in report_writer.STATUS_COLUMNS if col in data.columns), None)
+        if status_col is not None:
+            for status in ["fail", "warning"]:
+                counts[status] += int((data[status_col] == status).sum())
+    return counts
+
+
+def index_sheets(index):
+    return [{"sheet": "agency_reports", "data": index,
+             "subtitle": "Validation reports by agency", "subtitle_cells": "A2:C2",
+             "column_widths": [(0, 0, 35), (1, 1, 60), (2, 4, 11)]}]
+
+
+def _upload(local_file, filename):
+    with open(local_file, "rb") as source, fsspec.open(filename, "wb") as destination:
+        shutil.copyfileobj(source, destination)
+    return filename
+
+
+def write_agency_reports(output_dir, this_date, jobs=None, logger=None, **tables):
+    '''
+    Writes every agency's workbook and the index workbook to {output_dir}/agency_reports_{this_date}/,
+    from the check tables given by their validate.py stage names (see AGENCY_REPORTS; reports whose tables are not
+    all given are skipped). jobs is the number of worker processes (default: the number of CPUs).
+    Returns the index, as a dataframe.
+    '''
+    agencies = {}
+    for report, (report_sheets, table_names) in AGENCY_REPORTS.items():
+        if not all(name in tables for name in table_names):
+            continue
+        for agency, sheets in split_sheets(report_sheets(*[tables[name] for name in table_names])).items():
+            agencies.setdefault(agency, []).extend(sheets)
+    agencies = dict(sorted(agencies.items()))
+
+    report_dir = f"{output_dir}/agency_reports_{this_date}"
+    remote = "://" in report_dir
+    staging = tempfile.TemporaryDirectory(prefix="agency_reports_") if remote else None
+    write_dir = staging.name if remote else report_dir
+    os.makedirs(write_dir, exist_ok=True)
+
+    files = {agency: agency_filename(agency, this_date) for agency in agencies}
+    index = pd.DataFrame([{ORG_COL: agency, "report_file": f"{report_dir}/{files[agency]}", **count_statuses(sheets)}
+                          for agency, sheets in agencies.items()],
+                         columns=[ORG_COL, "report_file", "checks", "fail", "warning"])
+    index_file = f"index_{this_date}.xlsx"
+    try:
+        paths = [os.path.join(write_dir, files[agency]) for agency in agencies]
+        with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), initializer=validation_logging.init_worker,
+                                 initargs=validation_logging.worker_initargs()) as pool:
+            # Small agencies take little time to write, so they are sent to the workers in batches.
+            list(pool.map(report_writer.write_workbook, paths, agencies.values(),
+                          chunksize=max(1, len(paths) // (4 * (jobs or os.cpu_count())))))
+        report_writer.write_workbook(os.path.join(write_dir, index_file), index_sheets(index))
+        if logger is not None:
+            logger.info(f"Wrote {len(agencies)} agency reports and an index to {write_dir}")
+
+        if remote:
+            with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as uploads:
+                list(uploads.map(_upload, [*paths, os.path.join(write_dir, index_file)],
+                                 [f"{report_dir}/{files[agency]}" for agency in agencies] + [f"{report_dir}/{index_file}"]))
+            if logger is not None:
+                logger.info(f"Uploaded {len(agencies) + 1} files to {report_dir}")
+    finally:
+        if staging is not None:
+            staging.cleanup()
+    return index
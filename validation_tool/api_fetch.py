@@ -0,0 +1,169 @@
+from argparse import ArgumentParser
+import datetime
+import asyncio
+import aiohttp
+import random
+import gzip
+import os
+
+import blackcat_api
+import instrumentation
+import results_sink
+import validation_logging
+
+'''Fetches many BlackCat API responses at once, with asyncio, and saves them (gzipped) to a local cache folder.
+blackcat_api.py reads one response at a time with requests; when the data is spread over many requests (several
+years, or one request per report or table), waiting for each in turn is most of the ingestion time. Here:
+- every request of a batch is started at once, and at most --concurrency of them are open at the same time; they
+  share one session, so connections to the API are pooled and reused
+- a request that fails (connection error, timeout, or a 429 or 5xx answer) is tried again up to --retries times,
+  after a random wait of up to backoff * 2^attempt seconds ("full jitter", so retries from many requests do not
+  all arrive together), or the API's Retry-After if it sent one
+- each response is streamed to a file in --cache_dir, written to a temporary name and moved into place when complete.
+  Responses for one report are cached under its ReportId and ReportLastModifiedDate
+  ({cache_dir}/report-{ReportId}-{last modified}.json.gz), so a report is only downloaded again once it is modified.
+  Other responses (e.g. every report of a year) change without notice, so they are downloaded every time.
+The cached files can be read like any other source, e.g. blackcat_api.sync(path, raw_dir).
+
+A request is a dict with the url, the file name to save it as, and whether a saved file can be reused (see
+year_request() and report_request()). Fetching a batch:
+    paths = api_fetch.fetch([api_fetch.year_request(2022), api_fetch.year_request(2023)], "api_cache")
+
+To run from command line, navigate to folder and type e.g.:
+    python api_fetch.py --years 2021 2022 2023
+which fetches the three years at once and syncs each into its raw folder (blackcat_api.RAW_DIR). api_standin.py
+serves canned responses locally to try it against.
+'''
+
+API_URL = blackcat_api.API_URL
+REPORT_URL = "https://services.blackcattransit.com/api/APIModules/GetNTDReport/BCG_CA/{year}/{report_id}"
+CACHE_DIR = ".api_cache"
+CONCURRENCY = 8
+RETRIES = 4
+BACKOFF = 0.5 # seconds
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CHUNK_BYTES = 1 << 16
+
+
+def get_arguments(this_year):
+    parser = ArgumentParser(description="Fetch BlackCat API responses concurrently, then sync them into the raw store")
+    parser.add_argument('--years', type=int, nargs='+', default=[this_year])
+    parser.add_argument('--api_url', default=API_URL, help="URL of a year's reports, with {year} in it")
+    parser.add_argument('--raw_dir', default=blackcat_api.RAW_DIR,
+                        help="Folder (local or gs://) to sync each year into, with {year} in it")
+    parser.add_argument('--cache_dir', default=CACHE_DIR, help="Local folder to save the responses in")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="Most requests open at the same time")
+    parser.add_argument('--retries', type=int, default=RETRIES, help="Times to try a failed request again")
+    parser.add_argument('--no_sync', action='store_true', help="Only fetch the responses")
+    validation_logging.add_arguments(parser)
+    instrumentation.add_arguments(parser, "api_fetch")
+    args = parser.parse_args()
+    return args
+
+
+def year_request(year, url=API_URL):
+    '''The request for every report of a year. Its response is never reused.'''
+    return {"url": url.format(year=year), "name": f"year-{year}", "reuse": False}
+
+
+def report_request(year, report_id, last_modified, url=REPORT_URL):
+    '''
+    The request for one report, cached under its ReportId and last modified date (as blackcat_api.last_modified()
+    returns it, or as in its watermark).
+    '''
+    stamp = "".join(character for character in str(last_modified) if character.isalnum())
+    return {"url": url.format(year=year, report_id=report_id), "name": f"report-{report_id}-{stamp}", "reuse": True}
+
+
+def retry_wait(attempt, backoff, retry_after=None):
+    '''Seconds to wait before trying a request again: the server's Retry-After, or a random "full jitter" wait.'''
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+    return random.uniform(0, backoff * 2 ** attempt)
+
+
+async def fetch_one(session, request, cache_dir, limit, retries=RETRIES, backoff=BACKOFF):
+    '''Saves the response to request in cache_dir (unless it is there and can be reused). Returns the file's path.'''
+    path = os.path.join(cache_dir, f"{request['name']}.json.gz")
+    if request["reuse"] and os.path.exists(path):
+        instrumentation.add_count("cache_hits", 1)
+        return path
+    for attempt in range(retries + 1):
+        retry_after = None
+        try:
+            async with limit:
+                async with session.get(request["url"]) as response:
+                    if response.status not in RETRY_STATUSES:
+                        response.raise_for_status()
+                        # Each attempt writes its own temporary file, so a failed attempt never leaves a partial response
+                        with gzip.open(f"{path}.{attempt}.tmp", "wb") as f:
+                            async for chunk in response.content.iter_chunked(CHUNK_BYTES):
+                                f.write(chunk)
+                        os.replace(f"{path}.{attempt}.tmp", path)
+                        instrumentation.add_count("cache_misses", 1)
+                        return path
+                    error = aiohttp.ClientResponseError(response.request_info, response.history,
+                                                        status=response.status, message=response.reason)
+                    retry_after = response.headers.get("Retry-After")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES:
+                raise
+            error = e
+        if attempt < retries:
+            instrumentation.add_count("retries", 1)
+            await asyncio.sleep(retry_wait(attempt, backoff, retry_after))
+    raise error
+
+
+async def fetch_all(requests, cache_dir=CACHE_DIR, concurrency=CONCURRENCY, retries=RETRIES, backoff=BACKOFF,
+                    timeout=blackcat_api.TIMEOUT, logger=None):
+    '''
+    Fetches every request at once, with at most concurrency open at the same time (see above).
+    Returns {name: path of the saved response}. Raises the first error once every request has finished.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    limit = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        results = await asyncio.gather(*[fetch_one(session, request, cache_dir, limit, retries, backoff)
+                                         for request in requests], return_exceptions=True)
+    failed = [(request, result) for request, result in zip(requests, results) if isinstance(result, BaseException)]
+    if logger is not None:
+        for request, error in failed:
+            logger.error(f"Could not fetch {request['url']}: {error!r}", extra={"url": request["url"]})
+        logger.info(f"Fetched {len(requests) - len(failed)} of {len(requests)} responses into {cache_dir}",
+                    extra={"requests": len(requests), "failed": len(failed)})
+    if failed:
+        raise failed[0][1]
+    return {request["name"]: path for request, path in zip(requests, results)}
+
+
+def fetch(requests, cache_dir=CACHE_DIR, concurrency=CONCURRENCY, retries=RETRIES, backoff=BACKOFF,
+          timeout=blackcat_api.TIMEOUT, logger=None):
+    '''fetch_all(), from code that is not async.'''
+    return asyncio.run(fetch_all(requests, cache_dir, concurrency, retries, backoff, timeout, logger))
+
+
+def main():
+    this_year = datetime.datetime.now().year
+    args = get_arguments(this_year)
+    logger = validation_logging.write_to_log('api_fetch_log.log', args.log_level)
+    run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("api_fetch", years=args.years, run_id=run_id)
+
+    with instrumentation.profiled(args.profile, args.profile_file, "api_fetch"):
+        with instrumentation.stage_timer(metrics, "api_fetch", "load") as record:
+            paths = fetch([year_request(year, args.api_url) for year in args.years], args.cache_dir,
+                          args.concurrency, args.retries, logger=logger)
+            record["rows_out"] = len(paths)
+        if not args.no_sync:
+            for year in args.years:
+                with instrumentation.stage_timer(metrics, f"blackcat_api_{year}", "load") as record:
+                    manifest = blackcat_api.sync(paths[f"year-{year}"], args.raw_dir.format(year=year),
+                                                 run_id=run_id, logger=logger)
+                    record["rows_out"] = sum(manifest["rows"].values())
+    instrumentation.write_metrics(metrics, args.metrics_file)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from argparse import ArgumentParser
+import threading
+import random
+import time
+import json
+import re
+
+import blackcat_api
+
+'''A local stand-in for the BlackCat API, to run api_fetch.py (or blackcat_api.py) against without the network.
+It serves canned payloads, the reports of a recorded response (default: the sample in data/), at:
+    /api/APIModules/GetNTDReportsByYear/BCG_CA/{year}      every report, with ReportPeriod set to {year}
+    /api/APIModules/GetNTDReport/BCG_CA/{year}/{report_id}  one report
+    /stats                                                  requests served, failed and most served at once
+Each request waits --latency seconds (plus up to --jitter more) before it is answered, and --fail_rate of them are
+answered with --fail_status (default 503, or e.g. 429), with a Retry-After header of --retry_after seconds, so
+retries and the concurrency limit can be tried out.
+
+To run from command line, navigate to folder and type e.g.:
+    python api_standin.py --port 8123 --latency 0.2 --fail_rate 0.1
+then, in another terminal:
+    python api_fetch.py --years 2022 2023 --api_url http://localhost:8123/api/APIModules/GetNTDReportsByYear/BCG_CA/{year}
+From a script, start(reports) serves on a free port in a background thread and returns the server;
+server.server_address[1] is its port and server.shutdown() stops it.
+'''
+
+PORT = 8123
+FAIL_STATUS = 503
+RETRY_AFTER = "0"
+YEAR_PATH = re.compile(r"/api/APIModules/GetNTDReportsByYear/BCG_CA/(\d+)$")
+REPORT_PATH = re.compile(r"/api/APIModules/GetNTDReport/BCG_CA/(\d+)/(\d+)$")
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Serve canned BlackCat API responses locally")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--source', default=blackcat_api.FIXTURE, help="Recorded response to serve the reports of")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds to wait before answering each request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many more seconds, at random")
+    parser.add_argument('--fail_rate', type=float, default=0.0, help="Share of requests to answer with --fail_status")
+    parser.add_argument('--fail_status', type=int, default=FAIL_STATUS, choices=[429, 500, 502, 503, 504])
+    parser.add_argument('--retry_after', default=RETRY_AFTER, help="Retry-After header of the failed answers")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    return args
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''Answers GET requests from the server's reports, latency and failures (see above).'''
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.stats["requests"] += 1
+            server.stats["in_flight"] += 1
+            server.stats["max_in_flight"] = max(server.stats["max_in_flight"], server.stats["in_flight"])
+            fail = server.rng.random() < server.fail_rate
+            wait = server.latency + server.rng.uniform(0, server.jitter)
+        try:
+            time.sleep(wait)
+            if self.path == "/stats":
+                return self.send_json(200, {key: value for key, value in server.stats.items() if key != "in_flight"})
+            if fail:
+                with server.lock:
+                    server.stats["failed"] += 1
+                return self.send_json(server.fail_status, {"Message": "Try again later"},
+                                      {"Retry-After": server.retry_after})
+            year_match, report_match = YEAR_PATH.match(self.path), REPORT_PATH.match(self.path)
+            if year_match:
+                year = year_match.group(1)
+                return self.send_json(200, [{**report, "ReportPeriod": int(year)} for report in server.reports])
+            if report_match:
+                year, report_id = report_match.groups()
+                report = next((report for report in server.reports if str(report["ReportId"]) == report_id), None)
+                if report is not None:
+                    return self.send_json(200, {**report, "ReportPeriod": int(year)})
+            return self.send_json(404, {"Message": f"No such resource: {self.path}"})
+        finally:
+            with server.lock:
+                server.stats["in_flight"] -= 1
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # keep the console for the client's log
+        pass
+
+
+def make_server(reports, port=0, latency=0.0, jitter=0.0, fail_rate=0.0, seed=0, fail_status=FAIL_STATUS,
+                retry_after=RETRY_AFTER):
+    '''A stand-in server for reports (a list of report dicts) on port (0: any free port). Call serve_forever() to run it.'''
+    server = ThreadingHTTPServer(("localhost", port), StandInHandler)
+    server.daemon_threads = True
+    server.reports = reports
+    server.latency, server.jitter, server.fail_rate = latency, jitter, fail_rate
+    server.fail_status, server.retry_after = fail_status, retry_after
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.stats = {"requests": 0, "failed": 0, "in_flight": 0, "max_in_flight": 0}
+    return server
+
+
+def start(reports, **kwargs):
+    '''Starts a stand-in server (see make_server()) in a background thread, and returns it.'''
+    server = make_server(reports, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    args = get_arguments()
+    with blackcat_api.open_source(args.source) as stream:
+        reports = list(blackcat_api.iter_reports(stream))
+    server = make_server(reports, args.port, args.latency, args.jitter, args.fail_rate, args.seed, args.fail_status,
+                         args.retry_after)
+    print(f"Serving {len(reports)} reports from {args.source} on http://localhost:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+from argparse import ArgumentParser
+from google.cloud import bigquery
+from data_sources import share_categories
+import pandas as pd
+import numpy as np
+import datetime
+
+import check_rules
+import data_sources
+import instrumentation
+import partitioned_tables
+import results_sink
+import rr20_service_check
+import validation_logging
+
+'''Historical backfill: the RR-20 checks for every year there is data for, each year against the year before, in one run.
+rr20_service_check.py and validate.py check this year (from the clock) against last year, so getting past years'
+results meant one run per year. Here:
+- each RR-20 table is loaded once, with every year from --first_year (default: the first year in the partitioned
+  service table) to --last_year, from the year-partitioned tables (see partitioned_tables.py); years without data
+  are left out
+- the service and financial datasets of all those years are built once (each year joined as its schema says, and the
+  service ratios computed in one pass, as they are grouped by year)
+- every pair of consecutive years is checked by the same batched rules as validate.py --check_engine rules
+  (check_rules.run_batch()), on that pair's rows of the datasets: a year's results have the same rows as a
+  validate.py --storage partitioned run for that year (validate.py joins this year's tables as a year with
+  date_uploaded, so for an older year the modes of an organization can come in another order)
+- the results of every year are written at once (see results_sink.py), to Parquet partitioned by year and check
+  (--results_dir), and to BigQuery in one load job (--results_table), with one run id. A table of how many rows
+  failed, per check and year, is logged, to tune the thresholds with.
+Only the checks that read the RR-20 tables alone are run (not RR20F-182, which needs the inventory, nor the VOMS and
+A-10 checks).
+
+To run from command line, navigate to folder and type e.g.:
+    python backfill.py --first_year 2019 --last_year 2023 --results_dir gs://calitp-ntd-report-validation/validation_results
+and to run it on synthetic data (see synthetic_data.py --years and partitioned_tables.py --data_dir), type e.g.:
+    python backfill.py --data_dir synthetic_1x --results_dir backfill_results
+'''
+
+# The validate.py stages the rules read, and how each is built here
+BACKFILL_INPUTS = ["service_allyears", "service_ratios", "financials_allyears"]
+RR20_TABLES = {"rr20_service": "rr20_service_data", "rr20_exp_by_mode": "rr20_expenses_by_mode",
+               "rr20_financials": "rr20_financials__2"}
+
+
+def get_arguments(this_year):
+    parser = ArgumentParser(description="Run the RR-20 checks for every pair of consecutive years")
+    parser.add_argument('--first_year', type=int, default=None,
+                        help="First year to load; each later year is checked against the year before. Default: the first "
+                             "year in the partitioned tables")
+    parser.add_argument('--last_year', type=int, default=this_year)
+    parser.add_argument('--data_dir', default=None,
+                        help="Read the partitioned tables from this local folder (see synthetic_data.py), not BigQuery")
+    results_sink.add_arguments(parser)
+    instrumentation.add_arguments(parser, "backfill")
+    validation_logging.add_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def load_all_years(client, years):
+    '''
+    The RR-20 tables of years, in one query per table. Returns the years that have service data, and
+    {year: {"rr20_service", "rr20_exp_by_mode", "rr20_financials": that year's rows}} for those years.
+    '''
+    loaded = {name: partitioned_tables.get_years(client, tablename, years) for name, tablename in RR20_TABLES.items()}
+    found = sorted(int(year) for year in loaded["rr20_service"][partitioned_tables.YEAR_COLUMN].unique())
+    return found, {year: {name: partitioned_tables.year_rows(df, year) for name, df in loaded.items()} for year in found}
+
+
+def build_datasets(tables, orgs):
+    '''
+    The service dataset, its ratios and the financials of every year in tables (see load_all_years()), as validate.py
+    builds them for two years, newest year first: {"service_allyears", "service_ratios", "financials_allyears"}.
+    '''
+    years = sorted(tables, reverse=True)
+    if not years:
+        return {}
+    frames = share_categories([orgs] + [tables[year][name] for year in years for name in RR20_TABLES],
+                              ["Organization_Legal_Name", "Organization"], ["Common_Name_Acronym_DBA"], ["Mode"],
+                              ["Operating_Capital"])
+    orgs = frames[0]
+    shared = {year: dict(zip(RR20_TABLES, frames[1 + 3*i:4 + 3*i])) for i, year in enumerate(years)}
+
+    service = pd.concat([rr20_service_check.join_service_year(
+        shared[year]["rr20_service"], shared[year]["rr20_exp_by_mode"], shared[year]["rr20_financials"], orgs,
+        uploaded_once=partitioned_tables.uploaded_once("rr20_service_data", year)) for year in years], ignore_index=True)
+    financials = pd.concat([shared[year]["rr20_financials"] for year in years], ignore_index=True)
+    numeric_columns = financials.select_dtypes(include=['number']).columns
+    financials[numeric_columns] = financials[numeric_columns].fillna(0)
+    return {"service_allyears": service, "service_ratios": rr20_service_check.calculate_ratios(service),
+            "financials_allyears": financials}
+
+
+def year_pairs(years):
+    '''Every (this year, last year) of consecutive years in years, oldest first.'''
+    return [(year, year - 1) for year in sorted(years) if year - 1 in years]
+
+
+def pair_rows(rows_by_year, this_year, last_year):
+    '''The row positions of a dataset's rows of both years, this year's first (as validate.py concatenates them).'''
+    return np.concatenate([rows_by_year.get(year, np.array([], dtype=np.int64)) for year in (this_year, last_year)])
+
+
+def run_backfill(datasets, pairs, logger=None):
+    '''
+    Runs the rules that read datasets (see build_datasets()) for every year pair. Returns {year: {check: results}}.
+    '''
+    batches = check_rules.compile_rules([rule for rule in check_rules.RULES if rule["input"] in BACKFILL_INPUTS])
+    # Each dataset's rows of every year, found in one pass over it
+    rows_by_year = {name: {int(year): rows for year, rows in df.groupby("Fiscal_Year").indices.items()}
+                    for name, df in datasets.items()}
+    results = {}
+    for this_year, last_year in pairs:
+        results[this_year] = {}
+        for batch in batches.values():
+            df = datasets[batch["input"]]
+            pair = df.take(pair_rows(rows_by_year[batch["input"]], this_year, last_year))
+            results[this_year].update(check_rules.run_batch(pair, batch, this_year, last_year))
+        if logger is not None:
+            failed = sum(int((checks["check_status"] == "fail").sum()) for checks in results[this_year].values())
+            logger.info(f"Checked {this_year} against {last_year}: {failed} rows failed",
+                        extra={"this_year": this_year, "last_year": last_year, "failed": failed})
+    return results
+
+
+def failure_table(results):
+    '''How many rows failed, out of how many, per check (rows) and year (columns), e.g. "12/143".'''
+    counts = pd.DataFrame([{"check": check, "year": year, "failed": int((checks["check_status"] == "fail").sum()),
+                            "rows": len(checks)}
+                           for year, year_checks in results.items() for check, checks in year_checks.items()])
+    if counts.empty:
+        return counts
+    counts["failed"] = counts["failed"].astype(str) + "/" + counts["rows"].astype(str)
+    return counts.pivot(index="check", columns="year", values="failed")
+
+
+def write_backfill(client, run_id, results, results_dir=None, results_table_id=None, logger=None):
+    '''
+    Writes the results of every year (see run_backfill()) as one long table, to Parquet partitioned by year and check,
+    and to BigQuery in one load job. Either is skipped if it is None or "". Returns the long table.
+    '''
+    run_started = datetime.datetime.now()
+    reports = {check: "rr20_service" if check.startswith("service_") else "rr20_financials"
+               for year_checks in results.values() for check in year_checks}
+    tables = [results_sink.results_table(year_checks, run_id, year, reports, run_started=run_started)
+              for year, year_checks in results.items()]
+    long_results = pd.concat(tables, ignore_index=True) if tables else results_sink.results_table({}, run_id, 0, {})
+    if results_dir:
+        results_sink.write_parquet(long_results, results_dir)
+    if results_table_id:
+        results_sink.load_to_bigquery(client, long_results, results_table_id)
+    if logger is not None:
+        logger.info(f"Saved {len(long_results)} results of {len(results)} years for run {run_id}",
+                    extra={"run_id": run_id, "rows": len(long_results), "years": list(results),
+                           "results_dir": results_dir, "results_table": results_table_id})
+    return long_results
+
+
+def main():
+    this_year = datetime.datetime.now().year
+    args = get_arguments(this_year)
+    logger = validation_logging.write_to_log('backfill_log.log', args.log_level)
+    run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("backfill", first_year=args.first_year, last_year=args.last_year, run_id=run_id)
+    client = data_sources.LocalBigQueryClient(args.data_dir) if args.data_dir else bigquery.Client()
+
+    with instrumentation.profiled(args.profile, args.profile_file, "backfill"):
+        with instrumentation.stage_timer(metrics, "rr20_all_years", "load") as record:
+            first_year = args.first_year or min(
+                partitioned_tables.available_years(client, RR20_TABLES["rr20_service"]), default=args.last_year)
+            years, tables = load_all_years(client, list(range(first_year, args.last_year + 1)))
+            orgs = data_sources.get_orgs(client)
+            record["rows_out"] = sum(instrumentation.count_rows(*year_tables.values()) for year_tables in tables.values())
+        logger.info(f"Loaded the RR-20 tables of {', '.join(map(str, years)) or 'no years'}", extra={"years": years})
+        with instrumentation.stage_timer(metrics, "datasets", "derive") as record:
+            datasets = build_datasets(tables, orgs)
+            record["rows_out"] = instrumentation.count_rows(*datasets.values())
+        with instrumentation.stage_timer(metrics, "year_pairs", "check") as record:
+            results = run_backfill(datasets, year_pairs(years), logger)
+            record["rows_out"] = sum(len(checks) for year_checks in results.values() for checks in year_checks.values())
+        with instrumentation.stage_timer(metrics, "results", "write"):
+            write_backfill(None if args.data_dir else client, run_id, results, args.results_dir,
+                           None if args.data_dir else args.results_table, logger)
+    instrumentation.write_metrics(metrics, args.metrics_file)
+
+    logger.info(f"Failed rows per check and year:\n{failure_table(results).to_string()}")
+    logger.info(f"Backfill of {len(results)} year pairs is complete!")
+
+if __name__ == "__main__":
+    main()
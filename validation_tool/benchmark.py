@@ -0,0 +1,145 @@
+from argparse import ArgumentParser
+import pandas as pd
+import numpy as np
+import datetime
+import platform
+import subprocess
+import tempfile
+import json
+import time
+import sys
+
+import data_sources
+import synthetic_data
+import validate
+import validation_logging
+
+'''Times every stage of a validation run (each data load, derived table, check and report) on synthetic data
+(see synthetic_data.py) at one or more scales, and saves the timings as JSON, with each stage's rows in and out,
+bytes read and peak memory (see instrumentation.py).
+The run is the same dependency graph as validate.py; data is served from parquet files by
+data_sources.LocalBigQueryClient instead of BigQuery, and reports are written to a temporary folder.
+
+To run from command line, navigate to folder and type e.g.:
+    python benchmark.py --scales 1x 10x --repeat 3 --output benchmark_results.json
+To compare with an earlier run, and exit with an error if any stage got slower by more than 25%, type:
+    python benchmark.py --scales 1x 10x --compare benchmark_results.json --tolerance 0.25
+'''
+
+# Stages that take less than this many seconds in both runs are not flagged, as their timings are mostly noise.
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Benchmark the validation checks on synthetic data")
+    parser.add_argument('--scales', nargs='+', choices=synthetic_data.SCALES, default=["1x", "10x"])
+    parser.add_argument('--repeat', type=int, default=1, help="Number of times to run each scale")
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--reports', nargs='+', choices=validate.REPORTS, default=validate.REPORTS)
+    parser.add_argument('--this_year', type=int, default=2023)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=f"benchmark_results_{datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')}.json")
+    parser.add_argument('--compare', default=None, help="Earlier benchmark JSON file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+    return args
+
+
+def get_run_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"started": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git_commit": commit,
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform()}
+
+
+def benchmark_scale(scale, args, logger):
+    '''Generates data at one scale, runs the validation graph args.repeat times, and returns the timings.'''
+    with tempfile.TemporaryDirectory(prefix=f"benchmark_{scale}_") as tmp_dir:
+        start = time.perf_counter()
+        data = synthetic_data.generate(scale, args.this_year, args.seed)
+        a10_files = synthetic_data.write_synthetic_data(data, tmp_dir)
+        generate_seconds = time.perf_counter() - start
+        input_rows = {name: len(df) for name, df in data["tables"].items()}
+        input_rows.update({f"{year}_a10": len(df) for year, df in data["a10"].items()})
+        del data
+
+        run_args = validate.default_arguments(args.this_year, last_year=args.this_year - 1, output_dir=tmp_dir,
+                                              a10_data=a10_files[args.this_year],
+                                              a10_lastyr_data=a10_files[args.this_year - 1], a10_year=args.this_year)
+        client = data_sources.LocalBigQueryClient(tmp_dir)
+        runs = []
+        for i in range(args.repeat):
+            graph = validate.build_graph(client, run_args, logger)
+            graph = validate.prune_graph(graph, [f"{report}_report" for report in args.reports])
+            start = time.perf_counter()
+            timings = validate.run_graph(graph, logger, jobs=args.jobs)
+            logger.info(f"Scale {scale}, run {i + 1} of {args.repeat}: {time.perf_counter() - start:.2f}s")
+            runs.append(timings.assign(run=i, total=time.perf_counter() - start))
+
+    runs = pd.concat(runs, ignore_index=True)
+    stages = (runs.groupby(["stage", "kind"], sort=False)
+              .agg(rows_in=("rows_in", "first"), rows_out=("rows_out", "first"), bytes_read=("bytes_read", "first"),
+                   peak_rss_mb=("peak_rss_mb", "max"), seconds_min=("seconds", "min"),
+                   seconds_median=("seconds", "median"), seconds_all=("seconds", list))
+              .reset_index())
+    stages[["seconds_min", "seconds_median"]] = stages[["seconds_min", "seconds_median"]].round(3)
+    for column in ["rows_in", "rows_out", "bytes_read"]:
+        stages[column] = stages[column].astype(object).where(stages[column].notna(), None)
+    totals = runs.groupby("run")["total"].first()
+    return {"scale": scale,
+            "orgs": synthetic_data.BASE_ORGS * synthetic_data.SCALES[scale],
+            "input_rows": input_rows,
+            "generate_seconds": round(generate_seconds, 3),
+            "total_seconds_min": round(totals.min(), 3),
+            "total_seconds_median": round(totals.median(), 3),
+            "stages": stages.to_dict(orient="records")}
+
+
+def compare_results(old, new, tolerance, logger):
+    '''Returns the stages whose median time went up by more than tolerance (a fraction) since the old results.'''
+    old_stages = {(r["scale"], s["stage"]): s["seconds_median"] for r in old["results"] for s in r["stages"]}
+    regressions = []
+    for result in new["results"]:
+        for stage in result["stages"]:
+            before = old_stages.get((result["scale"], stage["stage"]))
+            after = stage["seconds_median"]
+            if before is None or max(before, after) < MIN_REGRESSION_SECONDS:
+                continue
+            if after > before * (1 + tolerance):
+                regressions.append({"scale": result["scale"], "stage": stage["stage"],
+                                    "seconds_before": before, "seconds_after": after})
+                logger.info(f"Slower: {stage['stage']} at {result['scale']}: {before:.3f}s -> {after:.3f}s")
+    return regressions
+
+
+def main():
+    logger = validation_logging.write_to_log('benchmark_log.log')
+    args = get_arguments()
+
+    results = {"run": {**get_run_info(), "repeat": args.repeat, "jobs": args.jobs, "reports": args.reports,
+                       "seed": args.seed},
+               "results": []}
+    for scale in args.scales:
+        results["results"].append(benchmark_scale(scale, args, logger))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        results["regressions"] = compare_results(baseline, results, args.tolerance, logger)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Benchmark results saved to {args.output}")
+
+    if results.get("regressions"):
+        logger.info(f"{len(results['regressions'])} stage(s) slower than {args.compare} by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pandas as pd
+import datetime
+import requests
+import fsspec
+import ijson
+import json
+
+import instrumentation
+import results_sink
+import validation_logging
+
+'''Ingests the NTD reports from the BlackCat API (GetNTDReportsByYear) into the raw store, as Parquet.
+The response is one JSON array with an object per report: the report's ReportId, Organization, ReportPeriod,
+ReportStatus and ReportLastModifiedDate, and each of its tables (NTDReportingRR20_Rural, NTDReportingA35, SS60, ...)
+as {"Data": [rows]}. notebooks/ETL_inspect_API_data.ipynb loads it whole with response.json(); here it is parsed
+as it is downloaded, with ijson, one report at a time:
+- each row is flattened: a nested {"id", "Text", "Value", ...} dict (e.g. Mode, Type) is replaced by its "Text",
+  as in the notebook, and any other nested value is kept as JSON text
+- rows are added to a buffer per table, column by column, and every --batch_rows rows the buffer is written as one
+  typed Parquet file (integers, floats, booleans and text)
+- each column has one type for the whole table: the type in the table's newest file, if there is one, widened as
+  batches arrive (see widen()). A column whose integers turn out to include floats is stored as floats, and one with
+  any other mix of types as text; this run's files written before a column was widened are written again with the
+  new type, so every file a run writes for a table has the same schema
+- the report fields go to the "reports" table, one row per report.
+Memory therefore holds one report and at most --batch_rows rows per table, however many reports the API returns.
+
+Syncs are incremental: each report's ReportLastModifiedDate is kept as its watermark, in {raw_dir}/_watermarks.json,
+with the run that wrote the report's rows. A sync only flattens and writes the reports that are new, or whose
+ReportLastModifiedDate differs from their watermark; unchanged reports are skipped as soon as they are parsed (the
+API has no "modified since" filter, so the response itself is still downloaded in full). Reports that are no longer
+in the response lose their watermark. Each sync is recorded in {raw_dir}/_sync/{run_id}.json: the source, times,
+the new, modified, unchanged and removed ReportIds and the rows written per table. The watermarks are saved last,
+so a sync that fails part way is simply done again by the next one. --full_sync rewrites every report.
+
+Tables are named as in BigQuery's external tables: the API's name in lowercase with "_data" added (e.g.
+ntdreportingrr20_rural_data). Every run adds its own files, named with the run's id:
+    {raw_dir}/{table}/{run_id}-{part}.parquet
+Reading a table back: read_raw_table(raw_dir, "ntdreportingrr20_rural_data") returns, for every report, the rows of
+the run that its watermark points to (so a modified report's earlier rows are left out), or every row if there are
+no watermarks yet.
+
+To run from command line, navigate to folder and type:
+    python blackcat_api.py --year 2023
+To write every report again, not only the new or modified ones, add --full_sync.
+To ingest the recorded response in data/ (five 2023 reports, with contacts replaced) into a local folder, type:
+    python blackcat_api.py --source data/blackcat_GetNTDReportsByYear_2023_sample.json --raw_dir blackcat_api_2023
+'''
+
+API_URL = "https://services.blackcattransit.com/api/APIModules/GetNTDReportsByYear/BCG_CA/{year}"
+RAW_DIR = "gs://calitp-ntd-report-validation/blackcat_ntd_reports_{year}_api"
+FIXTURE = "data/blackcat_GetNTDReportsByYear_2023_sample.json"
+REPORT_FIELDS = ['ReportId', 'Organization', 'ReportPeriod', 'ReportStatus', 'ReportLastModifiedDate']
+REPORTS_TABLE = "reports"
+WATERMARKS_FILE = "_watermarks.json"
+MANIFEST_DIR = "_sync"
+LAST_MODIFIED_FORMAT = "%m/%d/%Y %I:%M:%S %p" # e.g. 9/18/2023 2:35:31 PM
+BATCH_ROWS = 50_000
+TIMEOUT = 300 # seconds to wait for the API to start sending, or between chunks
+
+
+def get_arguments(this_year):
+    parser = ArgumentParser(description="Stream the NTD reports from the BlackCat API into the raw store")
+    parser.add_argument('--year', type=int, default=this_year)
+    parser.add_argument('--source', default=None,
+                        help="URL or file (local or gs://, can be gzipped) of the response; default: the API for --year")
+    parser.add_argument('--raw_dir', default=None, help=f"Folder (local or gs://) to write to; default: {RAW_DIR}")
+    parser.add_argument('--batch_rows', type=int, default=BATCH_ROWS, help="Rows of a table to write per Parquet file")
+    parser.add_argument('--full_sync', action='store_true',
+                        help="Write every report, not only those that are new or modified since the last sync")
+    validation_logging.add_arguments(parser)
+    instrumentation.add_arguments(parser, "blackcat_api")
+    args = parser.parse_args()
+    return args
+
+
+def table_name(key):
+    '''The raw table of an API table, named as in BigQuery (see notebooks/ETL_inspect_API_data.ipynb).'''
+    return f"{key.lower()}_data"
+
+
+@contextmanager
+def open_source(source, timeout=TIMEOUT):
+    '''The response as a binary stream: downloaded as it is read for a URL, or read from a (local or fsspec) file.'''
+    if source.startswith(("http://", "https://")):
+        with requests.get(source, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True # undo gzip or deflate transfer encoding
+            yield response.raw
+    else:
+        instrumentation.add_file_read(source)
+        with fsspec.open(source, "rb", compression="infer") as f:
+            yield f
+
+
+def iter_reports(stream):
+    '''The reports in a response, one at a time, as dicts.'''
+    yield from ijson.items(stream, "item", use_float=True)
+
+
+def flatten_value(value):
+    if isinstance(value, dict):
+        return value.get("Text") if "Text" in value else json.dumps(value)
+    if isinstance(value, list):
+        return json.dumps(value)
+    return value
+
+
+def last_modified(report):
+    '''A report's ReportLastModifiedDate in ISO format (or as given, if it is not in the API's format).'''
+    value = report.get("ReportLastModifiedDate")
+    try:
+        return datetime.datetime.strptime(value, LAST_MODIFIED_FORMAT).isoformat()
+    except (TypeError, ValueError):
+        return value
+
+
+def new_buffer(types=None):
+    # types: the table's column types so far, kept from batch to batch; files: this run's (path, schema) of the table
+    return {"columns": {}, "rows": 0, "parts": 0, "types": dict(types or {}), "files": []}
+
+
+def saved_types(raw_dir, table):
+    '''The column types of a table's newest file in raw_dir ({column: Arrow type}), or {} if it has none.'''
+    fs, path = fsspec.core.url_to_fs(raw_dir)
+    files = sorted(fs.glob(f"{path}/{table}/*.parquet"))
+    if not files:
+        return {}
+    with fs.open(files[-1], "rb") as f:
+        schema = pq.read_schema(f)
+    return dict(zip(schema.names, schema.types))
+
+
+def add_rows(buffer, rows):
+    '''Appends rows (dicts) to a table's buffer, column by column. Columns missing from a row are null.'''
+    columns = buffer["columns"]
+    for row in rows:
+        n = buffer["rows"]
+        for column, value in row.items():
+            values = columns.get(column)
+            if values is None:
+                values = columns[column] = [None] * n
+            values.append(flatten_value(value))
+        buffer["rows"] = n + 1
+        for values in columns.values():
+            if len(values) == n:
+                values.append(None)
+
+
+def widen(known, found):
+    '''The type of a column known so far as known (None: not seen yet) once it also has values of type found.'''
+    if known is None or pa.types.is_null(known):
+        return found
+    if pa.types.is_null(found) or found == known:
+        return known
+    if all(pa.types.is_integer(dtype) or pa.types.is_floating(dtype) for dtype in (known, found)):
+        return pa.float64()
+    return pa.string()
+
+
+def cast(array, dtype):
+    if dtype == pa.string() and array.type != pa.string():
+        # as str() gives them, like the values of a batch with mixed types
+        return pa.array([None if value is None else str(value) for value in array.to_pylist()], type=pa.string())
+    return array.cast(dtype)
+
+
+def conform(table, types):
+    '''table with a column of each type in types ({column: Arrow type}), in that order; those it lacks are null.'''
+    return pa.table({column: cast(table[column], dtype) if column in table.column_names else pa.nulls(len(table), dtype)
+                     for column, dtype in types.items()})
+
+
+def to_arrow(columns, types):
+    '''
+    The buffered columns as an Arrow table with the table's column types (types, {column: Arrow type}), after widening
+    them to hold these values. A column whose values in this batch have more than one type is text.
+    '''
+    arrays = {}
+    for column, values in columns.items():
+        try:
+            arrays[column] = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            arrays[column] = pa.array([None if value is None else str(value) for value in values], type=pa.string())
+        types[column] = widen(types.get(column), arrays[column].type)
+    return conform(pa.table(arrays), types)
+
+
+def flush(buffer, raw_dir, table, run_id):
+    '''Writes a table's buffered rows as one Parquet file, and empties the buffer. Returns the number of rows written.'''
+    rows = buffer["rows"]
+    if rows == 0:
+        return 0
+    fs, path = fsspec.core.url_to_fs(raw_dir)
+    fs.makedirs(f"{path}/{table}", exist_ok=True)
+    file = f"{path}/{table}/{run_id}-{buffer['parts']:05d}.parquet"
+    arrow_table = to_arrow(buffer["columns"], buffer["types"])
+    with fs.open(file, "wb") as f:
+        pq.write_table(arrow_table, f)
+    buffer["files"].append((file, arrow_table.schema))
+    buffer.update(columns={}, rows=0, parts=buffer["parts"] + 1)
+    return rows
+
+
+def conform_files(buffer, raw_dir):
+    '''Writes again the files of a table written before its column types last changed, with the final types.'''
+    fs, _ = fsspec.core.url_to_fs(raw_dir)
+    schema = pa.schema(list(buffer["types"].items()))
+    for file, file_schema in buffer["files"]:
+        if file_schema.equals(schema):
+            continue
+        with fs.open(file, "rb") as f:
+            arrow_table = pq.read_table(f)
+        with fs.open(file, "wb") as f:
+            pq.write_table(conform(arrow_table, buffer["types"]), f)
+        instrumentation.add_count("files_conformed", 1)
+
+
+def ingest(source, raw_dir, batch_rows=BATCH_ROWS, run_id=None, logger=None, timeout=TIMEOUT, watermarks=None):
+    '''
+    Streams the reports in source (URL or file) into raw_dir, as described above, skipping those whose last modified
+    date is the same as in watermarks ({ReportId: watermark}; default: none are skipped).
+    Returns the rows written per table, and the last modified date of every report in source ({ReportId: date}).
+    '''
+    run_id = run_id or results_sink.new_run_id()
+    watermarks = watermarks or {}
+    buffers = {}
+    written = {}
+    reports = {}
+
+    def add(table, rows):
+        if table not in buffers:
+            buffers[table] = new_buffer(saved_types(raw_dir, table))
+        buffer = buffers[table]
+        add_rows(buffer, rows)
+        if buffer["rows"] >= batch_rows:
+            written[table] = written.get(table, 0) + flush(buffer, raw_dir, table, run_id)
+
+    with open_source(source, timeout) as stream:
+        for report in iter_reports(stream):
+            report_id = report.get("ReportId")
+            reports[report_id] = last_modified(report)
+            watermark = watermarks.get(report_id)
+            if watermark is not None and watermark["last_modified"] == reports[report_id]:
+                instrumentation.add_count("reports_unchanged", 1)
+                continue
+            add(REPORTS_TABLE, [{field: report.get(field) for field in REPORT_FIELDS}])
+            for key, value in report.items():
+                if isinstance(value, dict) and isinstance(value.get("Data"), list):
+                    add(table_name(key), value["Data"])
+            instrumentation.add_count("reports", 1)
+    for table, buffer in buffers.items():
+        written[table] = written.get(table, 0) + flush(buffer, raw_dir, table, run_id)
+        conform_files(buffer, raw_dir)
+
+    if logger is not None:
+        logger.info(f"Wrote {written.get(REPORTS_TABLE, 0)} of {len(reports)} reports from {source} to {raw_dir}, "
+                    f"run {run_id}: "
+                    + ", ".join(f"{table} {rows}" for table, rows in written.items() if table != REPORTS_TABLE),
+                    extra={"run_id": run_id, "rows": written})
+    return written, reports
+
+
+def load_watermarks(raw_dir):
+    '''The watermark of every report synced to raw_dir ({ReportId: {"ReportId", "last_modified", "run_id"}}), or {}.'''
+    fs, path = fsspec.core.url_to_fs(f"{raw_dir}/{WATERMARKS_FILE}")
+    if not fs.exists(path):
+        return {}
+    with fs.open(path, "r") as f:
+        return {watermark["ReportId"]: watermark for watermark in json.load(f)}
+
+
+def _write_json(raw_dir, name, value):
+    # Write to a temporary file and move it into place, so an interrupted sync never leaves a half-written file.
+    fs, path = fsspec.core.url_to_fs(f"{raw_dir}/{name}")
+    fs.makedirs(path.rsplit("/", 1)[0], exist_ok=True)
+    with fs.open(f"{path}.tmp", "w") as f:
+        json.dump(value, f, indent=1, default=str)
+    fs.mv(f"{path}.tmp", path)
+
+
+def sync(source, raw_dir, batch_rows=BATCH_ROWS, run_id=None, logger=None, timeout=TIMEOUT, full_sync=False):
+    '''
+    Writes the reports in source that are new or modified since the last sync to raw_dir (every report if full_sync),
+    records the sync in its manifest and updates the watermarks (see above). Returns the manifest.
+    '''
+    run_id = run_id or results_sink.new_run_id()
+    started = datetime.datetime.now()
+    watermarks = load_watermarks(raw_dir)
+    written, reports = ingest(source, raw_dir, batch_rows, run_id, logger, timeout, None if full_sync else watermarks)
+
+    changes = {"new": [], "modified": [], "unchanged": []}
+    new_watermarks = []
+    for report_id, modified in reports.items():
+        watermark = watermarks.get(report_id)
+        if watermark is None:
+            change = "new"
+        elif watermark["last_modified"] != modified:
+            change = "modified"
+        else:
+            change = "unchanged"
+        changes[change].append(report_id)
+        rewritten = full_sync or change != "unchanged"
+        new_watermarks.append({"ReportId": report_id, "last_modified": modified,
+                               "run_id": run_id if rewritten else watermark["run_id"]})
+    changes["removed"] = [report_id for report_id in watermarks if report_id not in reports]
+
+    manifest = {"run_id": run_id, "source": source, "started": started.isoformat(timespec="seconds"),
+                "finished": datetime.datetime.now().isoformat(timespec="seconds"), "full_sync": full_sync,
+                "reports": len(reports), **changes, "rows": written}
+    _write_json(raw_dir, f"{MANIFEST_DIR}/{run_id}.json", manifest)
+    _write_json(raw_dir, WATERMARKS_FILE, new_watermarks)
+    if logger is not None:
+        logger.info(f"Synced {source} to {raw_dir}: " + ", ".join(f"{len(changes[change])} {change}" for change in changes)
+                    + " reports", extra={"run_id": run_id, **{change: len(ids) for change, ids in changes.items()}})
+    return manifest
+
+
+def read_raw_table(raw_dir, table):
+    '''
+    The rows of a raw table in raw_dir, as a dataframe: for every report, those written by the run of its watermark,
+    or every row from every run if raw_dir has no watermarks.
+    '''
+    fs, path = fsspec.core.url_to_fs(raw_dir)
+    files = sorted(fs.glob(f"{path}/{table}/*.parquet"))
+    runs = {}
+    for watermark in load_watermarks(raw_dir).values():
+        runs.setdefault(watermark["run_id"], []).append(watermark["ReportId"])
+    frames = []
+    for file in files:
+        run_id = file.rsplit("/", 1)[-1].rsplit("-", 1)[0]
+        if runs and run_id not in runs:
+            continue # every report in it was rewritten since, or removed
+        with fs.open(file, "rb") as f:
+            frame = pq.read_table(f).to_pandas()
+        if runs and "ReportId" in frame.columns:
+            frame = frame[frame["ReportId"].isin(runs[run_id])]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def main():
+    this_year = datetime.datetime.now().year
+    args = get_arguments(this_year)
+    logger = validation_logging.write_to_log('blackcat_api_log.log', args.log_level)
+    source = args.source or API_URL.format(year=args.year)
+    raw_dir = args.raw_dir or RAW_DIR.format(year=args.year)
+    run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("blackcat_api", year=args.year, run_id=run_id, source=source)
+
+    with instrumentation.profiled(args.profile, args.profile_file, "blackcat_api"):
+        with instrumentation.stage_timer(metrics, "blackcat_api", "load") as record:
+            manifest = sync(source, raw_dir, args.batch_rows, run_id, logger, full_sync=args.full_sync)
+            record["rows_out"] = sum(manifest["rows"].values())
+    instrumentation.write_metrics(metrics, args.metrics_file)
+
+if __name__ == "__main__":
+    main()
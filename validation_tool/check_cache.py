@@ -0,0 +1,195 @@
+import pandas as pd
+import numpy as np
+import functools
+import importlib
+import hashlib
+import inspect
+import logging
+import weakref
+import pickle
+import json
+import sys
+import os
+
+import instrumentation
+
+'''Memoized checks: a check called again with the same inputs returns its saved results instead of running again,
+e.g. when a script is re-run after an ingestion that changed nothing.
+Every check a script runs goes through memoize():
+    memo = functools.partial(check_cache.memoize, cache_dir=args.cache_dir, max_mb=args.cache_max_mb)
+    checks = timed("financials_Fare_Revenues", "check", memo(financial_checks, "financials_Fare_Revenues"),
+                   allyears, "Fare_Revenues", this_year, last_year, logger)
+
+Results are saved as {cache_dir}/{key}.pkl, where the key is a hash of:
+- the check's name
+- its parameters (every argument that is not a table; loggers are left out)
+- a fingerprint of each input table: a hash of every value, in row order, and of the column names and dtypes
+- the code version: a hash of the source of the check's module and of check_results.py, and the pandas version.
+Changing a check's code, or the shared result builder, therefore never returns results from the old code.
+A hit only costs hashing the inputs and reading one small file. Each table's fingerprint is computed once and reused
+by the other checks that get the same table.
+
+The cache is a folder on local disk, given with --cache_dir (e.g. --cache_dir .check_cache, which .gitignore leaves
+out); without it, checks are not memoized and nothing is saved. When it grows over --cache_max_mb, the least recently
+used results are deleted. Each check stage counts its cache_hits and cache_misses, and the run's
+metrics JSON has the totals and hit rate (see instrumentation.write_metrics()).
+'''
+
+CACHE_DIR = ".check_cache"
+CACHE_MAX_MB = 512
+SHARED_CODE = ["check_results"] # modules whose code every check's results depend on
+
+_fingerprints = {} # id(table): (weak reference to the table, fingerprint)
+_code_versions = {}
+
+
+def add_arguments(parser):
+    '''Adds the --cache_dir and --cache_max_mb options to a script's argument parser.'''
+    parser.add_argument('--cache_dir', default=None,
+                        help=f"Folder to save check results in, to reuse when a check gets the same inputs again, e.g. "
+                             f"{CACHE_DIR}; default: no cache")
+    parser.add_argument('--cache_max_mb', type=float, default=CACHE_MAX_MB,
+                        help="Size of --cache_dir above which the least recently used results are deleted")
+    return parser
+
+
+def fingerprint(data):
+    '''A hash of a table's (or series' or array's) values in row order, and of its column names and dtypes.'''
+    entry = _fingerprints.get(id(data))
+    if entry is not None and entry[0]() is data:
+        return entry[1]
+    frame = data if isinstance(data, (pd.DataFrame, pd.Series)) else pd.Series(data)
+    # A NaN can have different bits (e.g. 0/0 gives a negative NaN, which comes back as a positive one from a snapshot),
+    # so every NaN is hashed as the same value.
+    if isinstance(frame, pd.DataFrame):
+        floats = [column for column, dtype in frame.dtypes.items() if dtype.kind == "f"]
+        frame = frame.assign(**{column: frame[column].fillna(np.nan) for column in floats}) if floats else frame
+    elif frame.dtype.kind == "f":
+        frame = frame.fillna(np.nan)
+    dtypes = frame.dtypes.items() if isinstance(frame, pd.DataFrame) else [(frame.name, frame.dtype)]
+    digest = hashlib.sha256(json.dumps([f"{column}:{dtype}" for column, dtype in dtypes]).encode())
+    digest.update(np.ascontiguousarray(pd.util.hash_pandas_object(frame, index=False).to_numpy()).tobytes())
+    value = digest.hexdigest()
+    try:
+        reference = weakref.ref(data, lambda _, key=id(data): _fingerprints.pop(key, None))
+        _fingerprints[id(data)] = (reference, value)
+    except TypeError: # lists can not be weakly referenced
+        pass
+    return value
+
+
+def code_version(func):
+    '''A hash of the source files of func's module and of the SHARED_CODE modules, and of the pandas version.'''
+    module = func.__module__
+    if module not in _code_versions:
+        digest = hashlib.sha256(pd.__version__.encode())
+        for name in [module] + SHARED_CODE:
+            source = inspect.getsourcefile(sys.modules.get(name) or importlib.import_module(name))
+            with open(source, "rb") as f:
+                digest.update(f.read())
+        _code_versions[module] = digest.hexdigest()
+    return _code_versions[module]
+
+
+def is_table(value):
+    return isinstance(value, (pd.DataFrame, pd.Series, np.ndarray, pd.api.extensions.ExtensionArray))
+
+
+def cache_key(check_name, check_func, args, kwargs):
+    '''The key a check's results are saved under (see above).'''
+    arguments = inspect.signature(check_func).bind(*args, **kwargs).arguments
+    key = {"check": check_name,
+           "params": {arg: value for arg, value in arguments.items()
+                      if not is_table(value) and not isinstance(value, logging.Logger)},
+           "inputs": {arg: fingerprint(value) for arg, value in arguments.items() if is_table(value)},
+           "code": code_version(check_func)}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _evict(cache_dir, max_bytes):
+    '''Deletes the least recently used results until the folder is no bigger than max_bytes.'''
+    entries = []
+    with os.scandir(cache_dir) as files:
+        for entry in files:
+            if entry.name.endswith(".pkl"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: # deleted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def get(cache_dir, key):
+    '''The results saved under key, or None. A hit marks the file as recently used.'''
+    path = os.path.join(cache_dir, f"{key}.pkl")
+    try:
+        with open(path, "rb") as f:
+            result = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    os.utime(path)
+    return result
+
+
+def put(cache_dir, key, result, max_bytes):
+    # Write to a temporary file and move it into place, so a concurrent reader never sees a half-written file.
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{key}.pkl")
+    with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+    _evict(cache_dir, max_bytes)
+
+
+def cached_call(check_name, check_func, cache_dir, max_bytes, *args, **kwargs):
+    '''Returns check_func(*args, **kwargs), from the cache if it was saved before with the same key.'''
+    key = cache_key(check_name, check_func, args, kwargs)
+    result = get(cache_dir, key)
+    if result is not None:
+        instrumentation.add_count("cache_hits", 1)
+        return result
+    instrumentation.add_count("cache_misses", 1)
+    result = check_func(*args, **kwargs)
+    put(cache_dir, key, result, max_bytes)
+    return result
+
+
+def memoize(check_func, check_name, cache_dir=CACHE_DIR, max_mb=CACHE_MAX_MB):
+    '''
+    check_func, going through the cache in cache_dir (or check_func itself if cache_dir is None or "").
+    The result can be pickled, so it can be run in a worker process.
+    '''
+    if not cache_dir:
+        return check_func
+    memoized = functools.partial(cached_call, check_name, check_func, cache_dir, int(max_mb * 1024 * 1024))
+    return functools.update_wrapper(memoized, check_func)
+
+
+def original(func):
+    '''
+    The check function memoize() was given, or func itself if it is not memoized. Unlike the name memoize() copies onto
+    the memoized function, this is kept when it is sent to a worker process (which pickles partials without their names).
+    '''
+    if isinstance(func, functools.partial) and func.func is cached_call:
+        return func.args[1]
+    return func
+
+
+def memoize_graph(graph, cache_dir=CACHE_DIR, max_mb=CACHE_MAX_MB):
+    '''
+    Memoizes every check stage of a validate.py graph. Returns the graph. Checks without input stages read their own data
+    (e.g. the SQL checks of sql_checks.py), so their results can not be keyed on it and are not memoized.
+    '''
+    for name, stage in graph.items():
+        if stage["kind"] == "check" and stage["inputs"]:
+            stage["func"] = memoize(stage["func"], name, cache_dir, max_mb)
+    return graph
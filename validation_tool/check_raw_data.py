@@ -2,9 +2,11 @@ from google.cloud import bigquery, storage
 from argparse import ArgumentParser
 import pandas as pd
 import datetime
-import logging
 import re
 
+import schema_validation
+import validation_logging
+
 
 '''Check and load BlackCat 2023 NTD reports into Big Query. 
 This script:
@@ -12,6 +14,8 @@ This script:
 - Lists out the subrecipients in the latest file
 - loops over them and adds their data to BigQuery's raw data tables - IF the data is not already there. Checks are included
 - before upload into BigQuery, a `date_uploaded` file is added to each dataset
+- sheets with a schema in notebooks/schemas (see schema_validation.INGESTION_SCHEMAS) are checked against it, and
+  the failure cases are logged (and written to --schema_failures, if given)
 
 To run:
 python check_raw_data.py --form_to_check <form-number>
@@ -35,32 +39,13 @@ def get_arguments(this_year):
     parser.add_argument('--form_to_check')
     parser.add_argument('--incoming_org_col_name', default='Organization Legal Name')
     parser.add_argument('--bq_org_col_name', default='Organization_Legal_Name')
+    parser.add_argument('--schema_failures', default=None,
+                        help="CSV file (local or gs://) to write the incoming data's schema failure cases to")
 
     args = parser.parse_args()
     return args
 
 
-def write_to_log(logfilename):
-    '''
-    Creates a logger object that outputs to a log file, to the filename specified,
-    and also streams to console.
-    '''
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter(f'%(asctime)s:%(levelname)s: %(message)s',
-                                  datefmt='%y-%m-%d %H:%M:%S')
-    file_handler = logging.FileHandler(logfilename)
-    file_handler.setFormatter(formatter)
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
-
-    if not logger.hasHandlers():
-        logger.addHandler(file_handler)
-        logger.addHandler(stream_handler)
-
-    return logger
-
-
 def get_latest_excel(this_year, form_to_check, bucket, subdir):
     # Dict code table to decipher a) forms to files - this lists the BEGINNING of the form name
     form_to_file_dict = {
@@ -166,7 +151,7 @@ def compare_datasets(form_to_check, form_to_sheets_dict, this_year, latest_file,
 
 def main():
     # Set up the logger object
-    logger = write_to_log('load_raw_data_output.log')
+    logger = validation_logging.write_to_log('load_raw_data_output.log')
 
     storage_client = storage.Client(project='cal-itp-data-infra')
     bucket_name = "calitp-ntd-report-validation"
@@ -194,6 +179,8 @@ def main():
         sheet = form_to_sheets_dict.get(args.form_to_check)[0]
     
     latest_raw_data = load_excel_data(f"gs://{bucket_name}/{latest_filename}", sheet) #now load the data
+    # Check the incoming data against its schema in notebooks/schemas, if it has one. Failures are logged; the raw data is still loaded as is.
+    schema_validation.check_ingested_sheet(latest_raw_data, sheet, logger, args.schema_failures)
 
     orgs = pd.read_csv(args.subrecipients)
     orgs_submitting = orgs['Organization'].unique() 
@@ -0,0 +1,92 @@
+import pandas as pd
+import numpy as np
+
+'''Shared builder for the tables that checks return. Rows are appended column by column into plain lists,
+instead of one dict per row, and the table is made (and sorted) once at the end:
+    output = check_results.new_results()
+    for agency in agencies:
+        ...
+        check_results.add_result(output, Organization=agency, name_of_check=check_name, value_checked=value,
+                                 check_status=result, Description=description)
+    checks = check_results.results_frame(output)
+
+Check names, statuses, modes and descriptions repeat on most rows (a check's pass rows all share one name, status
+and empty description), so results_frame() stores them as categoricals: each distinct value is kept once,
+and each row only holds a small integer code. A description that has values in it is added as a template and its
+values, with describe(), instead of as text:
+    description = check_results.describe("The {variable} for {mode} has changed ...", variable=variable, mode=mode)
+results_frame() fills in each distinct template and values once, when the table is made, so the rows of a check
+that fail for the same reason share one text while the check runs, not one copy each.
+combine_results() concatenates check tables and keeps those columns categorical. Each table is already sorted by
+organization, so they are merged (a stable sort, which takes the sorted runs as they are) instead of sorted again;
+the rows of an organization are in the order of the tables, and of the rows in each. The values in the tables (and
+in the reports written from them) are unchanged.
+'''
+
+CHECK_COLUMNS = ["Organization", "name_of_check", "value_checked", "check_status", "Description"]
+CATEGORICAL_COLUMNS = ["name_of_check", "mode", "check_status", "check_result", "Description"]
+
+
+def new_results(*columns):
+    '''An empty result table, as a dict of column name: list of values. The columns default to CHECK_COLUMNS.'''
+    return {column: [] for column in (columns or CHECK_COLUMNS)}
+
+
+def describe(template, **values):
+    '''A description to be made from template (filled in with str.format()) and values by results_frame().'''
+    return (template, tuple(values.items()))
+
+
+def add_result(results, **row):
+    '''Appends one row, given as column=value for every column of results.'''
+    if len(row) != len(results):
+        raise ValueError(f"A result row needs exactly the columns {list(results)}, got {list(row)}")
+    for column, values in results.items():
+        values.append(row[column])
+
+
+def fill_in(values):
+    '''A column's values, with the descriptions made by describe() filled in: each distinct one once.'''
+    texts = {}
+    filled = []
+    for value in values:
+        if isinstance(value, tuple):
+            if value not in texts:
+                template, template_values = value
+                texts[value] = template.format(**dict(template_values))
+            value = texts[value]
+        filled.append(value)
+    return filled
+
+
+def results_frame(results, sort_by="Organization"):
+    '''
+    The result table as a dataframe, sorted by sort_by (or unsorted if None), with its descriptions filled in (see
+    describe()) and the columns in CATEGORICAL_COLUMNS as categoricals.
+    '''
+    if "Description" in results:
+        results = {**results, "Description": fill_in(results["Description"])}
+    frame = pd.DataFrame(results)
+    for column in frame.columns.intersection(CATEGORICAL_COLUMNS):
+        frame[column] = frame[column].astype("category")
+    if sort_by is not None:
+        frame = frame.sort_values(by=sort_by)
+    return frame
+
+
+def combine_results(frames, sort_by="Organization"):
+    '''
+    Concatenates check tables, in the order given, and merges them by sort_by (unless it is None): each table is sorted
+    by it already (see results_frame()), so a stable sort keeps their rows' order and only interleaves the tables.
+    Columns that are categorical in every table are given the same categories first, so they stay categorical instead
+    of becoming strings.
+    '''
+    frames = list(frames)
+    for column in CATEGORICAL_COLUMNS:
+        parts = [frame[column] for frame in frames if column in frame.columns]
+        if len(parts) < len(frames) or not all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            continue
+        categories = pd.unique(np.concatenate([part.cat.categories.to_numpy(dtype=object) for part in parts]))
+        frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    combined = pd.concat(frames, ignore_index=True)
+    return combined.sort_values(by=sort_by, kind="stable") if sort_by is not None else combined
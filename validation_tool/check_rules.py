@@ -0,0 +1,512 @@
+from types import SimpleNamespace
+import pandas as pd
+import numpy as np
+import functools
+import json
+
+import a10_facilities_check
+import check_results
+import rr20_service_check
+import rr20_financials_check
+import validation_logging
+
+'''The table checks as declarative rules, compiled into batched pandas/NumPy operations. A rule says what a check
+computes and how it classifies it; the compiler runs every rule that reads the same table with the same grouping keys
+in one pass over it, instead of filtering the table once per agency (and mode) as the loop code does.
+
+A rule is a dict:
+    {"check": "service_cost_per_hr",  # the check (validate.py stage) whose table the rule adds rows to
+     "id": "cost_per_hr",             # the check id in its log summary (e.g. RR20F-179), or None to not log one
+     "form": "rr20_service",          # the report, which gives the organization and year columns (see FORMS)
+     "input": "service_ratios",       # the validate.py stage of the table the rule reads
+     "by": ["Mode"],                  # grouping keys within an organization: one row per value in this year's rows
+     "agencies": "all",               # check every organization in the table ("all") or only those with rows this year
+     "requires": ["this_year", "last_year"], # skip organizations without rows in these years
+     "threshold": .3,
+     "values": {"this": {"agg": "first", "column": "cost_per_hr", "year": "this_year", "round": 2},
+                "last": {"agg": "first", "column": "cost_per_hr", "year": "last_year", "round": 2, "missing": 0}},
+     "fields": {"pct_change": "round(abs((last - this) / last) * 100, 1)"},
+     "outcomes": [{"when": "(last != 0) & (abs((last - this) / last) >= threshold)", "status": "fail",
+                   "name": "cost_per_hr", "description": "... has changed from last year by {pct_change}% ..."},
+                  {"status": "pass", "name": "cost_per_hr", "description": ""}],
+     "columns": {"mode": "{Mode}", "value_checked": "{this_year} = {this}, {last_year} = {last}"}}
+A value aggregates one column (or the sum of a list of columns) over a group's rows of one year (or of both, if
+"year" is None), optionally only the rows matching "where" ({column: value}):
+- "first": the value of the first row, "sum": the sum, "sum_unique": the sum of the distinct values,
+  "any_null": whether any of the columns is null on any row
+- "columns_from" instead of "column" sums each row's numeric columns from that column to the last one
+- "round": decimals to round to; 0 rounds to a whole number, as round(x) does
+- "missing": the value of groups without such rows.
+Expressions ("when" and "fields") are Python expressions over whole columns (one value per row of the results), of
+the values, the threshold, this_year and last_year, with & and | in place of and and or; abs() and round() work on
+columns. The first outcome whose "when" is true (or that has none) gives the row's status, name and description.
+Descriptions, names and "columns" are str.format() templates of the values, fields, grouping keys, threshold and years.
+
+Rows are in the order the loop code adds them: by organization (in order of first appearance in the table, or in this
+year's rows), then by grouping key (in order of first appearance in this year's rows), then in the order of the check's
+rules, before results_frame() sorts them by organization. The results are the same as the loop code's, row for row.
+RULES has every check that is one row per organization (or organization and mode) and compares its own values:
+the RR-20 service and financials checks and the A-10 facilities checks. The VOMS checks (per VIN) and RR20F-182
+(which joins two tables) are still run by their own functions.
+
+To run the rules from validate.py instead of the check functions, type:
+    python validate.py --check_engine rules
+To compare them with the check functions on synthetic data, type:
+    python equivalence.py --candidate rules --datasets synthetic --scale 10x
+'''
+
+# The organization and year columns of each form's tables, and the columns of its results
+FORMS = {
+    "rr20_service": {"org": "Organization_Legal_Name", "year": "Fiscal_Year",
+                     "columns": rr20_service_check.SERVICE_RESULT_COLUMNS},
+    "rr20_financials": {"org": "Organization_Legal_Name", "year": "Fiscal_Year", "columns": check_results.CHECK_COLUMNS},
+    "a10": {"org": "Agency", "year": "year", "columns": check_results.CHECK_COLUMNS},
+}
+YEARS = {"this_year", "last_year"}
+AGGREGATIONS = {"first", "sum", "sum_unique", "any_null"}
+# Columns of the results that come from a row's outcome; the others (but Organization) come from the rule's "columns"
+OUTCOME_COLUMNS = {"name_of_check": "name", "check_status": "status", "Description": "description"}
+
+
+def _year_values(variable, rounding, missing=None):
+    values = {"this": {"agg": "first", "column": variable, "year": "this_year", "round": rounding},
+              "last": {"agg": "first", "column": variable, "year": "last_year", "round": rounding}}
+    if missing is not None:
+        values["last"]["missing"] = missing
+    return values
+
+
+def _service_rule(variable, threshold, outcomes):
+    return {"check": f"service_{variable}", "id": variable, "form": "rr20_service", "input": "service_ratios",
+            "by": ["Mode"], "agencies": "all", "requires": ["this_year", "last_year"], "threshold": threshold,
+            "values": _year_values(variable, 2, missing=0),
+            "fields": {"pct_change": "round(abs((last - this) / last) * 100, 1)"},
+            "outcomes": outcomes,
+            "columns": {"mode": "{Mode}", "value_checked": "{this_year} = {this}, {last_year} = {last}"}}
+
+
+def ratio_rule(variable, threshold):
+    '''The rule of rr20_service_check.rr20_ratios() for one ratio (see ratio_result()).'''
+    return _service_rule(variable, threshold, [
+        {"when": "(last == 0) & (abs(this - last) >= threshold)", "status": "fail", "name": variable,
+         "description": f"The {variable} for {{Mode}} has changed from last year by > = {threshold*100}%, please provide a narrative justification."},
+        {"when": "(last != 0) & (abs((last - this) / last) >= threshold)", "status": "fail", "name": variable,
+         "description": f"The {variable} for {{Mode}} has changed from last year by {{pct_change}}%, please provide a narrative justification."},
+        {"status": "pass", "name": variable, "description": ""}])
+
+
+def single_number_rule(variable, threshold=None):
+    '''The rule of rr20_service_check.check_single_number() for one variable (see single_number_result()).'''
+    outcomes = [{"when": "((round(this) == 0) & (round(last) != 0)) | ((round(this) != 0) & (round(last) == 0))",
+                 "status": "fail", "name": variable,
+                 "description": f"The {variable} for {{Mode}} has changed either from or to zero compared to last year. Please provide a narrative justification."}]
+    if threshold is not None:
+        outcomes += [
+            {"when": "(last == 0) & (abs(this - last) >= threshold)", "status": "fail", "name": variable,
+             "description": f"The {variable} for {{Mode}} was 0 last year and has changed by > = {threshold*100}%, please provide a narrative justification."},
+            {"when": "(last != 0) & (abs((last - this) / last) >= threshold)", "status": "fail", "name": variable,
+             "description": f"The {variable} for {{Mode}} has changed from last year by {{pct_change}}%; please provide a narrative justification."}]
+    outcomes.append({"status": "pass", "name": variable, "description": ""})
+    return _service_rule(variable, threshold, outcomes)
+
+
+def financial_rule(variable):
+    '''The rule of rr20_financials_check.financial_checks() for one variable (see financial_result()).'''
+    values = {year: {"agg": "sum_unique", "column": variable, "year": f"{year}_year", "round": 0} for year in ["this", "last"]}
+    outcomes = []
+    if variable != 'Other_Directly_Generated_Funds':
+        outcomes.append({"when": "((round(this) == 0) & (round(last) != 0)) | ((round(this) != 0) & (round(last) == 0))",
+                         "status": "fail", "name": f"Change from 0: {variable}",
+                         "description": f"{variable} funding changed either from or to zero compared to last year. Please provide a narrative justification."})
+    outcomes += [
+        {"when": "(abs(round(last)) == abs(round(this))) & (this != 0) & (last != 0)", "status": "fail",
+         "name": f"Same value: {variable}",
+         "description": f"You have identical values for {variable} reported in {{this_year}} and {{last_year}}, which is unusual. Please provide a narrative justification."},
+        {"status": "pass", "name": variable, "description": ""}]
+    return {"check": f"financials_{variable}", "id": variable, "form": "rr20_financials", "input": "financials_allyears",
+            "by": [], "agencies": "this_year", "requires": ["this_year", "last_year"], "values": values,
+            "outcomes": outcomes, "columns": {"value_checked": "{this_year} = {this}, {last_year} = {last}"}}
+
+
+MISSING_SERVICE_DATA = "RR20F-179: Missing service data check"
+EQUAL_TOTALS = "RR20F-001OA: equal totals"
+CAPITAL_TOTALS = "RR20F-001C: equal totals for capital expenses by mode and funding source expenditures"
+GEN_PURPOSE_COLUMNS = ['Under 200 Vehicles', '200 to 300 Vehicles', 'Over 300 Vehicles']
+
+RULES = [
+    # RR-20 service data
+    {"check": "service_missing_data", "id": None, "form": "rr20_service", "input": "service_allyears",
+     "by": [], "agencies": "all", "requires": [],
+     "values": {"missing": {"agg": "any_null", "column": ['Annual_VRM', 'Annual_VRH', 'Annual_UPT', 'VOMX'], "year": None}},
+     "outcomes": [{"when": "missing", "status": "fail", "name": MISSING_SERVICE_DATA,
+                   "description": "One or more service data values is missing in these columns. Please revise in BlackCat and resubmit.'Annual VRM', 'Annual VRH', 'Annual UPT','Sponsored UPT', 'VOMX'"},
+                  {"status": "pass", "name": MISSING_SERVICE_DATA, "description": ""}],
+     "columns": {"mode": "", "value_checked": "Service data columns"}},
+    *[ratio_rule(variable, threshold) if check is rr20_service_check.rr20_ratios else single_number_rule(variable, threshold)
+      for variable, check, threshold in rr20_service_check.SERVICE_CHECKS],
+
+    # RR-20 financial data
+    *[financial_rule(variable) for variable in rr20_financials_check.FINANCIAL_VARIABLES],
+    {"check": "financials_equal_totals", "id": "RR20F-001OA", "form": "rr20_financials", "input": "financials_allyears",
+     "by": [], "agencies": "all", "requires": ["this_year"],
+     "values": {column: {"agg": "first", "column": column, "year": "this_year", "where": {"Operating_Capital": "Operating"}}
+                for column in ["Total_Annual_Revenues_Expended", "Total_Annual_Expenses_by_Mode"]},
+     "outcomes": [{"when": "round(Total_Annual_Revenues_Expended) != round(Total_Annual_Expenses_by_Mode)",
+                   "status": "fail", "name": EQUAL_TOTALS,
+                   "description": "Total_Annual_Revenues_Expended (${Total_Annual_Revenues_Expended}) should, but does not, equal Total_Annual_Expenses_by_Mode (${Total_Annual_Expenses_by_Mode}). Please provide a narrative justification."},
+                  {"status": "pass", "name": EQUAL_TOTALS, "description": ""}],
+     "columns": {"value_checked": "Total_Annual_Revenues_Expended = ${Total_Annual_Revenues_Expended},Total_Annual_Expenses_by_Mode = ${Total_Annual_Expenses_by_Mode}"}},
+    {"check": "financials_rr20f_001c", "id": "RR20F-001C", "form": "rr20_financials", "input": "financials_allyears",
+     "by": [], "agencies": "this_year", "requires": ["this_year"],
+     "values": {"sum_a": {"agg": "first", "column": "Total_Annual_Expenses_by_Mode", "year": "this_year",
+                          "where": {"Operating_Capital": "Capital"}},
+                "sum_b": {"agg": "first", "columns_from": "Other_Directly_Generated_Funds", "year": "this_year",
+                          "where": {"Operating_Capital": "Capital"}}},
+     "outcomes": [{"when": "round(sum_a) == round(sum_b)", "status": "pass", "name": CAPITAL_TOTALS, "description": ""},
+                  {"status": "fail", "name": CAPITAL_TOTALS,
+                   "description": "The sum of Total Expenses for all modes for Uses of Capital {sum_a} does not equal the sum of all values entered for Directly Generated, Non-Federal and Federal Government Funds {sum_b} for Uses of Capital. Please revise or explain."}],
+     "columns": {"value_checked": "Total_Annual_Expenses_by_Mode = {sum_a},by funding source = {sum_b}"}},
+
+    # A-10 facilities: four rows per agency
+    {"check": "a10_facilities", "id": None, "form": "a10", "input": "a10", "by": [], "agencies": "this_year", "requires": [],
+     "values": {"total_fac": {"agg": "sum", "column": "Total Facilities", "year": "this_year", "round": 0, "missing": 0}},
+     "outcomes": [{"when": "total_fac % 1 == 0", "status": "pass", "name": "Whole Number Facilities", "description": ""},
+                  {"status": "fail", "name": "Whole Number Facilities",
+                   "description": "The reported total facilities do not add up to a whole number. Please explain."}],
+     "columns": {"value_checked": "Total Facilities: {total_fac}"}},
+    {"check": "a10_facilities", "id": None, "form": "a10", "input": "a10", "by": [], "agencies": "this_year", "requires": [],
+     "values": {"total_fac": {"agg": "sum", "column": "Total Facilities", "year": "this_year", "round": 0, "missing": 0}},
+     "outcomes": [{"when": "total_fac != 0", "status": "pass", "name": "Non-zero Facilities", "description": ""},
+                  {"status": "fail", "name": "Non-zero Facilities", "description": "There are no reported facilities. Please explain."}],
+     "columns": {"value_checked": "Total Facilities: {total_fac}"}},
+    {"check": "a10_facilities", "id": None, "form": "a10", "input": "a10", "by": [], "agencies": "this_year", "requires": [],
+     "values": {"total_gen_fac": {"agg": "sum", "column": GEN_PURPOSE_COLUMNS, "year": "this_year", "round": 0}},
+     "outcomes": [{"when": "(round(total_gen_fac) <= 1) & (round(total_gen_fac) != 0)", "status": "pass",
+                   "name": "Gen Purpose Facilities", "description": ""},
+                  {"when": "round(total_gen_fac) > 1", "status": "fail", "name": "Multiple Gen Purpose Facilities",
+                   "description": "You reported > 1 general purpose facility. Please verify whether this is correct."},
+                  {"status": "fail", "name": "Non-zero Gen Purpose Facilities",
+                   "description": "You reported no general purpose facilities. Please verify whether this is correct."}],
+     "columns": {"value_checked": "Gen Purpose Facilities: {total_gen_fac}"}},
+    {"check": "a10_facilities", "id": None, "form": "a10", "input": "a10", "by": [], "agencies": "this_year",
+     "requires": ["this_year", "last_year"],
+     "values": {"total_gen_fac": {"agg": "sum", "column": GEN_PURPOSE_COLUMNS, "year": "this_year", "round": 0},
+                "last_yr_gen_fac": {"agg": "sum", "column": GEN_PURPOSE_COLUMNS, "year": "last_year", "round": 0}},
+     "outcomes": [{"when": "round(total_gen_fac) == round(last_yr_gen_fac)", "status": "pass",
+                   "name": "Comparison to last yr: Gen Purpose Facilities", "description": ""},
+                  {"status": "fail", "name": "Comparison to last yr: Gen Purpose Facilities",
+                   "description": "Num. of general purpose facilities differs that last year - please verify or clarify."}],
+     "columns": {"value_checked": "{total_gen_fac} in {this_year}, {last_yr_gen_fac} in {last_year} (Gen Purpose Facilities)"}},
+]
+
+# The check functions the rules replace, and the check each call is for (given its keyword arguments)
+CHECK_FUNCTIONS = {
+    rr20_service_check.check_missing_servicedata: "service_missing_data",
+    rr20_service_check.rr20_ratios: "service_{variable}",
+    rr20_service_check.check_single_number: "service_{variable}",
+    rr20_financials_check.financial_checks: "financials_{variable}",
+    rr20_financials_check.equal_totals: "financials_equal_totals",
+    rr20_financials_check.rr20f_001c: "financials_rr20f_001c",
+    a10_facilities_check.facility_checks: "a10_facilities",
+}
+
+
+def _validate(rule):
+    '''Raises ValueError if a rule is not in the format above.'''
+    for key in ["check", "form", "input", "by", "agencies", "requires", "values", "outcomes"]:
+        if key not in rule:
+            raise ValueError(f"Rule for {rule.get('check')} has no {key!r}")
+    if rule["form"] not in FORMS:
+        raise ValueError(f"Rule for {rule['check']}: unknown form {rule['form']!r}, expected one of {list(FORMS)}")
+    if rule["agencies"] not in ("all", "this_year") or not set(rule["requires"]) <= YEARS:
+        raise ValueError(f"Rule for {rule['check']}: agencies must be 'all' or 'this_year', and requires a list of {sorted(YEARS)}")
+    for name, value in rule["values"].items():
+        if value["agg"] not in AGGREGATIONS or value.get("year") not in YEARS | {None}:
+            raise ValueError(f"Rule for {rule['check']}: value {name} needs an agg in {sorted(AGGREGATIONS)} and a year in {sorted(YEARS)} or None")
+        if ("column" in value) == ("columns_from" in value):
+            raise ValueError(f"Rule for {rule['check']}: value {name} needs one of column or columns_from")
+    if not rule["outcomes"] or "when" in rule["outcomes"][-1]:
+        raise ValueError(f"Rule for {rule['check']}: the last outcome must have no 'when', so every row has one")
+
+
+def compile_rules(rules=None):
+    '''
+    Groups rules (default RULES) into batches, one per input table and grouping keys, each run in one pass by
+    run_batch(). Returns {batch name: {"input", "form", "by", "rules", "values"}}, where "values" are the distinct
+    values of the batch's rules, each computed once. A check's rules must all be in the same batch.
+    '''
+    batches = {}
+    batch_of_check = {}
+    for rule in RULES if rules is None else rules:
+        _validate(rule)
+        name = f"rules_{rule['input']}" + "".join(f"_by_{key.lower()}" for key in rule["by"])
+        if batch_of_check.setdefault(rule["check"], name) != name:
+            raise ValueError(f"The rules of {rule['check']} read different tables or have different grouping keys")
+        batch = batches.setdefault(name, {"input": rule["input"], "form": rule["form"], "by": list(rule["by"]),
+                                          "rules": [], "values": {}})
+        if batch["form"] != rule["form"]:
+            raise ValueError(f"The rules of {name} are for different forms")
+        batch["rules"].append(rule)
+        for value in rule["values"].values():
+            batch["values"].setdefault(_value_key(value), value)
+    for batch in batches.values():
+        for check in {rule["check"] for rule in batch["rules"]}:
+            agencies = {rule["agencies"] for rule in batch["rules"] if rule["check"] == check}
+            if len(agencies) > 1:
+                raise ValueError(f"The rules of {check} check different agencies")
+    return batches
+
+
+def _value_key(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def _round(values, decimals=None):
+    '''round() for columns: round(x) and round(x, decimals) of every value.'''
+    return np.round(values) if decimals is None else np.round(values, decimals)
+
+
+def _numpy(series):
+    '''The values of a series as a NumPy array, keeping the dtype of nullable integers that have no missing values.'''
+    if isinstance(series.dtype, pd.api.extensions.ExtensionDtype) and hasattr(series.dtype, "numpy_dtype") \
+            and not series.isna().any():
+        return series.to_numpy(dtype=series.dtype.numpy_dtype)
+    return series.to_numpy()
+
+
+def _group_sums(values, groups, n_groups):
+    '''The sum of values per group (0 for groups without values), adding each group's values in row order.'''
+    order = np.argsort(groups, kind="stable")
+    groups = groups[order]
+    starts = np.flatnonzero(np.diff(groups, prepend=-1))
+    sums = np.zeros(n_groups, dtype=np.result_type(values.dtype, np.int64))
+    if len(starts):
+        # reduceat adds each group's values the way Series.sum() does, so the sums are the same to the last bit
+        sums[groups[starts]] = np.add.reduceat(values[order], starts)
+    return sums
+
+
+def _row_sums(frame, first_column):
+    '''The sum of each row's numeric columns from first_column on, as DataFrame.sum(numeric_only=True, axis=1) gives it.'''
+    columns = frame.iloc[:, frame.columns.get_loc(first_column):].select_dtypes(include=["number", "bool"])
+    values = np.ascontiguousarray(columns.to_numpy())
+    if values.dtype.kind == "f":
+        values = np.where(np.isnan(values), 0, values)
+    return values.sum(axis=1)
+
+
+def _aggregate(df, value, groups, n_groups, years):
+    '''
+    One value per group (of every row's group in groups), and whether the group has rows to compute it from.
+    The values keep their dtype, so they print as the loop code's values do.
+    '''
+    keep = groups >= 0
+    if value.get("year") is not None:
+        keep &= years[value["year"]]
+    for column, expected in value.get("where", {}).items():
+        keep &= (df[column] == expected).to_numpy()
+    rows = np.flatnonzero(keep)
+    row_groups = groups[rows]
+    present = np.bincount(row_groups, minlength=n_groups) > 0
+    columns = value.get("column")
+    columns = columns if isinstance(columns, list) or columns is None else [columns]
+
+    if value["agg"] == "any_null":
+        nulls = df[columns].iloc[rows].isna().any(axis=1).to_numpy()
+        return np.bincount(row_groups, weights=nulls, minlength=n_groups) > 0, present
+    if value["agg"] == "first":
+        firsts, positions = np.unique(row_groups, return_index=True)
+        if columns is None:
+            picked = _row_sums(df.iloc[rows[positions]], value["columns_from"])
+        else:
+            picked = _numpy(df[columns[0]].iloc[rows[positions]])
+        # Groups without rows get 0 (or NaN), which a rule only sees as its "missing" value
+        result = np.zeros(n_groups, dtype=picked.dtype) if picked.dtype.kind in "iub" else np.full(n_groups, np.nan)
+        result[firsts] = picked
+        return result, present
+
+    # sum or sum_unique: the column sums are added up, as frame[columns].sum().sum() does
+    total = None
+    for column in columns:
+        values = _numpy(df[column].iloc[rows])
+        if values.dtype.kind == "f":
+            values = np.where(np.isnan(values), 0, values)
+        keep_rows = np.ones(len(rows), dtype=bool)
+        if value["agg"] == "sum_unique":
+            keep_rows = ~pd.DataFrame({"group": row_groups, "value": values}).duplicated().to_numpy()
+        sums = _group_sums(values[keep_rows], row_groups[keep_rows], n_groups)
+        total = sums if total is None else total + sums
+    return total, present
+
+
+def _as_display(values, rounding, present, missing):
+    '''The values as the loop code formats them: rounded as round() rounds, and missing values as the literal default.'''
+    if rounding == 0:
+        shown = [int(x) for x in values.tolist()] if values.dtype.kind == "f" else values.tolist()
+    else:
+        shown = values.tolist()
+    if missing is not None:
+        shown = [x if has_rows else missing for x, has_rows in zip(shown, present)]
+    return shown
+
+
+def _evaluate(expression, names):
+    with np.errstate(all="ignore"):
+        return eval(expression, {"__builtins__": {}, "abs": abs, "round": _round}, names)
+
+
+def run_batch(df, batch, this_year=None, last_year=None, logger=None):
+    '''
+    Runs the rules of one batch of compile_rules() on its input table df. Returns {check: results}, with each check's
+    results as its check function returns them.
+    '''
+    form = FORMS[batch["form"]]
+    org_codes, orgs = pd.factorize(df[form["org"]], sort=False)
+    n_orgs = len(orgs)
+    year = df[form["year"]].to_numpy()
+    years = {"this_year": year == this_year, "last_year": year == last_year}
+    org_has_year = {name: np.bincount(org_codes[rows & (org_codes >= 0)], minlength=n_orgs) > 0
+                    for name, rows in years.items()}
+
+    # Groups: organizations, or organizations and the values of the grouping keys. Groups are numbered per row
+    # in one pass, and only groups with rows this year are checked.
+    if batch["by"]:
+        combined = org_codes.astype(np.int64)
+        valid = org_codes >= 0
+        for key in batch["by"]:
+            codes, uniques = pd.factorize(df[key], sort=False)
+            combined = combined * (len(uniques) + 1) + codes
+            valid &= codes >= 0
+        groups, uniques = pd.factorize(np.where(valid, combined, -1), sort=False)
+        groups = np.where(valid, groups, -1)
+        n_groups = len(uniques)
+        group_org = np.full(n_groups, -1)
+        group_org[groups[valid]] = org_codes[valid]
+        first_rows = np.full(n_groups, len(df))
+        this_rows = np.flatnonzero(years["this_year"] & valid)
+        checked, positions = np.unique(groups[this_rows], return_index=True)
+        first_rows[checked] = this_rows[positions]
+        has_group = first_rows < len(df)
+        key_values = {key: df[key].to_numpy(dtype=object)[np.where(has_group, first_rows, 0)] for key in batch["by"]}
+    else:
+        groups, n_groups = org_codes, n_orgs
+        group_org = np.arange(n_orgs)
+        first_rows = np.zeros(n_orgs, dtype=int)
+        key_values = {}
+        has_group = np.ones(n_orgs, dtype=bool)
+
+    # Every value of the batch, for every group, in one pass over the table
+    computed = {key: _aggregate(df, value, groups, n_groups, years) for key, value in batch["values"].items()}
+
+    # Organizations are checked in order of first appearance in the table, or in this year's rows
+    this_orgs = org_codes[years["this_year"] & (org_codes >= 0)]
+    first_this = np.full(n_orgs, n_orgs + len(df))
+    unique_this, positions = np.unique(this_orgs, return_index=True)
+    first_this[unique_this] = positions
+    org_rank = {"all": np.arange(n_orgs), "this_year": first_this}
+
+    output = {}
+    counts = {}
+    for index, rule in enumerate(batch["rules"]):
+        selected = has_group & (group_org >= 0)
+        if rule["agencies"] == "this_year":
+            selected &= org_has_year["this_year"][np.maximum(group_org, 0)]
+        for required in rule["requires"]:
+            selected &= org_has_year[required][np.maximum(group_org, 0)]
+        chosen = np.flatnonzero(selected)
+        chosen = chosen[np.lexsort((first_rows[chosen], org_rank[rule["agencies"]][group_org[chosen]]))]
+
+        names = {"this_year": this_year, "last_year": last_year, "threshold": rule.get("threshold")}
+        shown = dict(names)
+        for name, value in rule["values"].items():
+            values, present = computed[_value_key(value)]
+            values, present = values[chosen], present[chosen]
+            if value.get("round") is not None:
+                values = _round(values, value["round"] or None)
+            if value.get("missing") is not None:
+                values = np.where(present, values, value["missing"])
+            names[name] = values
+            shown[name] = _as_display(values, value.get("round"), present, value.get("missing"))
+        for name, expression in rule.get("fields", {}).items():
+            names[name] = shown[name] = _evaluate(expression, names)
+            if isinstance(shown[name], np.ndarray):
+                shown[name] = shown[name].tolist()
+        for key in batch["by"]:
+            shown[key] = key_values[key][chosen].tolist()
+
+        conditions = [np.broadcast_to(_evaluate(outcome["when"], names), len(chosen)).astype(bool)
+                      for outcome in rule["outcomes"][:-1]]
+        picked = np.select(conditions, np.arange(len(conditions)), default=len(conditions))
+        # Only the text is made row by row, from the values as the loop code formats them
+        per_row = [{name: values[i] if isinstance(values, list) else values for name, values in shown.items()}
+                   for i in range(len(chosen))]
+        columns = {"Organization": orgs.take(group_org[chosen]).tolist()}
+        for column in form["columns"][1:]:
+            if column in OUTCOME_COLUMNS:
+                field = OUTCOME_COLUMNS[column]
+                columns[column] = [rule["outcomes"][o][field].format(**row) for o, row in zip(picked, per_row)]
+            else:
+                columns[column] = [rule["columns"][column].format(**row) for row in per_row]
+        check = output.setdefault(rule["check"], {"rows": [], "sort": []})
+        check["rows"].append(pd.DataFrame(columns, columns=form["columns"]))
+        check["sort"].append(np.stack([org_rank[rule["agencies"]][group_org[chosen]], first_rows[chosen],
+                                       np.full(len(chosen), index)]))
+        counts[rule["check"]] = (rule.get("id"), n_orgs if rule["agencies"] == "all" else len(unique_this))
+
+    results = {}
+    for check, parts in output.items():
+        rows = pd.concat(parts["rows"], ignore_index=True)
+        org_order, group_order, rule_order = np.concatenate(parts["sort"], axis=1)
+        rows = rows.iloc[np.lexsort((rule_order, group_order, org_order))]
+        results[check] = check_results.results_frame(rows.to_dict("list") if len(rows) else
+                                                     check_results.new_results(*form["columns"]))
+        check_id, agencies = counts[check]
+        if check_id is not None and logger is not None:
+            validation_logging.log_check_summary(logger, check_id, results[check], agencies)
+    return results
+
+
+def check_table(results, check):
+    '''One check's results from the results of run_batch().'''
+    return results[check]
+
+
+def rules_graph(graph, rules=None):
+    '''
+    Replaces the check stages of a validate.py graph that have rules (default RULES) with one stage per batch of
+    compile_rules(), which runs them on its input in one pass, and a stage per check that takes its results from it.
+    Returns the graph.
+    '''
+    for name, batch in compile_rules(rules).items():
+        checks = list(dict.fromkeys(rule["check"] for rule in batch["rules"]))
+        stages = [graph[check] for check in checks if check in graph and graph[check]["kind"] == "check"]
+        if len(stages) < len(checks) or batch["input"] not in graph:
+            continue
+        kwargs = {arg: value for stage in stages for arg, value in stage["kwargs"].items()
+                  if arg in ("this_year", "last_year", "logger")}
+        if "this_year" in kwargs:
+            kwargs.setdefault("last_year", kwargs["this_year"] - 1)
+        graph[name] = {"func": run_batch, "kind": "check", "inputs": {"df": batch["input"]},
+                       "kwargs": {"batch": batch, **kwargs}}
+        for check in checks:
+            graph[check] = {"func": check_table, "kind": "derive", "inputs": {"results": name}, "kwargs": {"check": check}}
+    return graph
+
+
+def _run_check(check, batches, df, this_year=None, last_year=None, logger=None, **kwargs):
+    check = check.format(**kwargs)
+    batch = next(batch for batch in batches.values() if any(rule["check"] == check for rule in batch["rules"]))
+    batch = {**batch, "rules": [rule for rule in batch["rules"] if rule["check"] == check]}
+    if last_year is None and this_year is not None:
+        last_year = this_year - 1
+    return run_batch(df, batch, this_year, last_year, logger)[check]
+
+
+def as_candidate(rules=None):
+    '''
+    The rules as a candidate engine for equivalence.py: functions with the names and arguments of the check functions
+    they replace, each running the rules of the check it is called for.
+    '''
+    batches = compile_rules(rules)
+    return SimpleNamespace(**{func.__name__: functools.partial(_run_check, check, batches)
+                              for func, check in CHECK_FUNCTIONS.items()})
@@ -0,0 +1,344 @@
+from types import SimpleNamespace
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import functools
+import json
+import os
+import re
+
+import instrumentation
+
+'''Shared data loaders for the validation checks.
+The check scripts (rr20_service_check.py, rr20_financials_check.py, voms_inventory_check.py, a10_facilities_check.py)
+and the combined run in validate.py all load their inputs through these functions, so every
+BigQuery table and input file is read the same way no matter which entry point is used.
+
+Every loader sets the dtypes in COLUMN_DTYPES on the table it returns (see apply_dtypes()): organization names, modes
+and other keys with few distinct values become categoricals, so each row holds a small integer code instead of a
+python string, and comparing a column to one agency, or joining tables on it, compares integers. Fiscal_Year becomes
+a 2-byte integer. The memory this saves is counted in each load stage's metrics ("bytes_saved").
+Tables that are joined or concatenated should first be given the same categories with share_categories().
+A LocalBigQueryClient answers the same queries from a local folder of Parquet files, for runs with --data_dir.
+Tables are joined with join_tables(), which plans a chain of inner joins on the tables' key codes and only copies
+each table's columns once, into the joined table, instead of making a wide table after every join.
+
+Prepared input tables can also be saved as snapshots: Arrow IPC (Feather v2) files in a snapshot folder, listed by name
+in the folder's registry.json. Worker processes read them with read_snapshot(), which memory-maps the file read-only,
+so every worker shares the same copy of the data instead of receiving its own.
+'''
+
+BQ_RAW_DATASET = "cal-itp-data-infra.blackcat_raw"
+SNAPSHOT_REGISTRY = "registry.json"
+
+# Dtypes set on load, by BigQuery-safe column name (so the Excel extracts, with spaces in their names, get them too).
+# Measures are left as loaded: float64, or Int64 for BigQuery integer columns, which both hold missing values already.
+COLUMN_DTYPES = {
+    "Organization_Legal_Name": "category",
+    "Organization": "category",
+    "Common_Name_Acronym_DBA": "category",
+    "Mode": "category",
+    "Operating_Capital": "category",
+    "Status": "category",
+    "Ownership_Type": "category",
+    "Fiscal_Year": "int16",
+}
+
+# The A-10 extracts in data/ use the column names from notebooks/schemas/facilities_a10_schema.py.
+# facility_checks() expects the names as they appear on the NTD form.
+A10_COLUMN_NAMES = {
+    "Under200Vehicles": "Under 200 Vehicles",
+    "200to300Vehicles": "200 to 300 Vehicles",
+    "Over300Vehicles": "Over 300 Vehicles",
+    "HeavyMaintenanceFacilities": "Heavy Maintenance Facilities",
+    "TotalFacilities": "Total Facilities",
+}
+
+
+def make_name_bq_safe(name):
+    '''Column name as it is loaded into BigQuery (see data_to_BQ.py and check_raw_data.py).'''
+    name = name.replace(" ", "_").replace("/", "_").replace(".", "_").replace("-", "").replace("#", "num")
+    return re.sub(r"\W+", "", name)
+
+
+def apply_dtypes(df):
+    '''
+    Returns df with the COLUMN_DTYPES of its columns, and counts the memory saved towards the running stage.
+    Only text columns are made categorical, and only whole-number years with no missing values are made int16.
+    '''
+    dtypes = {}
+    for column in df.columns:
+        dtype = COLUMN_DTYPES.get(make_name_bq_safe(str(column)))
+        if dtype == "category" and df[column].dtype == object:
+            dtypes[column] = dtype
+        elif (dtype == "int16" and pd.api.types.is_integer_dtype(df[column].dtype) and df[column].notna().all()
+              and df[column].between(-2**15, 2**15 - 1).all()):
+            dtypes[column] = dtype
+    if not dtypes:
+        return df
+    before = df[list(dtypes)].memory_usage(index=False, deep=True).sum()
+    df = df.astype(dtypes)
+    instrumentation.add_count("bytes_saved", int(before - df[list(dtypes)].memory_usage(index=False, deep=True).sum()))
+    return df
+
+
+def share_categories(frames, *column_groups):
+    '''
+    Gives the categorical columns in each group of columns the same categories (the sorted union of their categories)
+    in every frame that has them, and returns the frames. Joins and concatenations on those columns then compare
+    integer codes, and keep them categorical. Columns that are joined to each other under different names go in one group:
+        rr20_service, orgs = share_categories([rr20_service, orgs], ["Organization_Legal_Name", "Organization"])
+    '''
+    frames = list(frames)
+    for columns in column_groups:
+        parts = [(i, column) for i, frame in enumerate(frames) for column in columns
+                 if column in frame.columns and isinstance(frame[column].dtype, pd.CategoricalDtype)]
+        if len(parts) < 2:
+            continue
+        categories = functools.reduce(lambda a, b: a.union(b), [frames[i][column].cat.categories for i, column in parts])
+        for i, column in parts:
+            if not frames[i][column].cat.categories.equals(categories):
+                frames[i] = frames[i].assign(**{column: frames[i][column].cat.set_categories(categories)})
+    return frames
+
+
+def group_codes(df, columns):
+    '''
+    The columns of df as keys for groupby(): categoricals as their integer codes, other columns as they are.
+    Missing values get the code after the last category, so with categories in sorted order (as apply_dtypes() and
+    share_categories() make them) the groups come out in the same order as when grouping on the values with dropna=False.
+    '''
+    keys = []
+    for column in columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes.to_numpy()
+            values = pd.Series(np.where(codes == -1, len(values.cat.categories), codes), index=df.index, name=column)
+        keys.append(values)
+    return keys
+
+
+def key_codes(table, keys):
+    '''
+    The key columns of a table as integer codes (categoricals by their codes, see group_codes()), for join_rows().
+    Missing values get a code of their own, so they match each other, as they do in merge().
+    '''
+    return pd.DataFrame({f"key_{i}": np.asarray(codes) for i, codes in enumerate(group_codes(table, keys))})
+
+
+def join_rows(left_keys, right_keys):
+    '''
+    The rows of left_keys and right_keys (made by key_codes(), with the keys in the same order) that an inner join
+    matches, as two arrays of row numbers, in the order merge() returns the rows.
+    '''
+    matched = (left_keys.assign(left_row=np.arange(len(left_keys)))
+               .merge(right_keys.assign(right_row=np.arange(len(right_keys))), on=list(left_keys.columns)))
+    return matched["left_row"].to_numpy(), matched["right_row"].to_numpy()
+
+
+def join_tables(tables, joins, coalesce=(), sort_before=None, columns=None):
+    '''
+    Inner-joins tables ({name: table}; the first one is the base) in one planned pass. Each join only matches the
+    key codes of the rows joined so far to the next table's (see join_rows()), and keeps the row numbers of each table;
+    the columns of every table are copied once, into the joined table, at the end. The result has the same rows and
+    columns, in the same order, as a chain of merge(how="inner") calls. The categorical keys of all the tables must have
+    the same categories (see share_categories()).
+    joins: [(table, columns joined on, the table's columns they match (None: the same names),
+             the table's columns to add (None: all its other columns))], in join order.
+    coalesce: columns of more than one table that are not joined on. The first table's value is kept, or the next one's
+    (in join order) where it is missing.
+    sort_before: (table, column) to sort the rows by, before that table is joined.
+    columns: the columns to return (default: all of them).
+    '''
+    base = next(iter(tables))
+    rows = {base: np.arange(len(tables[base]))}
+    sources = {column: [(base, column)] for column in tables[base].columns} # joined column: [(table, column)]
+    for table, keys, table_keys, table_columns in joins:
+        if sort_before is not None and sort_before[0] == table:
+            source, column = sources[sort_before[1]][0]
+            order = tables[source][column].take(rows[source]).reset_index(drop=True).sort_values().index.to_numpy()
+            rows = {name: table_rows[order] for name, table_rows in rows.items()}
+        left_keys = pd.DataFrame({f"key_{i}": np.asarray(group_codes(tables[source], [column])[0])[rows[source]]
+                                  for i, (source, column) in enumerate(sources[key][0] for key in keys)})
+        left_rows, right_rows = join_rows(left_keys, key_codes(tables[table], table_keys or keys))
+        rows = {name: table_rows[left_rows] for name, table_rows in rows.items()}
+        rows[table] = right_rows
+        if table_columns is None:
+            table_columns = [column for column in tables[table].columns if column not in (table_keys or keys)]
+        for column in table_columns:
+            joined_column = column
+            if column in sources and column not in coalesce: # both kept, with suffixes, as merge() does
+                sources = {f"{name}_x" if name == column else name: source for name, source in sources.items()}
+                joined_column = f"{column}_y"
+            sources.setdefault(joined_column, []).append((table, column))
+
+    joined = {}
+    for joined_column, column_sources in sources.items():
+        values = [tables[source][column].take(rows[source]).reset_index(drop=True) for source, column in column_sources]
+        joined[joined_column] = functools.reduce(lambda first, then: first.combine_first(then), values)
+    joined = pd.DataFrame(joined)
+    return joined[columns] if columns is not None else joined
+
+
+def run_query(client, query):
+    '''Runs a query and returns the result as a dataframe, counting the bytes BigQuery read towards the running stage.'''
+    job = client.query(query)
+    df = job.to_dataframe()
+    instrumentation.add_count("bytes_read", getattr(job, "total_bytes_processed", None) or 0)
+    return df
+
+
+def _size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+
+class LocalBigQueryClient:
+    '''
+    Stands in for bigquery.Client() in the queries made by this file and partitioned_tables.py, serving the tables in
+    a local folder of {table}.parquet files (e.g. written by synthetic_data.py) and of partitioned tables (see
+    partitioned_tables.py --data_dir). Each query reads the table's parquet file, so load stages still read from disk.
+    '''
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+    def query(self, query):
+        tablename = re.search(r"`[\w-]+\.\w+\.(\w+)`", query).group(1)
+        path = os.path.join(self.data_dir, f"{tablename}.parquet")
+        if os.path.isdir(os.path.join(self.data_dir, tablename)):
+            # A year-partitioned table (see partitioned_tables.py): only the years in the query are read
+            path = os.path.join(self.data_dir, tablename)
+            years = re.search(r"(\w+) IN \(([\d, ]+)\)", query)
+            filters = [(years.group(1), "in", [int(year) for year in years.group(2).split(",")])] if years else None
+            df = pd.read_parquet(path, filters=filters)
+            if years: # read back as a categorical
+                df[years.group(1)] = df[years.group(1)].astype("int64")
+        else:
+            df = pd.read_parquet(path)
+
+        # The latest submission per org (and year), as in data_sources.get_bq_data(); rows without a date come last
+        latest = re.search(r"PARTITION BY ([\w, ]+) ORDER BY date_uploaded DESC", query)
+        if latest:
+            df["rank_date"] = (df.groupby([column.strip() for column in latest.group(1).split(",")])["date_uploaded"]
+                               .rank(method="min", ascending=False, na_option="bottom").astype("int64"))
+            df = df[df["rank_date"] == 1].reset_index(drop=True)
+        # The rows and latest upload of each year (see partitioned_tables.year_versions_sql())
+        summary = re.search(r"COUNT\(\*\) AS (\w+), MAX\((\w+)\) AS (\w+).*GROUP BY (\w+)", query, re.S)
+        if summary:
+            count, column, latest, key = summary.groups()
+            df = (df.groupby(key, observed=True).agg(**{count: (column, "size"), latest: (column, "max")})
+                  .reset_index())
+        return SimpleNamespace(to_dataframe=lambda: df, total_bytes_processed=_size(path))
+
+
+def get_bq_data(client, year, tablename, org_col="Organization_Legal_Name"):
+    '''
+    For each org, get the rows with the latest date_uploaded, which is their latest submitted report.
+    '''
+    bq_data_query = f"""SELECT * FROM
+          (select *,
+          RANK() OVER(PARTITION BY {org_col} ORDER BY date_uploaded DESC) rank_date
+        from `{BQ_RAW_DATASET}.{year}_{tablename}`) s
+        WHERE rank_date = 1;
+        """
+
+    df = run_query(client, bq_data_query)
+    df = df.drop_duplicates().drop(['rank_date', 'date_uploaded'], axis=1)
+    return apply_dtypes(df)
+
+
+def get_bq_table(client, year, tablename):
+    '''
+    Get a whole table. Used for tables that were only uploaded once (e.g., 2022 data, which has
+    a slightly different schema and no date_uploaded column) or that are not per-submission.
+    '''
+    bq_data_query = f"""SELECT * FROM `{BQ_RAW_DATASET}.{year}_{tablename}`"""
+    df = run_query(client, bq_data_query).drop_duplicates()
+    return apply_dtypes(df)
+
+
+def get_orgs(client):
+    '''List of subrecipients submitting to NTD.'''
+    orgs_q = f"""SELECT * FROM `{BQ_RAW_DATASET}.2023_organizations`"""
+    orgs = run_query(client, orgs_q).drop_duplicates().drop(['date_uploaded'], axis=1)
+    return apply_dtypes(orgs)
+
+
+def load_excel_data(filename, sheetname):
+    instrumentation.add_file_read(filename)
+    df = pd.read_excel(filename, sheet_name=sheetname,
+                            index_col=None)
+    return apply_dtypes(df)
+
+
+def load_a10_data(this_year_file, last_year_file):
+    '''
+    Loads this year's and last year's A-10 extracts into one table, with a "year" column,
+    so facility_checks() can compare to the prior year.
+    '''
+    instrumentation.add_file_read(this_year_file)
+    instrumentation.add_file_read(last_year_file)
+    df = pd.read_csv(this_year_file, index_col = 0)
+    df_lastyr = pd.read_csv(last_year_file, index_col = 0)
+    allyears = pd.concat([df, df_lastyr], ignore_index = True)
+    allyears = allyears.rename(columns=A10_COLUMN_NAMES)
+    return allyears
+
+
+def get_snapshot_registry(snapshot_dir):
+    '''Returns {snapshot name: {"path", "rows", "bytes"}} for the snapshots in a folder.'''
+    registry_file = os.path.join(snapshot_dir, SNAPSHOT_REGISTRY)
+    if not os.path.exists(registry_file):
+        return {}
+    with open(registry_file) as f:
+        return json.load(f)
+
+
+def _save_snapshot_registry(snapshot_dir, registry):
+    # Write to a temporary file and swap it in, so a reader never sees a half-written registry.
+    registry_file = os.path.join(snapshot_dir, SNAPSHOT_REGISTRY)
+    with open(f"{registry_file}.tmp", "w") as f:
+        json.dump(registry, f, indent=2)
+    os.replace(f"{registry_file}.tmp", registry_file)
+
+
+def write_snapshot(snapshot_dir, name, df):
+    '''
+    Writes a dataframe once as an uncompressed Arrow IPC file (so it can be memory-mapped) and registers it by name.
+    Only the main process writes snapshots.
+    '''
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = os.path.join(snapshot_dir, f"{name}.arrow")
+    table = pa.Table.from_pandas(df)
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    registry = get_snapshot_registry(snapshot_dir)
+    registry[name] = {"path": path, "rows": len(df), "bytes": os.path.getsize(path)}
+    _save_snapshot_registry(snapshot_dir, registry)
+    return path
+
+
+def read_snapshot(snapshot_dir, name):
+    '''
+    Looks up a snapshot by name and reads it through a read-only memory map. Numeric columns without nulls
+    point straight into the mapped file; only text columns are decoded into this process.
+    '''
+    registry = get_snapshot_registry(snapshot_dir)
+    if name not in registry:
+        raise KeyError(f"No snapshot called {name} in {snapshot_dir}")
+    source = pa.memory_map(registry[name]["path"], "r")
+    instrumentation.add_count("bytes_read", registry[name]["bytes"])
+    table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True)
+
+
+def remove_snapshot(snapshot_dir, name):
+    registry = get_snapshot_registry(snapshot_dir)
+    entry = registry.pop(name, None)
+    if entry is not None:
+        os.remove(entry["path"])
+        _save_snapshot_registry(snapshot_dir, registry)
@@ -2,7 +2,8 @@ from argparse import ArgumentParser
 from google.cloud import bigquery, storage
 import pandas as pd
 import datetime
-import logging
+
+import validation_logging
 
 '''
 One-time load of various files from Google Could storage into Big Query. This will not be automated as we only need to do it once.
@@ -28,27 +29,6 @@ def get_arguments():
     args = parser.parse_args()
     return args
 
-def write_to_log(logfilename):
-    '''
-    Creates a logger object that outputs to a log file, to the filename specified,
-    and also streams to console.
-    '''
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter(f'%(asctime)s:%(levelname)s: %(message)s',
-                                  datefmt='%y-%m-%d %H:%M:%S')
-    file_handler = logging.FileHandler(logfilename)
-    file_handler.setFormatter(formatter)
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
-
-    if not logger.hasHandlers():
-        logger.addHandler(file_handler)
-        logger.addHandler(stream_handler)
-
-    return logger
-
-
 def load_excel_data(filepath, sheetname):
     df = pd.read_excel(f"{filepath}",
                         sheet_name=sheetname,
@@ -105,7 +85,7 @@ def load_new_table(dfdict, year, client, logger):
 
 def main():
     # Set up the logger object
-    logger = write_to_log('load_new_data_toBQ_log.log')
+    logger = validation_logging.write_to_log('load_new_data_toBQ_log.log')
 
     # load in the arguments
     args = get_arguments()
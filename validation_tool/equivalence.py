@@ -0,0 +1,291 @@
+from argparse import ArgumentParser
+from types import SimpleNamespace
+from graphlib import TopologicalSorter
+import pandas as pd
+import importlib
+import datetime
+import logging
+import tempfile
+import json
+import time
+import sys
+import os
+
+import check_rules
+import data_sources
+import sql_checks
+import synthetic_data
+import voms_inventory_check
+import a10_facilities_check
+import validate
+import validation_logging
+
+'''Checks that a faster version of the validation checks (a "candidate engine") gives the same results as the
+current checks, and how much faster it is.
+
+A candidate engine is a python module with functions of the same names and arguments as the current checks
+(rr20_ratios, check_single_number, financial_checks, facility_checks, vins_all_checks, ...). It only needs to have
+the functions it replaces; checks it does not have are listed as "not in candidate".
+--candidate sql compares the SQL versions of the threshold checks (see sql_checks.py), run with DuckDB on the
+synthetic data's files. Their timings include reading the files, which the current checks' do not.
+--candidate rules compares the checks written as rules (see check_rules.py), each run as its own batch.
+Every check is run with the current function and the candidate's on the same inputs. Both results are put in a
+canonical order (every value as text, rows sorted by every column), and any rows that are in one but not the other are
+reported as drift.
+
+Inputs come from two datasets:
+    * fixture: the extracts in data/ (A-30, revenue vehicle inventory and RR-20 2022 for the VOMS checks, and the
+      2021 and 2020 A-10 extracts). There are not two years of RR-20 extracts, so the RR-20 checks only run on
+      the synthetic data.
+    * synthetic: data from synthetic_data.py, at --scale, run through the same stages as validate.py.
+
+The outputs of the current checks can also be saved as "golden" files, and later compared with the current checks
+(to catch a change in results) or with a candidate, without running the old code.
+
+To run from command line, navigate to folder and type e.g.:
+    python equivalence.py --candidate fast_checks
+    python equivalence.py --candidate fast_checks --datasets synthetic --scale 10x --repeat 3 --min_speedup 2
+    python equivalence.py --candidate sql --datasets synthetic --min_speedup 0
+    python equivalence.py --candidate rules --datasets fixture synthetic --scale 10x
+    python equivalence.py --save_golden golden
+    python equivalence.py --golden golden
+It exits with an error if any check's results drifted, or (with --candidate) if the candidate was slower than
+--min_speedup times the current check, so it can be used as a pass/fail gate.
+'''
+
+DATASETS = ['fixture', 'synthetic']
+
+# Checks that take less than this many seconds with both engines are not timing-gated, as their timings are mostly noise.
+MIN_GATE_SECONDS = 0.05
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Compare validation check results between the current checks and a candidate engine")
+    parser.add_argument('--candidate', default=None, help="Module with the candidate check functions, sql for sql_checks.py or rules for check_rules.py")
+    parser.add_argument('--golden', default=None, help="Folder of saved golden outputs to compare against")
+    parser.add_argument('--save_golden', default=None, help="Folder to save the current checks' outputs to")
+    parser.add_argument('--datasets', nargs='+', choices=DATASETS, default=DATASETS)
+    parser.add_argument('--scale', choices=synthetic_data.SCALES, default="1x")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help="Time each check this many times and keep the fastest")
+    parser.add_argument('--min_speedup', type=float, default=0.9,
+                        help="Fail if a candidate check is not at least this many times as fast as the current one "
+                             "(the default allows for 10%% timing noise)")
+    parser.add_argument('--output', default=None, help="File to save the comparison to, as JSON")
+    args = parser.parse_args()
+    if not (args.candidate or args.golden or args.save_golden):
+        parser.error("give at least one of --candidate, --golden or --save_golden")
+    return args
+
+
+def fixture_graph():
+    '''Stages (in the format of validate.build_graph()) for the checks that can run on the extracts in data/.'''
+    graph = {}
+
+    def add(name, func, kind, inputs=None, **kwargs):
+        graph[name] = {"func": func, "kind": kind, "inputs": inputs or {}, "kwargs": kwargs}
+
+    add("inventory", data_sources.load_excel_data, "load",
+        filename="data/RevenueVehicles_9_2_2023.xlsx", sheetname="Revenue Vehicles")
+    add("a30", data_sources.load_excel_data, "load",
+        filename="data/A_30_Revenue_Vehicle_Report_9_1_2023.xlsx", sheetname="A-30 (Rural) RVI")
+    add("rr20_service", data_sources.load_excel_data, "load",
+        filename="data/NTD_Annual_Report_Rural_2022.xlsx", sheetname="Service Data")
+    add("a10", data_sources.load_a10_data, "load",
+        this_year_file="data/2021_a10_submitted_partialdata.csv", last_year_file="data/2020_a10_submitted_partialdata.csv")
+    add("a30_agencies", validate.get_agencies, "derive", inputs={"df": "a30"})
+
+    voms_inputs = {"a30_data": "a30", "a30_agencies": "a30_agencies", "inventory_data": "inventory"}
+    add("voms_vins_all", voms_inventory_check.vins_all_checks, "check", inputs=voms_inputs)
+    add("voms_vins_mismatched", voms_inventory_check.partial_vin_checklist, "check", inputs=voms_inputs)
+    add("voms_totals", voms_inventory_check.check_totals, "check", inputs={**voms_inputs, "rr20_data": "rr20_service"})
+    add("a10_facilities", a10_facilities_check.facility_checks, "check", inputs={"df": "a10"},
+        this_year=2021, last_year=2020)
+    return graph
+
+
+def synthetic_graph(data_dir, scale, seed, check_logger, this_year=2023):
+    '''Writes synthetic data at the given scale to data_dir, and returns the validate.py stages that read it.'''
+    data = synthetic_data.generate(scale, this_year, seed)
+    a10_files = synthetic_data.write_synthetic_data(data, data_dir)
+    run_args = validate.default_arguments(this_year, last_year=this_year - 1, output_dir=data_dir,
+                                          a10_data=a10_files[this_year], a10_lastyr_data=a10_files[this_year - 1],
+                                          a10_year=this_year)
+    return validate.build_graph(data_sources.LocalBigQueryClient(data_dir), run_args, check_logger)
+
+
+def get_check_inputs(graph):
+    '''Runs the load and derive stages, and returns {check stage: (func, inputs, kwargs)}.'''
+    results = {}
+    checks = {}
+    sorter = TopologicalSorter({name: set(stage["inputs"].values()) for name, stage in graph.items()})
+    for name in sorter.static_order():
+        stage = graph[name]
+        if stage["kind"] not in ("load", "derive", "check"):
+            continue
+        inputs = {arg: results[dependency] for arg, dependency in stage["inputs"].items()}
+        if stage["kind"] in ("load", "derive"):
+            results[name] = stage["func"](**inputs, **stage["kwargs"])
+        elif stage["kind"] == "check":
+            checks[name] = (stage["func"], inputs, stage["kwargs"])
+    return checks
+
+
+def time_check(func, inputs, kwargs, repeat):
+    '''Runs a check repeat times, each on its own copy of the inputs. Returns the result and the fastest time.'''
+    best = None
+    for i in range(repeat):
+        copies = {arg: value.copy() if isinstance(value, (pd.DataFrame, pd.Series)) else value
+                  for arg, value in inputs.items()}
+        start = time.perf_counter()
+        result = func(**copies, **kwargs)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return result, best
+
+
+def canonical(df):
+    '''Every value as text, rows sorted by every column, so results can be compared regardless of row order and dtype.'''
+    df = df.astype(str)
+    return df.sort_values(list(df.columns), kind="mergesort").reset_index(drop=True)
+
+
+def diff_results(expected, actual):
+    '''
+    Compares two canonical results. Rows are compared as a multiset over the columns they share, so a row
+    that appears twice in one and once in the other is reported once.
+    '''
+    shared = [c for c in expected.columns if c in actual.columns]
+    expected_rows = expected[shared].assign(_n=expected.groupby(shared, sort=False).cumcount())
+    actual_rows = actual[shared].assign(_n=actual.groupby(shared, sort=False).cumcount())
+    merged = expected_rows.merge(actual_rows, on=shared + ["_n"], how="outer", indicator=True)
+    return {"columns_missing": [c for c in expected.columns if c not in actual.columns],
+            "columns_extra": [c for c in actual.columns if c not in expected.columns],
+            "column_order_changed": shared != [c for c in actual.columns if c in expected.columns],
+            "rows_expected": len(expected),
+            "rows_actual": len(actual),
+            "rows_missing": merged[merged["_merge"] == "left_only"][shared],
+            "rows_extra": merged[merged["_merge"] == "right_only"][shared]}
+
+
+def has_drift(diff):
+    return bool(diff["columns_missing"] or diff["columns_extra"] or diff["column_order_changed"]
+                or len(diff["rows_missing"]) or len(diff["rows_extra"]))
+
+
+def golden_file(golden_dir, dataset, stage):
+    return os.path.join(golden_dir, dataset, f"{stage}.csv")
+
+
+def save_golden(golden_dir, dataset, stage, result):
+    os.makedirs(os.path.join(golden_dir, dataset), exist_ok=True)
+    result.to_csv(golden_file(golden_dir, dataset, stage), index=False)
+
+
+def load_golden(golden_dir, dataset, stage):
+    path = golden_file(golden_dir, dataset, stage)
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def compare_dataset(dataset, checks, args, candidate, logger):
+    '''
+    Runs every check with the current engine and/or the candidate, and compares the results. The expected results
+    are the golden outputs if --golden is given, otherwise the current checks'. Returns a row per check.
+    '''
+    rows = []
+    for stage, (func, inputs, kwargs) in checks.items():
+        row = {"dataset": dataset, "stage": stage, "check": func.__name__}
+        rows.append(row)
+        current = None
+        if args.save_golden or not (args.golden and candidate):
+            current, row["current_seconds"] = time_check(func, inputs, kwargs, args.repeat)
+            current = canonical(current)
+            if args.save_golden:
+                save_golden(args.save_golden, dataset, stage, current)
+
+        if candidate is not None:
+            if not hasattr(candidate, func.__name__):
+                row["status"] = "not in candidate"
+                continue
+            actual, row["candidate_seconds"] = time_check(getattr(candidate, func.__name__), inputs, kwargs, args.repeat)
+            actual = canonical(actual)
+        elif args.golden:
+            actual = current
+        else:
+            row["status"] = "saved"
+            continue
+
+        expected = load_golden(args.golden, dataset, stage) if args.golden else current
+        if expected is None:
+            row["status"] = "no golden output"
+            continue
+
+        diff = diff_results(expected, actual)
+        row.update({"rows_expected": diff["rows_expected"], "rows_actual": diff["rows_actual"],
+                    "rows_missing": len(diff["rows_missing"]), "rows_extra": len(diff["rows_extra"]),
+                    "columns_missing": diff["columns_missing"], "columns_extra": diff["columns_extra"],
+                    "column_order_changed": diff["column_order_changed"]})
+        row["status"] = "drift" if has_drift(diff) else "same"
+        if row["status"] == "drift":
+            logger.info(f"{dataset} {stage}: {'candidate' if candidate else 'current'} results differ from "
+                        f"{'golden' if args.golden else 'current'} results.\n"
+                        f"Missing rows:\n{diff['rows_missing'].head(10).to_string(index=False)}\n"
+                        f"Extra rows:\n{diff['rows_extra'].head(10).to_string(index=False)}")
+
+        if "candidate_seconds" in row and "current_seconds" in row:
+            row["speedup"] = round(row["current_seconds"] / max(row["candidate_seconds"], 1e-9), 2)
+            if (row["status"] == "same" and row["speedup"] < args.min_speedup
+                    and max(row["current_seconds"], row["candidate_seconds"]) >= MIN_GATE_SECONDS):
+                row["status"] = "too slow"
+    return rows
+
+
+def main():
+    logger = validation_logging.write_to_log('equivalence_log.log')
+    # The checks log a line per agency; keep that out of the timings.
+    check_logger = logging.getLogger("equivalence.checks")
+    check_logger.setLevel(logging.WARNING)
+    args = get_arguments()
+    candidate = None
+    if args.candidate == "rules":
+        candidate = check_rules.as_candidate()
+    elif args.candidate and args.candidate != "sql":
+        candidate = importlib.import_module(args.candidate)
+
+    rows = []
+    for dataset in args.datasets:
+        logger.info(f"Preparing {dataset} inputs")
+        if dataset == "fixture":
+            fixture_candidate = SimpleNamespace() if args.candidate == "sql" else candidate # no RR-20 checks
+            rows += compare_dataset(dataset, get_check_inputs(fixture_graph()), args, fixture_candidate, logger)
+        else:
+            with tempfile.TemporaryDirectory(prefix="equivalence_") as data_dir:
+                graph = synthetic_graph(data_dir, args.scale, args.seed, check_logger)
+                if args.candidate == "sql":
+                    candidate = sql_checks.as_candidate(sql_checks.local_engine(data_dir))
+                rows += compare_dataset(dataset, get_check_inputs(graph), args, candidate, logger)
+
+    summary = pd.DataFrame(rows)
+    columns = [c for c in ["dataset", "stage", "check", "status", "rows_expected", "rows_actual", "rows_missing",
+                           "rows_extra", "current_seconds", "candidate_seconds", "speedup"] if c in summary.columns]
+    counts = [c for c in columns if c.startswith("rows_")]
+    summary[counts] = summary[counts].astype("Int64")
+    logger.info(f"Comparison:\n{summary[columns].round(3).to_string(index=False)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"run": {"started": datetime.datetime.now().isoformat(timespec="seconds"),
+                               "candidate": args.candidate, "golden": args.golden, "scale": args.scale,
+                               "repeat": args.repeat, "min_speedup": args.min_speedup},
+                       "checks": json.loads(summary.to_json(orient="records"))}, f, indent=2)
+
+    failed = summary[summary["status"].isin(["drift", "too slow", "no golden output"])]
+    if len(failed) > 0:
+        logger.info(f"{len(failed)} check(s) failed: {', '.join(failed['dataset'] + '/' + failed['stage'])}")
+        sys.exit(1)
+    logger.info("All compared checks give the same results.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import logging
+import fsspec
+import pickle
+import json
+
+import check_cache
+import check_results
+import check_rules
+import instrumentation
+import validation_logging
+
+'''Incremental validation: each check is only re-run for the organizations whose inputs changed since the last run.
+Every check in validate.py looks at one agency at a time, and an agency's results only depend on that agency's rows,
+so the results for everyone else can be taken from the last run.
+Run it with:
+    python validate.py --state_dir gs://calitp-ntd-report-validation/validation_state_2023
+(add --full_run to re-check everyone; the state is still saved).
+
+For every input table of a check, a "_fingerprint" stage computes one number per organization: the sum of
+the hashes of the organization's rows (so it does not depend on row order). A resubmission loaded through
+check_raw_data.py changes that organization's fingerprint and nobody else's. The check stage then:
+- loads the check's state from the last run ({state_dir}/{check}.pkl): its fingerprints and results
+- re-runs the check on only the rows of organizations whose fingerprint changed, or that are new
+- keeps the last run's results for everyone else (and drops organizations that are no longer in the inputs)
+- saves the fingerprints and merged results for the next run.
+The whole check is run again if there is no state, or if the check's code (see check_cache.code_version()), its
+arguments, the columns of its inputs or the pandas version changed. Inputs without an organization on every row are
+always checked in full.
+The merged results have the same rows as a full run; rows are ordered by organization in the same way as a full run.
+'''
+
+ORG_COLUMNS = ["Organization_Legal_Name", "Organization", "Agency"] # in order of preference
+FINGERPRINT_SUFFIX = "_fingerprint"
+STATE_VERSION = 1 # bump to invalidate every saved state
+
+
+def org_column(data):
+    '''The organization column of a table, or None.'''
+    return next((column for column in ORG_COLUMNS if column in data.columns), None)
+
+
+def _orgs(data):
+    return data[org_column(data)] if isinstance(data, pd.DataFrame) else pd.Series(data)
+
+
+def fingerprint(data):
+    '''
+    One fingerprint per organization of a table (or of an array of organization names), as a series indexed by
+    organization. None if the table has no organization column or some rows have no organization.
+    '''
+    if isinstance(data, pd.DataFrame) and org_column(data) is None:
+        return None
+    orgs = _orgs(data)
+    if orgs.isna().any():
+        return None
+    row_hashes = pd.util.hash_pandas_object(data if isinstance(data, pd.DataFrame) else orgs, index=False).to_numpy()
+    codes, uniques = pd.factorize(orgs)
+    if len(codes) == 0:
+        return pd.Series([], dtype="uint64")
+    order = np.argsort(codes, kind="stable")
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    # uint64 sums wrap around, so the sum is exact and the same in any row order.
+    sums = np.add.reduceat(row_hashes[order], starts)
+    return pd.Series(sums, index=uniques[codes[order][starts]])
+
+
+def changed_orgs(old, new):
+    '''Organizations whose fingerprint differs between old and new ({input: fingerprints}), or that are in only one.'''
+    changed = set()
+    for arg in set(old) | set(new):
+        before = old.get(arg, pd.Series([], dtype="uint64")).to_dict()
+        after = new.get(arg, pd.Series([], dtype="uint64")).to_dict()
+        changed.update(org for org in before.keys() | after.keys() if before.get(org) != after.get(org))
+    return changed
+
+
+def only_orgs(data, orgs):
+    '''The rows of a table (or the names in an array) that belong to orgs.'''
+    keep = _orgs(data).isin(orgs).to_numpy()
+    return data[keep]
+
+
+def state_key(check_func, kwargs, inputs):
+    '''
+    Identifies what a check's saved results were computed with: the check function and its code (see
+    check_cache.code_version()), its arguments (other than the logger) and the columns of its input tables.
+    Results saved under another key are not reused.
+    '''
+    check_func = check_cache.original(check_func)
+    key = {"func": f"{check_func.__module__}.{check_func.__qualname__}",
+           "code": check_cache.code_version(check_func),
+           "kwargs": {arg: value for arg, value in kwargs.items() if arg != "logger"},
+           "columns": {arg: [f"{column}:{dtype}" for column, dtype in data.dtypes.items()]
+                       for arg, data in inputs.items() if isinstance(data, pd.DataFrame)},
+           "pandas": pd.__version__,
+           "version": STATE_VERSION}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def state_file(state_dir, check_name):
+    return f"{state_dir}/{check_name}.pkl"
+
+
+def load_state(state_dir, check_name):
+    '''The state a check saved in the last run, or None.'''
+    fs, path = fsspec.core.url_to_fs(state_file(state_dir, check_name))
+    if not fs.exists(path):
+        return None
+    with fs.open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_state(state_dir, check_name, state):
+    # Write to a temporary file and move it into place, so an interrupted run never leaves a half-written state.
+    fs, path = fsspec.core.url_to_fs(state_file(state_dir, check_name))
+    fs.makedirs(path.rsplit("/", 1)[0], exist_ok=True)
+    with fs.open(f"{path}.tmp", "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    fs.mv(f"{path}.tmp", path)
+
+
+def _order_by_org(results, org_order):
+    positions = pd.Categorical(results["Organization"], categories=org_order).codes
+    return results.iloc[np.argsort(positions, kind="stable")].reset_index(drop=True)
+
+
+def merge_results(cached, new, changed, org_order):
+    '''
+    The cached results of organizations that did not change, plus the new results, with the organizations in
+    org_order. Within an organization, rows keep the order the check returned them in.
+    '''
+    kept = cached[~cached["Organization"].isin(changed)]
+    merged = check_results.combine_results([kept, new], sort_by=None)
+    return _order_by_org(merged, org_order)
+
+
+def incremental_check(check_name, check_func, state_dir, full_run=False, **arguments):
+    '''
+    Runs check_func on the organizations whose inputs changed since the last run, and merges the results with
+    the saved results for everyone else (see above). arguments are the check's inputs, their fingerprints
+    (as {input}_fingerprint) and its other keyword arguments.
+    '''
+    logger = logging.getLogger(validation_logging.LOGGER_NAME)
+    fingerprints = {arg[:-len(FINGERPRINT_SUFFIX)]: arguments.pop(arg)
+                    for arg in list(arguments) if arg.endswith(FINGERPRINT_SUFFIX)}
+    inputs = {arg: arguments.pop(arg) for arg in fingerprints}
+    key = state_key(check_func, arguments, inputs)
+    all_orgs = pd.unique(np.concatenate([_orgs(data).to_numpy(dtype=object) for data in inputs.values()
+                                         if not isinstance(data, pd.DataFrame) or org_column(data) is not None]))
+
+    state = None if full_run else load_state(state_dir, check_name)
+    if state is None or state["key"] != key or any(fp is None for fp in fingerprints.values()):
+        results = check_func(**inputs, **arguments)
+        n_checked = len(all_orgs)
+    else:
+        changed = changed_orgs(state["fingerprints"], fingerprints)
+        n_checked = len(changed & set(all_orgs))
+        if changed:
+            new = check_func(**{arg: only_orgs(data, changed) for arg, data in inputs.items()}, **arguments)
+        else:
+            new = state["results"].iloc[:0]
+        # Checks return their results sorted by organization, except those that keep the order of their input.
+        cached = state["results"]
+        sorted_output = cached["Organization"].is_monotonic_increasing and new["Organization"].is_monotonic_increasing
+        results = merge_results(cached, new, changed, sorted(all_orgs) if sorted_output else all_orgs)
+
+    instrumentation.add_count("orgs_checked", n_checked)
+    instrumentation.add_count("orgs_reused", len(all_orgs) - n_checked)
+    logger.info(f"{check_name}: checked {n_checked} of {len(all_orgs)} organizations, reused the last run's results "
+                f"for {len(all_orgs) - n_checked}",
+                extra={"check": check_name, "orgs": len(all_orgs), "orgs_checked": n_checked})
+    if all(fp is not None for fp in fingerprints.values()):
+        save_state(state_dir, check_name, {"key": key, "fingerprints": fingerprints, "results": results})
+    return results
+
+
+def make_incremental(graph, state_dir, full_run=False):
+    '''
+    Turns every check stage of a validate.py graph into an incremental_check() stage, and adds a fingerprint stage
+    for each of their inputs. Returns the graph.
+    '''
+    for name, stage in list(graph.items()):
+        # Checks without input stages read their own data (e.g. the SQL checks of sql_checks.py), and the rule batches of
+        # check_rules.py return several checks' results at once, so they are always run in full
+        if (stage["kind"] != "check" or not stage["inputs"]
+                or check_cache.original(stage["func"]) is check_rules.run_batch):
+            continue
+        inputs = {}
+        for arg, dependency in stage["inputs"].items():
+            fingerprint_stage = f"{dependency}{FINGERPRINT_SUFFIX}"
+            if fingerprint_stage not in graph:
+                graph[fingerprint_stage] = {"func": fingerprint, "kind": "derive", "inputs": {"data": dependency},
+                                            "kwargs": {}}
+            inputs[arg] = dependency
+            inputs[f"{arg}{FINGERPRINT_SUFFIX}"] = fingerprint_stage
+        graph[name] = {**stage, "func": incremental_check, "inputs": inputs,
+                       "kwargs": {**stage["kwargs"], "check_name": name, "check_func": stage["func"],
+                                  "state_dir": state_dir, "full_run": full_run}}
+    return graph
@@ -0,0 +1,201 @@
+from contextlib import contextmanager
+import pandas as pd
+import numpy as np
+import contextvars
+import datetime
+import platform
+import cProfile
+import resource
+import json
+import time
+import sys
+import os
+
+'''Shared instrumentation for the validation scripts: how long each stage of a run takes, how many rows go in and out,
+how many bytes it reads and the peak memory (RSS) while it runs. Stages are "load", "merge", "derive", "check"
+and "write".
+
+A run's metrics are a dict, made with new_run(), that each stage adds a record to:
+    metrics = instrumentation.new_run("rr20_service_check")
+    rr20_service = instrumentation.timed_call(metrics, "rr20_service", "load", get_bq_data, client, 2023, "rr20_service_data")
+    with instrumentation.stage_timer(metrics, "ratios", "derive", rows_in=len(df)) as stage:
+        ...
+        stage["rows_out"] = len(result)
+    instrumentation.write_metrics(metrics, "rr20_service_metrics.json")
+Code that runs inside a stage can add to its counters with add_count() (e.g. the data loaders add the bytes they read),
+without being passed the stage.
+
+Peak RSS is per stage on Linux, where the peak can be reset at the start of each stage. Elsewhere it is the peak of
+the whole process so far.
+
+Every script also takes --profile cprofile|pyinstrument, which saves a profile of the whole run to --profile_file
+(a .prof file for cProfile, viewable with snakeviz or pstats; an .html file for pyinstrument, which must be installed).
+'''
+
+STAGE_KINDS = ['load', 'merge', 'derive', 'check', 'write']
+PROFILERS = ['cprofile', 'pyinstrument']
+
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+def add_arguments(parser, script_name):
+    '''Adds the --metrics_file, --profile and --profile_file options to a script's argument parser.'''
+    parser.add_argument('--metrics_file', default=f"{script_name}_metrics.json",
+                        help="File to write per-stage timings, row counts and memory to, as JSON")
+    parser.add_argument('--profile', choices=PROFILERS, default=None, help="Profile the whole run")
+    parser.add_argument('--profile_file', default=None,
+                        help=f"Where to save the profile (default: {script_name}.prof or {script_name}.html)")
+    return parser
+
+
+def new_run(name, **info):
+    '''Returns an empty metrics dict for a run, with information about the run and environment.'''
+    return {"run": {"name": name,
+                    "started": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "pandas": pd.__version__,
+                    "platform": platform.platform(),
+                    **info},
+            "stages": []}
+
+
+def _read_proc_status(field):
+    '''A memory size from /proc/self/status, in MB, or None if not on Linux.'''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets the process's peak RSS (VmHWM) on Linux.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    peak = _read_proc_status("VmHWM")
+    if peak is None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = round(maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    return peak
+
+
+def count_rows(*values):
+    '''Total rows in the dataframes, series and arrays (including categoricals) among values, including lists of them; other values are not counted.'''
+    rows = 0
+    for value in values:
+        if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray, pd.api.extensions.ExtensionArray)):
+            rows += len(value)
+        elif isinstance(value, (list, tuple)):
+            rows += count_rows(*value)
+    return rows
+
+
+@contextmanager
+def stage_timer(metrics, name, kind, rows_in=None):
+    '''
+    Times the code in the with block as one stage, and adds its record to metrics (if metrics is not None).
+    Yields the record, so the block can set "rows_out" or other counters.
+    '''
+    record = {"stage": name, "kind": kind, "seconds": None, "rows_in": rows_in, "rows_out": None,
+              "bytes_read": 0, "peak_rss_mb": None, "pid": os.getpid()}
+    token = _current_stage.set(record)
+    _reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        record["peak_rss_mb"] = peak_rss_mb()
+        _current_stage.reset(token)
+        if metrics is not None:
+            metrics["stages"].append(record)
+
+
+def timed_call(metrics, name, kind, func, *args, **kwargs):
+    '''Calls func as one stage, counting rows in its dataframe arguments and result. Returns the result.'''
+    with stage_timer(metrics, name, kind, rows_in=count_rows(*args, *kwargs.values())) as record:
+        result = func(*args, **kwargs)
+        record["rows_out"] = count_rows(result) if isinstance(result, (pd.DataFrame, pd.Series, np.ndarray)) else None
+    return result
+
+
+def add_count(counter, n):
+    '''Adds n to a counter of the stage that is running, if any.'''
+    record = _current_stage.get()
+    if record is not None and n:
+        record[counter] = (record.get(counter) or 0) + n
+
+
+def add_file_read(path):
+    '''Counts a local file's size towards the running stage's bytes_read. Remote (gs://) paths are not counted.'''
+    if os.path.exists(path):
+        add_count("bytes_read", os.path.getsize(path))
+
+
+def stages_table(metrics):
+    return pd.DataFrame(metrics["stages"]).astype({"rows_in": "Int64", "rows_out": "Int64"})
+
+
+def write_metrics(metrics, filename):
+    '''Adds run totals (overall, per kind of stage, the check cache's hit rate and memory saved on load) and writes the metrics as JSON.'''
+    stages = pd.DataFrame(metrics["stages"])
+    metrics["run"]["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+    # Each stage resets the peak, so the run's peak is the highest of any stage's (in any one process).
+    metrics["run"]["peak_rss_mb"] = max([peak_rss_mb()] + [s["peak_rss_mb"] for s in metrics["stages"]])
+    # Hit rate of memoized checks (see check_cache.py)
+    hits = sum(stage.get("cache_hits") or 0 for stage in metrics["stages"])
+    misses = sum(stage.get("cache_misses") or 0 for stage in metrics["stages"])
+    if hits or misses:
+        metrics["run"]["check_cache"] = {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3)}
+    # Memory saved by the dtypes set on load (see data_sources.apply_dtypes())
+    saved = sum(stage.get("bytes_saved") or 0 for stage in metrics["stages"])
+    if saved:
+        metrics["run"]["memory_saved_mb"] = round(saved / (1024 * 1024), 1)
+    if len(stages) > 0:
+        metrics["totals_by_kind"] = (stages.groupby("kind", sort=False)
+                                     .agg(stages=("stage", "count"), seconds=("seconds", "sum"),
+                                          bytes_read=("bytes_read", "sum"), peak_rss_mb=("peak_rss_mb", "max"))
+                                     .round(3).reset_index().to_dict(orient="records"))
+    with open(filename, "w") as f:
+        json.dump(metrics, f, indent=2, default=str)
+
+
+@contextmanager
+def profiled(profiler, filename=None, script_name="validation"):
+    '''Profiles the with block with cProfile or pyinstrument (or does nothing if profiler is None).'''
+    if profiler is None:
+        yield
+        return
+    if profiler == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(filename or f"{script_name}.prof")
+    elif profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError("--profile pyinstrument needs pyinstrument: pip install pyinstrument")
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(filename or f"{script_name}.html", "w") as f:
+                f.write(profile.output_html())
+    else:
+        raise ValueError(f"Unknown profiler {profiler}, choose from {PROFILERS}")
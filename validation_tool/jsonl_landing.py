@@ -0,0 +1,235 @@
+from argparse import ArgumentParser
+from google.cloud import bigquery
+import datetime
+import hashlib
+import fsspec
+import gzip
+import json
+
+import blackcat_api
+import data_sources
+import instrumentation
+import results_sink
+import validation_logging
+
+'''Lands extracted records (from the BlackCat API, Airtable or any other source) as gzipped newline-delimited JSON,
+the raw format of notebooks/ETL_airtable_to_gcs_annotated.ipynb, ready to be loaded into BigQuery.
+The notebook makes a dataframe of the whole extract and compresses it in one go. Here records are written as they come:
+- each record's keys are made BigQuery-safe with data_sources.make_name_bq_safe() (nested objects too), and nulls in
+  arrays, which BigQuery does not allow, are replaced with -1 or "" (process_arrays_for_nulls(), as in the notebook)
+- records are compressed into the current chunk as they are written; once a chunk holds --max_chunk_mb of JSON it is
+  closed and the next one is started, so memory holds one record, and a big extract lands as many files that can be
+  loaded (or re-loaded) separately
+- when a chunk is closed, its manifest is written next to it: the table, run, part, number of records, bytes (as JSON
+  and gzipped), a sha256 of its JSON lines and its columns. A chunk without a manifest was not finished, and is not loaded.
+Chunks are named like the notebook's extracts, partitioned by the extract's date and time:
+    {landing_dir}/{table}/dt=2023-10-02/ts=2023-10-02T14:15:03/{table}-{part}.jsonl.gz (and .manifest.json)
+
+Writing records:
+    writer = jsonl_landing.new_writer(landing_dir, "ntdreportingp50_data")
+    jsonl_landing.write_records(writer, rows)
+    manifests = jsonl_landing.close_writer(writer)
+and loading them into BigQuery (gs:// landing folders only): jsonl_landing.load_to_bigquery(client, manifests, table_id)
+
+To land the tables of a BlackCat API response, navigate to folder and type e.g.:
+    python jsonl_landing.py --year 2023
+    python jsonl_landing.py --source data/blackcat_GetNTDReportsByYear_2023_sample.json --landing_dir api_jsonl_2023
+'''
+
+LANDING_DIR = "gs://calitp-ntd-report-validation/blackcat_ntd_reports_{year}_jsonl"
+MAX_CHUNK_MB = 256 # of JSON, before compression
+EXTENSION = ".jsonl.gz"
+MANIFEST_EXTENSION = ".manifest.json"
+
+
+def get_arguments(this_year):
+    parser = ArgumentParser(description="Land the tables of a BlackCat API response as gzipped JSON lines")
+    parser.add_argument('--year', type=int, default=this_year)
+    parser.add_argument('--source', default=None,
+                        help="URL or file (local or gs://, can be gzipped) of the response; default: the API for --year")
+    parser.add_argument('--landing_dir', default=None, help=f"Folder (local or gs://) to write to; default: {LANDING_DIR}")
+    parser.add_argument('--max_chunk_mb', type=float, default=MAX_CHUNK_MB,
+                        help="MB of JSON per file, before compression; bigger extracts are split into several files")
+    parser.add_argument('--bq_dataset', default=None,
+                        help="BigQuery dataset to load each table into, as {year}_{table}; default: do not load")
+    validation_logging.add_arguments(parser)
+    instrumentation.add_arguments(parser, "jsonl_landing")
+    args = parser.parse_args()
+    return args
+
+
+def process_arrays_for_nulls(arr):
+    '''
+    BigQuery does not allow arrays that contain nulls, so nulls are replaced with -1 in arrays of numbers,
+    and with "" in any other array. An array of only nulls becomes empty.
+    '''
+    types = set(type(entry) for entry in arr if entry is not None)
+    if not types:
+        return []
+    filler = -1 if types <= {int, float} else ""
+    return [x if x is not None else filler for x in arr]
+
+
+def make_record_bq_safe(record):
+    '''A record with BigQuery-safe keys (in nested objects too) and no nulls in its arrays.'''
+    safe = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            value = make_record_bq_safe(value)
+        elif isinstance(value, list):
+            value = process_arrays_for_nulls([make_record_bq_safe(entry) if isinstance(entry, dict) else entry
+                                              for entry in value])
+        safe[data_sources.make_name_bq_safe(str(key))] = value
+    return safe
+
+
+def extract_dir(landing_dir, table, extract_time):
+    '''The folder of one extract of a table, partitioned by date and time as in the Airtable notebook.'''
+    return f"{landing_dir}/{table}/dt={extract_time:%Y-%m-%d}/ts={extract_time.isoformat(timespec='seconds')}"
+
+
+def new_writer(landing_dir, table, extract_time=None, max_chunk_mb=MAX_CHUNK_MB, run_id=None):
+    '''A writer for one extract of a table (see above). Nothing is written until the first record.'''
+    return {"dir": extract_dir(landing_dir, table, extract_time or datetime.datetime.now()), "table": table,
+            "run_id": run_id or results_sink.new_run_id(), "max_bytes": int(max_chunk_mb * 1024 * 1024),
+            "part": 0, "chunk": None, "manifests": []}
+
+
+def _open_chunk(writer):
+    fs, path = fsspec.core.url_to_fs(writer["dir"])
+    fs.makedirs(path, exist_ok=True)
+    name = f"{path}/{writer['table']}-{writer['part']:05d}"
+    file = fs.open(f"{name}{EXTENSION}", "wb")
+    writer["chunk"] = {"fs": fs, "name": name, "file": file, "gzip": gzip.GzipFile(fileobj=file, mode="wb"),
+                       "rows": 0, "bytes": 0, "sha256": hashlib.sha256(), "columns": set()}
+
+
+def _close_chunk(writer):
+    '''Finishes the current chunk and writes its manifest.'''
+    chunk = writer["chunk"]
+    chunk["gzip"].close()
+    chunk["file"].close()
+    fs, name = chunk["fs"], chunk["name"]
+    protocol = fs.protocol if isinstance(fs.protocol, str) else fs.protocol[0]
+    manifest = {"file": f"{name}{EXTENSION}" if protocol == "file" else f"{protocol}://{name}{EXTENSION}",
+                "table": writer["table"], "run_id": writer["run_id"], "part": writer["part"], "rows": chunk["rows"],
+                "bytes": chunk["bytes"], "compressed_bytes": fs.size(f"{name}{EXTENSION}"),
+                "sha256": chunk["sha256"].hexdigest(), "columns": sorted(chunk["columns"]),
+                "written": datetime.datetime.now().isoformat(timespec="seconds")}
+    with fs.open(f"{name}{MANIFEST_EXTENSION}", "w") as f:
+        json.dump(manifest, f, indent=1)
+    instrumentation.add_count("bytes_written", manifest["compressed_bytes"])
+    writer["manifests"].append(manifest)
+    writer.update(chunk=None, part=writer["part"] + 1)
+
+
+def write_records(writer, records):
+    '''Writes records (dicts) to the writer's chunks, starting a new chunk whenever one is full. Returns the count.'''
+    n = 0
+    for record in records:
+        if writer["chunk"] is None:
+            _open_chunk(writer)
+        chunk = writer["chunk"]
+        record = make_record_bq_safe(record)
+        line = (json.dumps(record, default=str, separators=(",", ":")) + "\n").encode()
+        chunk["gzip"].write(line)
+        chunk["sha256"].update(line)
+        chunk["columns"].update(record)
+        chunk["rows"] += 1
+        chunk["bytes"] += len(line)
+        n += 1
+        if chunk["bytes"] >= writer["max_bytes"]:
+            _close_chunk(writer)
+    return n
+
+
+def close_writer(writer):
+    '''Finishes the last chunk. Returns the manifests of every chunk written.'''
+    if writer["chunk"] is not None:
+        _close_chunk(writer)
+    return writer["manifests"]
+
+
+def read_manifests(extract_dir):
+    '''The manifests of the finished chunks in an extract's folder, in order.'''
+    fs, path = fsspec.core.url_to_fs(extract_dir)
+    manifests = []
+    for file in sorted(fs.glob(f"{path}/*{MANIFEST_EXTENSION}")):
+        with fs.open(file, "r") as f:
+            manifests.append(json.load(f))
+    return manifests
+
+
+def iter_records(manifests):
+    '''The records of the chunks in manifests, one at a time, as dicts.'''
+    for manifest in manifests:
+        with fsspec.open(manifest["file"], "rt", compression="gzip") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def load_to_bigquery(client, manifests, table_id, write_disposition="WRITE_TRUNCATE"):
+    '''Loads the chunks in manifests (on gs://) into the BigQuery table table_id in one load job. Returns the job.'''
+    job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON, autodetect=True,
+                                        create_disposition="CREATE_IF_NEEDED", write_disposition=write_disposition)
+    job = client.load_table_from_uri([manifest["file"] for manifest in manifests], table_id, job_config=job_config)
+    job.result() # Wait for the job to complete.
+    return job
+
+
+def land_api_response(source, landing_dir, max_chunk_mb=MAX_CHUNK_MB, run_id=None, logger=None):
+    '''
+    Lands every table of a BlackCat API response (see blackcat_api.py), and its report fields as "reports", reading it
+    one report at a time. Rows are kept as the API sends them, with nested objects (e.g. Mode) as objects.
+    Returns the manifests of each table.
+    '''
+    run_id = run_id or results_sink.new_run_id()
+    extract_time = datetime.datetime.now()
+    writers = {}
+
+    def write(table, rows):
+        if table not in writers:
+            writers[table] = new_writer(landing_dir, table, extract_time, max_chunk_mb, run_id)
+        write_records(writers[table], rows)
+
+    with blackcat_api.open_source(source) as stream:
+        for report in blackcat_api.iter_reports(stream):
+            write(blackcat_api.REPORTS_TABLE, [{field: report.get(field) for field in blackcat_api.REPORT_FIELDS}])
+            for key, value in report.items():
+                if isinstance(value, dict) and isinstance(value.get("Data"), list):
+                    write(blackcat_api.table_name(key), value["Data"])
+    manifests = {table: close_writer(writer) for table, writer in writers.items()}
+
+    if logger is not None:
+        logger.info(f"Landed {source} in {landing_dir}: "
+                    + ", ".join(f"{table} {sum(m['rows'] for m in chunks)} rows in {len(chunks)} files"
+                                for table, chunks in manifests.items()),
+                    extra={"run_id": run_id, "rows": {table: sum(m["rows"] for m in chunks)
+                                                      for table, chunks in manifests.items()}})
+    return manifests
+
+
+def main():
+    this_year = datetime.datetime.now().year
+    args = get_arguments(this_year)
+    logger = validation_logging.write_to_log('jsonl_landing_log.log', args.log_level)
+    source = args.source or blackcat_api.API_URL.format(year=args.year)
+    landing_dir = args.landing_dir or LANDING_DIR.format(year=args.year)
+    run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("jsonl_landing", year=args.year, run_id=run_id, source=source)
+
+    with instrumentation.profiled(args.profile, args.profile_file, "jsonl_landing"):
+        with instrumentation.stage_timer(metrics, "jsonl_landing", "load") as record:
+            manifests = land_api_response(source, landing_dir, args.max_chunk_mb, run_id, logger)
+            record["rows_out"] = sum(m["rows"] for chunks in manifests.values() for m in chunks)
+        if args.bq_dataset:
+            client = bigquery.Client()
+            for table, chunks in manifests.items():
+                if chunks:
+                    with instrumentation.stage_timer(metrics, f"bq_{table}", "load"):
+                        load_to_bigquery(client, chunks, f"{args.bq_dataset}.{args.year}_{table}")
+                        logger.info(f"Loaded {table} into {args.bq_dataset}.{args.year}_{table}")
+    instrumentation.write_metrics(metrics, args.metrics_file)
+
+if __name__ == "__main__":
+    main()
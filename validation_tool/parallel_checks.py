@@ -0,0 +1,21 @@
+import data_sources
+import instrumentation
+
+'''Worker side of running independent validation checks in a process pool (python validate.py --jobs N).
+Input tables are written once as snapshots (see data_sources.write_snapshot()); each worker looks them up by name
+and memory-maps them read-only, instead of getting its own pickled copy of every table it needs.
+'''
+
+
+def run_stage(name, kind, func, snapshot_dir, snapshot_inputs, inputs, kwargs):
+    '''
+    Worker entry point. snapshot_inputs maps argument names to snapshot names; inputs holds any other
+    (small) arguments that were pickled as usual. Returns the stage result and its metrics record
+    (see instrumentation.stage_timer()); the stage's time includes mapping its snapshots.
+    '''
+    with instrumentation.stage_timer(None, name, kind) as record:
+        frames = {arg: data_sources.read_snapshot(snapshot_dir, snapshot) for arg, snapshot in snapshot_inputs.items()}
+        record["rows_in"] = instrumentation.count_rows(*frames.values(), *inputs.values())
+        result = func(**frames, **inputs, **kwargs)
+        record["rows_out"] = instrumentation.count_rows(result) if result is not None else None
+    return result, record
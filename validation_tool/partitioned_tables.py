@@ -0,0 +1,228 @@
+from argparse import ArgumentParser
+from google.cloud import bigquery
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pandas as pd
+import os
+
+import data_sources
+import results_sink
+import validation_logging
+
+'''Year-partitioned storage for the BlackCat tables: one table per form and sheet for every reporting year, in place
+of one table per year ({year}_{form}_{sheet}, e.g. 2023_rr20_service_data).
+Each table has a reporting_year column, is partitioned by it (one partition per year, as validation_results in
+results_sink.py) and clustered by organization, so a query for some years of some agencies only reads those years,
+and the rows of those agencies. Every year's rows have the same columns; older years are mapped onto them with
+SCHEMA_EVOLUTION:
+- columns that were renamed are renamed to their current name
+- columns a year did not have are null. They must be listed for that year, so a column that goes missing without
+  notice (e.g. a new export from BlackCat) stops the migration instead of silently becoming null.
+A year with no date_uploaded (uploaded once, like 2022 and before) has one submission per organization, so the latest
+submission of every year can be taken in one query (see latest_submissions_sql()).
+
+A validate.py run then loads each RR-20 table once, for both years, instead of once per year:
+    python validate.py --storage partitioned
+To copy years of the per-year tables into the partitioned tables (again, to replace a year), type e.g.:
+    python partitioned_tables.py --years 2022 2023
+and to do the same in a local folder of {year}_{table}.parquet files (e.g. one written by synthetic_data.py),
+which is written as {data_dir}/{table}/reporting_year={year}/part-0.parquet:
+    python partitioned_tables.py --years 2022 2023 --data_dir synthetic_1x
+'''
+
+BQ_PARTITIONED_DATASET = "cal-itp-data-infra.blackcat_by_year"
+YEAR_COLUMN = "reporting_year"
+
+# Tables that are kept for every year, and the organization column they are clustered by
+PARTITIONED_TABLES = {
+    "rr20_service_data": {"org_column": "Organization_Legal_Name"},
+    "rr20_expenses_by_mode": {"org_column": "Organization_Legal_Name"},
+    "rr20_financials__2": {"org_column": "Organization_Legal_Name"},
+}
+
+# How each year's table maps onto the current columns, for ranges of years (first or last None: open-ended):
+# {table: [{"years": (first, last), "renames": {old: new}, "missing": [columns]}]}
+# Years up to 2022 were loaded once from the annual Excel export (data_to_BQ.py), without an upload date.
+SCHEMA_EVOLUTION = {
+    "rr20_service_data": [{"years": (None, 2022), "missing": ["date_uploaded"]}],
+    "rr20_expenses_by_mode": [{"years": (None, 2022), "missing": ["date_uploaded"]}],
+    "rr20_financials__2": [{"years": (None, 2022), "missing": ["date_uploaded"]}],
+}
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Copy years of the per-year BlackCat tables into year-partitioned tables")
+    parser.add_argument('--years', type=int, nargs='+', required=True)
+    parser.add_argument('--tables', nargs='+', choices=list(PARTITIONED_TABLES), default=list(PARTITIONED_TABLES))
+    parser.add_argument('--data_dir', default=None,
+                        help="Copy the {year}_{table}.parquet files in this folder, instead of the BigQuery tables")
+    validation_logging.add_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def evolution(table, year):
+    '''The renames and missing columns of a year's table (see SCHEMA_EVOLUTION).'''
+    changes = {"renames": {}, "missing": []}
+    for entry in SCHEMA_EVOLUTION.get(table, []):
+        first, last = entry["years"]
+        if (first is None or year >= first) and (last is None or year <= last):
+            changes["renames"].update(entry.get("renames", {}))
+            changes["missing"] += entry.get("missing", [])
+    return changes
+
+
+def uploaded_once(table, year):
+    '''Whether a year's table was loaded once (no date_uploaded), like last year's tables in validate.py.'''
+    return "date_uploaded" in evolution(table, year)["missing"]
+
+
+def current_columns(table, year_columns):
+    '''
+    The columns of a partitioned table, in order, given {year: the year's columns}: those of the latest year, then any
+    others of older years (after their renames). Raises a ValueError if a year lacks a column that SCHEMA_EVOLUTION
+    does not list as missing for that year.
+    '''
+    renamed = {year: [evolution(table, year)["renames"].get(column, column) for column in columns]
+               for year, columns in year_columns.items()}
+    columns = []
+    for year in sorted(renamed, reverse=True):
+        columns += [column for column in renamed[year] if column not in columns]
+    for year, year_renamed in renamed.items():
+        unexpected = [column for column in columns
+                      if column not in year_renamed and column not in evolution(table, year)["missing"]]
+        if unexpected:
+            raise ValueError(f"{year}_{table} has no column {', '.join(unexpected)}; add it to SCHEMA_EVOLUTION "
+                             f"if it was renamed or did not exist in {year}")
+    return columns
+
+
+def table_ref(table):
+    '''How a query refers to a partitioned table (BigQuery, or data_sources.LocalBigQueryClient).'''
+    return f"`{BQ_PARTITIONED_DATASET}.{table}`"
+
+
+def latest_submissions_sql(table, years):
+    '''
+    The rows of each organization's latest submission (its rows with the latest date_uploaded) in each of years, in one
+    query, as data_sources.get_bq_data() gets them for one year. Years without date_uploaded keep every row.
+    '''
+    org_column = PARTITIONED_TABLES[table]["org_column"]
+    return f"""SELECT * FROM
+          (select *,
+          RANK() OVER(PARTITION BY {YEAR_COLUMN}, {org_column} ORDER BY date_uploaded DESC) rank_date
+        from {table_ref(table)}
+        where {YEAR_COLUMN} IN ({', '.join(str(int(year)) for year in years)})) s
+        WHERE rank_date = 1;
+        """
+
+
+def available_years(client, tablename):
+    '''The years a partitioned table has rows for, in order.'''
+    df = data_sources.run_query(client, f"SELECT DISTINCT {YEAR_COLUMN} FROM {table_ref(tablename)}")
+    return sorted({int(year) for year in df[YEAR_COLUMN]})
+
+
+def year_versions_sql(table, years):
+    '''The number of rows and the latest date_uploaded of each of years, in one query that only reads those columns.'''
+    return f"""SELECT {YEAR_COLUMN}, COUNT(*) AS row_count, MAX(date_uploaded) AS last_uploaded
+        FROM {table_ref(table)}
+        WHERE {YEAR_COLUMN} IN ({', '.join(str(int(year)) for year in years)})
+        GROUP BY {YEAR_COLUMN}
+        """
+
+
+def year_versions(client, tablename, years):
+    '''
+    {year: [rows, latest date_uploaded as text, or None]} of the years in a partitioned table that have rows. A new
+    submission, or a year copied into the table again with other rows, changes its entry.
+    '''
+    df = data_sources.run_query(client, year_versions_sql(tablename, years))
+    return {int(year): [int(rows), None if pd.isna(uploaded) else str(uploaded)]
+            for year, rows, uploaded in zip(df[YEAR_COLUMN], df["row_count"], df["last_uploaded"])}
+
+
+def get_years(client, tablename, years):
+    '''
+    The latest submissions of years from a partitioned table, in one query. Split the result into years with
+    year_rows(), which drops the columns the per-year loaders drop.
+    '''
+    return data_sources.run_query(client, latest_submissions_sql(tablename, years))
+
+
+def year_rows(df, year):
+    '''
+    One year's rows of a get_years() result, as data_sources.get_bq_data() (or get_bq_table(), for a year uploaded once)
+    returns them for that year: without duplicate rows, reporting_year, rank_date or date_uploaded, and with its dtypes.
+    '''
+    df = df[df[YEAR_COLUMN] == year].reset_index(drop=True)
+    df = df.drop_duplicates().drop([YEAR_COLUMN, 'rank_date', 'date_uploaded'], axis=1)
+    return data_sources.apply_dtypes(df)
+
+
+def migrate_bigquery(client, table, years, logger=None):
+    '''Copies years of {year}_{table} in blackcat_raw into the partitioned table, replacing those years' partitions.'''
+    schemas = {year: client.get_table(f"{data_sources.BQ_RAW_DATASET}.{year}_{table}").schema for year in years}
+    columns = current_columns(table, {year: [field.name for field in schema] for year, schema in schemas.items()})
+    types = {}
+    for year, schema in schemas.items():
+        for field in schema:
+            types.setdefault(evolution(table, year)["renames"].get(field.name, field.name), field.field_type)
+
+    def select(year):
+        renamed = {new: old for old, new in evolution(table, year)["renames"].items()}
+        source = {field.name for field in schemas[year]}
+        values = [f"{renamed.get(column, column)} AS {column}" if renamed.get(column, column) in source
+                  else f"CAST(NULL AS {types[column]}) AS {column}" for column in columns]
+        return f"SELECT {int(year)} AS {YEAR_COLUMN}, {', '.join(values)} FROM `{data_sources.BQ_RAW_DATASET}.{year}_{table}`"
+
+    target = f"`{BQ_PARTITIONED_DATASET}.{table}`"
+    script = [f"""CREATE TABLE IF NOT EXISTS {target}
+        PARTITION BY RANGE_BUCKET({YEAR_COLUMN}, GENERATE_ARRAY({results_sink.FIRST_YEAR}, {results_sink.FIRST_YEAR + 100}, 1))
+        CLUSTER BY {PARTITIONED_TABLES[table]["org_column"]}
+        AS {select(max(years))} WHERE FALSE"""]
+    for year in years:
+        script.append(f"DELETE FROM {target} WHERE {YEAR_COLUMN} = {int(year)}")
+        script.append(f"INSERT INTO {target} ({YEAR_COLUMN}, {', '.join(columns)}) {select(year)}")
+    client.query(";\n".join(script)).result()
+    if logger is not None:
+        logger.info(f"Copied {', '.join(map(str, years))} of {table} into {target}", extra={"table": table, "years": years})
+
+
+def migrate_local(data_dir, table, years, logger=None):
+    '''
+    Copies years of {data_dir}/{year}_{table}.parquet into {data_dir}/{table}/{YEAR_COLUMN}={year}/part-0.parquet,
+    replacing those years. Rows keep their order (BigQuery clusters them; a local folder does not need to).
+    '''
+    tables = {year: pq.read_table(os.path.join(data_dir, f"{year}_{table}.parquet")) for year in years}
+    tables = {year: t.rename_columns([evolution(table, year)["renames"].get(c, c) for c in t.column_names])
+              for year, t in tables.items()}
+    columns = current_columns(table, {year: t.column_names for year, t in tables.items()})
+    fields = {}
+    for t in tables.values():
+        for field in t.schema:
+            fields.setdefault(field.name, field.type)
+    schema = pa.schema([(column, fields[column]) for column in columns])
+    for year, t in tables.items():
+        t = pa.table({column: t[column].cast(schema.field(column).type) if column in t.column_names
+                      else pa.nulls(len(t), schema.field(column).type) for column in columns})
+        year_dir = os.path.join(data_dir, table, f"{YEAR_COLUMN}={year}")
+        os.makedirs(year_dir, exist_ok=True)
+        pq.write_table(t, os.path.join(year_dir, "part-0.parquet"))
+    if logger is not None:
+        logger.info(f"Copied {', '.join(map(str, years))} of {table} into {os.path.join(data_dir, table)}",
+                    extra={"table": table, "years": years})
+
+
+def main():
+    args = get_arguments()
+    logger = validation_logging.write_to_log('partitioned_tables_log.log', args.log_level)
+    client = None if args.data_dir else bigquery.Client()
+    for table in args.tables:
+        if args.data_dir:
+            migrate_local(args.data_dir, table, args.years, logger)
+        else:
+            migrate_bigquery(client, table, args.years, logger)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+from xlsxwriter.utility import xl_col_to_name
+import xlsxwriter
+import numpy as np
+import tempfile
+import shutil
+import fsspec
+import os
+
+'''Writes the validation reports (Excel files) for all the check scripts. A report is a list of sheet specs:
+    report_writer.write_report("reports/rr20_service_check_report.xlsx", [
+        {"sheet": "rr20_checks_full", "data": rr20_checks,
+         "subtitle": "Reduced Reporting RR-20: Validation Warnings", "subtitle_cells": "A2:C2",
+         "agency_response": True,
+         "column_widths": [(0, 0, 35), (1, 3, 22), (4, 4, 11), (5, 6, 53)]},
+    ])
+Each data sheet gets the report title and subtitle, the table from row 3 (header) down, yellow "Agency Response" and
+"Response Date" headers to the right of the table if agency_response is set, the column widths given
+(first column, last column, width) and panes frozen at B4. Rows whose status ("check_status" or "check_result") is
+"fail" or "warning" are highlighted. A sheet spec with "text" instead of "data" is a page of notes, like a readme:
+a list of (cell, text, style) with style "title", "subtitle" or None. Text cells must be in row order.
+
+Rows are written one at a time in xlsxwriter's constant_memory mode, so each finished row goes to disk instead of
+being kept until the file is closed. The highlighted rows are found in one pass over the status column and
+added as one conditional format per status, covering every run of consecutive rows with that status.
+Reports can be written to a local path or to GCS (gs://...).
+'''
+
+REPORT_TITLE = "NTD Data Validation Report"
+FIRST_DATA_ROW = 3 # 0-based: title, subtitle, header
+STATUS_COLUMNS = ["check_status", "check_result"]
+WRITE_CHUNK_ROWS = 10_000
+
+FORMATS = {
+    "title": {'bold': True, 'valign': 'center', 'align': 'left', 'font_color': '#1c639e', 'font_size': 15},
+    "subtitle": {'bold': True, 'align': 'left', 'font_color': 'black', 'font_size': 19},
+    "response_header": {'fg_color': 'yellow', 'bold': True, 'border': 1},
+    "header": {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'},
+    "fail": {'bg_color': '#FFC7CE', 'font_color': '#9C0006'},
+    "warning": {'bg_color': '#FFEB9C', 'font_color': '#9C5700'},
+}
+HIGHLIGHTS = ["fail", "warning"]
+
+
+def highlight_ranges(statuses, status, first_row, last_col):
+    '''
+    The cell ranges (e.g. "A4:F4 A7:F9") of the runs of consecutive rows whose status is status, for a table whose
+    first row is sheet row first_row (0-based) and whose last column is last_col. Returns "" if there are none.
+    '''
+    match = np.asarray(statuses == status, dtype=np.int8)
+    edges = np.diff(np.concatenate([[0], match, [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    last_col_letter = xl_col_to_name(last_col)
+    return " ".join(f"A{first_row + start + 1}:{last_col_letter}{first_row + end + 1}" for start, end in zip(starts, ends))
+
+
+def _rows(data):
+    '''Yields each row of data as a list of plain python values, with missing values as None (a blank cell).'''
+    for start in range(0, len(data), WRITE_CHUNK_ROWS):
+        chunk = data.iloc[start:start + WRITE_CHUNK_ROWS].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        yield from chunk.itertuples(index=False, name=None)
+
+
+def _write_data_sheet(workbook, formats, spec):
+    data = spec["data"]
+    worksheet = workbook.add_worksheet(spec["sheet"])
+    for first_col, last_col, width in spec.get("column_widths", []):
+        worksheet.set_column(first_col, last_col, width)
+    worksheet.freeze_panes('B4')
+
+    worksheet.write(0, 0, REPORT_TITLE, formats["title"])
+    worksheet.merge_range(spec["subtitle_cells"], spec["subtitle"], formats["subtitle"])
+    worksheet.write_row(FIRST_DATA_ROW - 1, 0, list(data.columns), formats["header"])
+    if spec.get("agency_response"):
+        worksheet.write_row(FIRST_DATA_ROW - 1, len(data.columns), ['Agency Response', 'Response Date'],
+                            formats["response_header"])
+
+    for i, row in enumerate(_rows(data)):
+        worksheet.write_row(FIRST_DATA_ROW + i, 0, row)
+
+    status_col = next((col for col in STATUS_COLUMNS if col in data.columns), None)
+    if status_col is not None and len(data) > 0:
+        statuses = data[status_col].to_numpy(dtype=object)
+        for status in HIGHLIGHTS:
+            ranges = highlight_ranges(statuses, status, FIRST_DATA_ROW, len(data.columns) - 1)
+            if ranges:
+                first_range = ranges.split(" ", 1)[0]
+                worksheet.conditional_format(first_range, {'type': 'formula', 'criteria': 'TRUE',
+                                                           'format': formats[status], 'multi_range': ranges})
+
+
+def _write_text_sheet(workbook, formats, spec):
+    worksheet = workbook.add_worksheet(spec["sheet"])
+    for cell, text, style in spec["text"]:
+        worksheet.write(cell, text, formats[style] if style else None)
+
+
+def write_workbook(target, sheets):
+    '''Writes the sheets to target, a local filename or a file object.'''
+    workbook = xlsxwriter.Workbook(target, {'constant_memory': True})
+    formats = {name: workbook.add_format(properties) for name, properties in FORMATS.items()}
+    for spec in sheets:
+        if "text" in spec:
+            _write_text_sheet(workbook, formats, spec)
+        else:
+            _write_data_sheet(workbook, formats, spec)
+    workbook.close()
+
+
+def write_report(filename, sheets):
+    '''Writes a report with the given sheets (see above) to filename, which can be a local path or a gs:// path.'''
+    if "://" not in filename:
+        write_workbook(filename, sheets)
+        return
+    # constant_memory keeps its rows in local temporary files, so the finished file is uploaded after it is closed.
+    with tempfile.TemporaryDirectory(prefix="report_") as tmp_dir:
+        local_file = os.path.join(tmp_dir, os.path.basename(filename))
+        write_workbook(local_file, sheets)
+        with open(local_file, "rb") as source, fsspec.open(filename, "wb") as destination:
+            shutil.copyfileobj(source, destination)
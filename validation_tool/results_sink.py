@@ -0,0 +1,130 @@
+from google.cloud import bigquery
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow as pa
+import pandas as pd
+import datetime
+import fsspec
+import uuid
+import json
+
+'''Machine-readable copies of the check results, next to the Excel reports, for dashboards and trend queries.
+Every run gets a run id, and, if asked to, writes all its check results, in one long table, to:
+- Parquet files partitioned by year and check, under --results_dir (e.g. RESULTS_DIR below):
+    {results_dir}/year=2023/check=service_cost_per_hr/{run_id}-0.parquet
+  Each run adds its own files, so earlier runs are kept.
+- the BigQuery table --results_table (e.g. RESULTS_TABLE, validation_results), appended in one load job. The table is
+  created on the first load, partitioned by year and clustered by report and check.
+Neither is written unless given, so runs on local data (--data_dir) or to a local --output_dir do not write to the
+shared bucket or table. Scheduled runs pass both:
+    --results_dir gs://calitp-ntd-report-validation/validation_results
+    --results_table cal-itp-data-infra.ntd_validation.validation_results
+
+Each row is one check result: the run, year, report and check (the stage name in validate.py, e.g. "service_VOMX")
+it came from, and the check table's Organization, name_of_check, mode, VIN, value_checked, check_status and Description
+(empty when a check does not have that column). check_result (VOMS totals) is stored as check_status. Any other columns,
+like the vehicle counts of the VOMS totals check, are kept as a JSON object in "details".
+Reading the results back:
+    pd.read_parquet("gs://calitp-ntd-report-validation/validation_results", filters=[("check", "=", "service_VOMX")])
+'''
+
+RESULTS_DIR = "gs://calitp-ntd-report-validation/validation_results"
+RESULTS_TABLE = "cal-itp-data-infra.ntd_validation.validation_results"
+RESULT_COLUMNS = ["Organization", "name_of_check", "mode", "VIN", "value_checked", "check_status", "Description"]
+PARTITION_COLUMNS = ["year", "check"]
+
+RESULTS_SCHEMA = pa.schema([("run_id", pa.string()), ("run_started", pa.timestamp("s")), ("year", pa.int64()),
+                            ("report", pa.string()), ("check", pa.string())]
+                           + [(column, pa.string()) for column in RESULT_COLUMNS]
+                           + [("details", pa.string())])
+BQ_TYPES = {pa.string(): "STRING", pa.int64(): "INT64", pa.timestamp("s"): "TIMESTAMP"}
+FIRST_YEAR = 2015 # first year partition of the BigQuery table
+
+
+def add_arguments(parser):
+    '''Adds the --results_dir and --results_table options to a script's argument parser.'''
+    parser.add_argument('--results_dir', default=None,
+                        help=f"Folder (local or gs://) to write the check results to as Parquet, e.g. {RESULTS_DIR}; "
+                             "default: not written")
+    parser.add_argument('--results_table', default=None,
+                        help=f"BigQuery table to load the check results into, e.g. {RESULTS_TABLE}; "
+                             "default: not loaded")
+    return parser
+
+
+def new_run_id(started=None):
+    '''A run id that sorts by start time, e.g. 20231002T141503-1f2e3d4c.'''
+    started = started or datetime.datetime.now()
+    return f"{started:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+
+def _details(rows):
+    return [json.dumps({key: value for key, value in row.items() if pd.notna(value)}, default=str) if row else None
+            for row in rows]
+
+
+def results_table(checks, run_id, year, reports, run_started=None, check_years=None):
+    '''
+    One long table of results from checks ({check name: check table}), where reports maps each check name to
+    the report it belongs to. Results are for year, except for checks in check_years ({check name: year}).
+    '''
+    run_started = pd.Timestamp(run_started or datetime.datetime.now()).floor("s")
+    tables = []
+    for check, table in checks.items():
+        table = table.rename(columns={"check_result": "check_status"}).reset_index(drop=True)
+        result = pd.DataFrame({column: (table[column].astype(str).where(table[column].notna(), None)
+                                        if column in table.columns else None)
+                               for column in RESULT_COLUMNS}, index=table.index)
+        others = table.drop(columns=[column for column in RESULT_COLUMNS if column in table.columns])
+        result["details"] = _details(others.to_dict(orient="records")) if len(others.columns) else None
+        result.insert(0, "check", check)
+        result.insert(0, "report", reports.get(check))
+        result.insert(0, "year", (check_years or {}).get(check, year))
+        result.insert(0, "run_started", run_started)
+        result.insert(0, "run_id", run_id)
+        tables.append(result)
+    if not tables:
+        return RESULTS_SCHEMA.empty_table().to_pandas()
+    return pd.concat(tables, ignore_index=True)
+
+
+def write_parquet(results, results_dir):
+    '''Adds the results to the Parquet dataset in results_dir (local or any fsspec URL), partitioned by year and check.'''
+    fs, path = fsspec.core.url_to_fs(results_dir)
+    table = pa.Table.from_pandas(results, schema=RESULTS_SCHEMA, preserve_index=False)
+    run_id = results["run_id"].iloc[0] if len(results) > 0 else "empty"
+    ds.write_dataset(table, path, format="parquet", partitioning=PARTITION_COLUMNS, partitioning_flavor="hive",
+                     filesystem=pa.fs.PyFileSystem(pa.fs.FSSpecHandler(fs)),
+                     basename_template=f"{run_id}-{{i}}.parquet", existing_data_behavior="overwrite_or_ignore")
+
+
+def load_to_bigquery(client, results, table_id):
+    '''Appends the results to the BigQuery table table_id in one load job, creating the table if needed.'''
+    job_config = bigquery.LoadJobConfig(
+        schema=[bigquery.SchemaField(field.name, BQ_TYPES[field.type]) for field in RESULTS_SCHEMA],
+        create_disposition="CREATE_IF_NEEDED",
+        write_disposition="WRITE_APPEND",
+        range_partitioning=bigquery.RangePartitioning(
+            field="year", range_=bigquery.PartitionRange(start=FIRST_YEAR, end=FIRST_YEAR + 100, interval=1)),
+        clustering_fields=["report", "check"],
+    )
+    job = client.load_table_from_dataframe(results, table_id, job_config=job_config)
+    job.result() # Wait for the job to complete.
+
+
+def write_results(client, run_id, year, reports, results_dir=None, results_table_id=None,
+                  check_years=None, logger=None, **checks):
+    '''
+    Writes the check tables passed as check name=table (see results_table()) to Parquet in results_dir and
+    to the BigQuery table results_table_id. Either is skipped if it is None or "". Returns the long results table.
+    '''
+    results = results_table(checks, run_id, year, reports, check_years=check_years)
+    if results_dir:
+        write_parquet(results, results_dir)
+    if results_table_id:
+        load_to_bigquery(client, results, results_table_id)
+    if logger is not None:
+        logger.info(f"Saved {len(results)} results from {len(checks)} checks for run {run_id}",
+                    extra={"run_id": run_id, "rows": len(results), "results_dir": results_dir,
+                           "results_table": results_table_id})
+    return results
@@ -1,16 +1,33 @@
 from argparse import ArgumentParser
 from google.cloud import bigquery
+from data_sources import get_bq_data, get_bq_table, share_categories
 import pandas as pd
 import datetime
+import functools
 import logging
 
+import check_cache
+import check_results
+import instrumentation
+import report_writer
+import results_sink
+import validation_logging
+
 '''Script for checking RR-20 NTD report for Financial Data. 
 Grabs data from GCS buckets for "this year" and "last year". 
 Writes validated data into:
 - a folder called "gs://calitp-ntd-report-validation/validation_reports_2023"
+- with --results_table and --results_dir, a BigQuery table such as validation_results, and Parquet files (every
+  check's results, with the run's id; see results_sink.py)
 
 To run from command line with the default datasources, navigate to folder and type: 
-python rr20_financials_check.py'''
+python rr20_financials_check.py
+Per-stage timings, row counts and memory are written to rr20_financials_check_metrics.json (see instrumentation.py).
+With --cache_dir .check_cache, checks given the same inputs as in an earlier run return their saved results (see check_cache.py).
+To also log every agency each check looks at, add --log_level DEBUG (see validation_logging.py).'''
+
+# For checks that are not passed a logger
+log = logging.getLogger(validation_logging.LOGGER_NAME)
 
 def get_arguments(this_year):
     """Get the data as input arguments (for now)"""
@@ -19,38 +36,43 @@ def get_arguments(this_year):
     parser.add_argument('--last_year', default=(this_year-1))
     parser.add_argument('--form_to_check', default="RR-20")
     parser.add_argument('--worksheet', default = "Financials - 2")
+    results_sink.add_arguments(parser)
+    check_cache.add_arguments(parser)
+    instrumentation.add_arguments(parser, "rr20_financials_check")
+    validation_logging.add_arguments(parser)
     args = parser.parse_args()
     return args
 
 
-def write_to_log(logfilename):
+def financial_result(variable, value_thisyr, value_lastyr, this_year, last_year):
     '''
-    Creates a logger object that outputs to a log file, to the filename specified,
-    and also streams to console.
+    The check status, check name and description of one agency in financial_checks(), from its rounded sums for
+    both years. Also used by sql_checks.py.
     '''
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter(f'%(asctime)s:%(levelname)s: %(message)s',
-                                  datefmt='%y-%m-%d %H:%M:%S')
-    file_handler = logging.FileHandler(logfilename)
-    file_handler.setFormatter(formatter)
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
-
-    if not logger.hasHandlers():
-        logger.addHandler(file_handler)
-        logger.addHandler(stream_handler)
-
-    return logger
+    if ((round(value_thisyr)==0 and round(value_lastyr) != 0) | (round(value_thisyr)!=0 and round(value_lastyr) == 0)) and (variable != 'Other_Directly_Generated_Funds'):
+        result = "fail"
+        check_name = f"Change from 0: {variable}"
+        description = check_results.describe("{variable} funding changed either from or to zero compared to last year. Please provide a narrative justification.",
+                                             variable=variable)
+    elif (abs(round(value_lastyr)) == abs(round(value_thisyr))) and (value_thisyr !=0) and (value_lastyr !=0):
+        result = "fail"
+        check_name = f"Same value: {variable}"
+        description = check_results.describe("You have identical values for {variable} reported in {this_year} and {last_year}, which is unusual. Please provide a narrative justification.",
+                                             variable=variable, this_year=this_year, last_year=last_year)
+    else:
+        result = "pass"
+        check_name = f"{variable}"
+        description = ""
+    return result, check_name, description
 
 
 def financial_checks(df, variable, this_year, last_year, logger):
     agencies = df[df['Fiscal_Year']==this_year]['Organization_Legal_Name'].unique()
-    output = []
+    output = check_results.new_results()
 
     for agency in agencies:
         if (len(df[(df['Organization_Legal_Name']==agency) & (df['Fiscal_Year']==this_year)]) == 0):
-            logger.info(f"There is no data for {agency}")
+            logger.debug("There is no data for agency", extra={"agency": agency, "check": variable})
             continue
         
         ### combine operating/capital rows into sums
@@ -77,34 +99,19 @@ def financial_checks(df, variable, this_year, last_year, logger):
                               & (df['Fiscal_Year'] == last_year)]
                       [variable].unique().sum()))
 
-        if ((round(value_thisyr)==0 and round(value_lastyr) != 0) | (round(value_thisyr)!=0 and round(value_lastyr) == 0)) and (variable != 'Other_Directly_Generated_Funds'):
-            result = "fail"
-            check_name = f"Change from 0: {variable}"
-            description = f"{variable} funding changed either from or to zero compared to last year. Please provide a narrative justification."
-        elif (abs(round(value_lastyr)) == abs(round(value_thisyr))) and (value_thisyr !=0) and (value_lastyr !=0):
-            result = "fail"
-            check_name = f"Same value: {variable}"
-            description = (f"You have identical values for {variable} reported in {this_year} and {last_year}, which is unusual. Please provide a narrative justification.")
-        else:
-            result = "pass"
-            check_name = f"{variable}"
-            description = ""
+        result, check_name, description = financial_result(variable, value_thisyr, value_lastyr, this_year, last_year)
             
-        output_line = {"Organization": agency,
-               "name_of_check" : check_name,
-                "value_checked": f"{this_year} = {value_thisyr}, {last_year} = {value_lastyr}",
-                "check_status": result,
-                "Description": description}
-
-        output.append(output_line)
-    checks = pd.DataFrame(output).sort_values(by="Organization")
-    logger.info(f"Ran financial checks on {variable}.")
+        check_results.add_result(output, Organization=agency, name_of_check=check_name,
+                                 value_checked=f"{this_year} = {value_thisyr}, {last_year} = {value_lastyr}",
+                                 check_status=result, Description=description)
+    checks = check_results.results_frame(output)
+    validation_logging.log_check_summary(logger, variable, checks, agencies)
     return checks
 
 
 def equal_totals(this_year, df, logger):
     agencies = df['Organization_Legal_Name'].unique()
-    output = []
+    output = check_results.new_results()
 
     for agency in agencies:
         agency_df = df[(df['Organization_Legal_Name']==agency) & (df['Fiscal_Year']==this_year)].drop_duplicates()
@@ -116,37 +123,36 @@ def equal_totals(this_year, df, logger):
             if round(Total_Annual_Revenues_Expended) != round(Total_Annual_Expenses_by_Mode):
                 result = "fail"
                 check_name = "RR20F-001OA: equal totals"
-                description = f"Total_Annual_Revenues_Expended (${Total_Annual_Revenues_Expended}) should, but does not, equal Total_Annual_Expenses_by_Mode (${Total_Annual_Expenses_by_Mode}). Please provide a narrative justification."
+                description = check_results.describe("Total_Annual_Revenues_Expended (${revenues}) should, but does not, equal Total_Annual_Expenses_by_Mode (${expenses}). Please provide a narrative justification.",
+                                                     revenues=Total_Annual_Revenues_Expended,
+                                                     expenses=Total_Annual_Expenses_by_Mode)
             else:
                 result = "pass"
                 check_name = "RR20F-001OA: equal totals"
                 description = ""
             
-            output_line = {"Organization": agency,
-                       "name_of_check" : check_name,
-                        "value_checked": f"Total_Annual_Revenues_Expended = ${Total_Annual_Revenues_Expended},Total_Annual_Expenses_by_Mode = ${Total_Annual_Expenses_by_Mode}",
-                        "check_status": result,
-                        "Description": description}
-            output.append(output_line)
+            check_results.add_result(output, Organization=agency, name_of_check=check_name,
+                                     value_checked=f"Total_Annual_Revenues_Expended = ${Total_Annual_Revenues_Expended},Total_Annual_Expenses_by_Mode = ${Total_Annual_Expenses_by_Mode}",
+                                     check_status=result, Description=description)
             
         else:
             pass
 
-    checks = pd.DataFrame(output).sort_values(by="Organization")
-    logger.info("Ran checks for RR20F-001OA NTD warning on equating revenues & expenses!")
+    checks = check_results.results_frame(output)
+    validation_logging.log_check_summary(logger, "RR20F-001OA", checks, agencies)
     return checks
 
 
 def rr20f_001c(df, this_year, logger):
     agencies = df[df['Fiscal_Year']==this_year]['Organization_Legal_Name'].unique()
-    output = []
+    output = check_results.new_results()
 
     for agency in agencies:
         agency_df = df[(df['Organization_Legal_Name'] == agency) & (df['Fiscal_Year'] == this_year)]
         df_capital_finances = agency_df[agency_df['Operating_Capital']=='Capital']
         
         if (len(agency_df) == 0):
-            print(f"There is no data for {agency}")
+            logger.debug("There is no data for agency", extra={"agency": agency, "check": "RR20F-001C"})
             continue
         
         sum_a = df_capital_finances['Total_Annual_Expenses_by_Mode'].values[0]
@@ -161,34 +167,31 @@ def rr20f_001c(df, this_year, logger):
         elif round(sum_a) != round(sum_b):
             result = "fail"
             check_name = f"RR20F-001C: equal totals for capital expenses by mode and funding source expenditures"
-            description = f"The sum of Total Expenses for all modes for Uses of Capital {sum_a} does not equal the sum of all values entered for Directly Generated, Non-Federal and Federal Government Funds {sum_b} for Uses of Capital. Please revise or explain."
+            description = check_results.describe("The sum of Total Expenses for all modes for Uses of Capital {sum_a} does not equal the sum of all values entered for Directly Generated, Non-Federal and Federal Government Funds {sum_b} for Uses of Capital. Please revise or explain.",
+                                                 sum_a=sum_a, sum_b=sum_b)
         
-        output_line = {"Organization": agency,
-               "name_of_check" : check_name,
-                "value_checked": f"Total_Annual_Expenses_by_Mode = {sum_a},by funding source = {sum_b}",
-                "check_status": result,
-                "Description": description}
-
-        output.append(output_line)
-    checks = pd.DataFrame(output).sort_values(by="Organization")
-    logger.info("Ran checks for RR20F-001C NTD warning on capital expenses!")
+        check_results.add_result(output, Organization=agency, name_of_check=check_name,
+                                 value_checked=f"Total_Annual_Expenses_by_Mode = {sum_a},by funding source = {sum_b}",
+                                 check_status=result, Description=description)
+    checks = check_results.results_frame(output)
+    validation_logging.log_check_summary(logger, "RR20F-001C", checks, agencies)
     return checks
 
 
 def rr20f_182(inv_df, fin_df, year):
     agencies = fin_df['Organization_Legal_Name'].unique()
-    output = []
+    output = check_results.new_results()
 
     for agency in agencies:
         agency_df = fin_df[(fin_df['Organization_Legal_Name']==agency) & (fin_df['Fiscal_Year']==year)].drop_duplicates()
         agency_inv = inv_df[inv_df['Organization']==agency].drop_duplicates()
         
         if len(agency_df) == 0:
-            print(f"There is no data for {agency} in {year}")
+            log.debug("There is no data for agency", extra={"agency": agency, "year": year, "check": "RR20F-182"})
             continue
         
         if len(agency_inv) == 0:
-            print(f"There is no inventory data for {agency} in {year}")
+            log.debug("There is no inventory data for agency", extra={"agency": agency, "year": year, "check": "RR20F-182"})
             continue
             
         total_cap_expenses = agency_df[agency_df['Operating_Capital']=='Capital']['Total_Annual_Expenses_by_Mode'].values[0]
@@ -201,119 +204,120 @@ def rr20f_182(inv_df, fin_df, year):
         elif (len(newfleet_df) > 0) and (total_cap_expenses == 0):
             result = "fail"
             check_name = "RR20F-182: new fleet has capital expenses"
-            description = f"There was $0 reported for Funds Expended on Capital for all modes on the RR-20 form, but {len(newfleet_df)} in the reporting year reported as Owned Outright by Public Agency (OOPA) in your inventory. Please provide narrative justification."
+            description = check_results.describe("There was $0 reported for Funds Expended on Capital for all modes on the RR-20 form, but {new_vehicles} in the reporting year reported as Owned Outright by Public Agency (OOPA) in your inventory. Please provide narrative justification.",
+                                                 new_vehicles=len(newfleet_df))
         else:
             result = "warning"
             check_name = "RR20F-182: new fleet has capital expenses"
             description = f"Either capital expenses or inventory data is lacking. Check manually."
 
-        output_line = {"Organization": agency,
-                   "name_of_check" : check_name,
-                    "value_checked": f"New fleet OOPA={len(newfleet_df)}, Total_Annual_Expenses_by_Mode = ${total_cap_expenses}",
-                    "check_status": result,
-                    "Description": description}
-        output.append(output_line)
-    checks = pd.DataFrame(output).sort_values(by="Organization")
+        check_results.add_result(output, Organization=agency, name_of_check=check_name,
+                                 value_checked=f"New fleet OOPA={len(newfleet_df)}, Total_Annual_Expenses_by_Mode = ${total_cap_expenses}",
+                                 check_status=result, Description=description)
+    checks = check_results.results_frame(output)
+    validation_logging.log_check_summary(log, "RR20F-182", checks, agencies)
     return checks
             
 
+def combine_financial_data(rr20_financial, rr20_financial_lastyr):
+    """Row-bind this year's and last year's financials, with missing numbers filled with 0."""
+    rr20_financial, rr20_financial_lastyr = share_categories(
+        [rr20_financial, rr20_financial_lastyr], ["Organization_Legal_Name"], ["Common_Name_Acronym_DBA"], ["Operating_Capital"])
+    allyears = pd.concat([rr20_financial, rr20_financial_lastyr], ignore_index = True)
+    numeric_columns = allyears.select_dtypes(include=['number']).columns
+    allyears[numeric_columns] = allyears[numeric_columns].fillna(0)
+    return allyears
+
+
+def fill_financial_data(rr20_financial):
+    """Copy of this year's financials with missing numbers filled with 0, for the check against inventory."""
+    rr20_financial = rr20_financial.copy()
+    numeric_columns = rr20_financial.select_dtypes(include=['number']).columns
+    rr20_financial[numeric_columns] = rr20_financial[numeric_columns].fillna(0)
+    return rr20_financial
+
+
+# Variables run through financial_checks(), in report order
+FINANCIAL_VARIABLES = ['FTA_Formula_Grants_for_Rural_Areas_5311', 'Other_Directly_Generated_Funds', 'Fare_Revenues']
+
+
+def financials_report_sheets(f_checks):
+    """The report's sheets, for report_writer.write_report()."""
+    return [
+        {"sheet": "rr20_financial_checks_full", "data": f_checks,
+         "subtitle": "Reduced Reporting RR-20: Financial Validation Warnings", "subtitle_cells": "A2:C2",
+         "agency_response": True,
+         "column_widths": [(0, 1, 35), (2, 2, 22), (3, 3, 11), (4, 6, 53)]},
+    ]
+
+
+def write_financials_report(f_checks, filename):
+    report_writer.write_report(filename, financials_report_sheets(f_checks))
+
+
 def main():
-    # Set up the logger object
-    logger = write_to_log('rr20_financialchecks_log.log')
-    
     ### Load data:
     this_year=datetime.datetime.now().year
     args = get_arguments(this_year)
+    # Set up the logger object
+    logger = validation_logging.write_to_log('rr20_financialchecks_log.log', args.log_level)
     last_year = args.last_year
     this_date=datetime.datetime.now().date().strftime('%Y-%m-%d') #for suffix on various files
     
     bq_form_ref = args.form_to_check.replace("-","").lower() #this will convert "RR-20" to "rr20"
     bq_sheet_ref = args.worksheet.replace(" ", "_").replace("/", "_").replace(".", "_").replace("-", "").replace('\W+', '').lower()
     
-    # For each org, get the rows with the latest date_uploaded, which is their latest submitted report.
-    # 2022 data was only uploaded once so has slightly different schema
-    bq_data_query = f"""SELECT * FROM 
-        (select *,
-        RANK() OVER(PARTITION BY Organization_Legal_Name ORDER BY date_uploaded DESC) rank_date 
-        from `cal-itp-data-infra.blackcat_raw.{this_year}_{bq_form_ref}_{bq_sheet_ref}`) s 
-        WHERE rank_date = 1;"""
-    client = bigquery.Client()
-    rr20_financial = client.query(bq_data_query).to_dataframe()
-    rr20_financial = rr20_financial.drop_duplicates().drop('rank_date', axis=1)
-    logger.info(f"Got {this_year} data from blackcat_raw.{this_year}_{bq_form_ref}_{bq_sheet_ref}, with {len(rr20_financial)} rows.")
-    
-    bq_2022_query = f"""SELECT * FROM `cal-itp-data-infra.blackcat_raw.{last_year}_{bq_form_ref}_{bq_sheet_ref}` ;"""
-    rr20_financial_2022 = client.query(bq_2022_query).to_dataframe()
-    rr20_financial_2022 = rr20_financial_2022.drop_duplicates()
-    logger.info(f"Got {last_year} data from blackcat_raw.{last_year}_{bq_form_ref}_{bq_sheet_ref}, with {len(rr20_financial_2022)} rows.")
-
-    allyears = pd.concat([rr20_financial, rr20_financial_2022], ignore_index = True)
-    numeric_columns = allyears.select_dtypes(include=['number']).columns
-    allyears[numeric_columns] = allyears[numeric_columns].fillna(0)
-
-    ### Run validation checks on financial data
-    v_5311 = financial_checks(allyears, 'FTA_Formula_Grants_for_Rural_Areas_5311', this_year, last_year, logger)
-    v_odg = financial_checks(allyears, 'Other_Directly_Generated_Funds', this_year, last_year, logger)
-    v_farerev = financial_checks(allyears, 'Fare_Revenues', this_year, last_year, logger)
-    v_equ_totals = equal_totals(this_year, allyears, logger)
-    v_cap_expenses = rr20f_001c(allyears, this_year, logger)
-    
-    # Run validation check against vehicle inventory
-    veh_inv_query = f"""SELECT * FROM `cal-itp-data-infra.blackcat_raw.{this_year}_inventory_revenue_vehicles`"""
-    veh_inv = client.query(veh_inv_query).to_dataframe()
-    logger.info(f"Got {this_year} data from blackcat_raw.{this_year}_inventory_revenue_vehicles, with {len(veh_inv)} rows.")
-
-    numeric_columns = rr20_financial.select_dtypes(include=['number']).columns
-    rr20_financial[numeric_columns] = rr20_financial[numeric_columns].fillna(0)
-    v_newfleet = rr20f_182(veh_inv, rr20_financial, this_year)
-    logger.info("Ran checks for RR20F-182 on whether new fleets show capital expenses!")
-
-    f_checks  = (pd.concat([v_5311, v_odg, v_farerev, v_equ_totals, v_cap_expenses, v_newfleet], ignore_index=True)
-                 .sort_values(by="Organization"))
-
-    GCS_FILE_PATH_VALIDATED = f"gs://calitp-ntd-report-validation/validation_reports_{this_year}" 
-    with pd.ExcelWriter(f"{GCS_FILE_PATH_VALIDATED}/rr20_financials_check_report_{this_date}.xlsx") as writer:
-        f_checks.to_excel(writer, sheet_name="rr20_financial_checks_full", index=False, startrow=2)
-
-        workbook = writer.book
-        worksheet = writer.sheets["rr20_financial_checks_full"]
-        cell_highlight = workbook.add_format({
-            'fg_color': 'yellow',
-            'bold': True,
-            'border': 1
-        })
-        report_title = "NTD Data Validation Report"
-        title_format = workbook.add_format({
-                'bold': True,
-                'valign': 'center',
-                'align': 'left',
-                'font_color': '#1c639e',
-                'font_size': 15
-                })
-        subtitle = "Reduced Reporting RR-20: Financial Validation Warnings"
-        subtitle_format = workbook.add_format({
-            'bold': True,
-            'align': 'left',
-            'font_color': 'black',
-            'font_size': 19
-            })
-        
-        worksheet.write('A1', report_title, title_format)
-        worksheet.merge_range('A2:C2', subtitle, subtitle_format)
-        worksheet.write('F3', 'Agency Response', cell_highlight)
-        worksheet.write('G3', 'Response Date', cell_highlight)
-        worksheet.set_column(0, 1, 35) #cols A-B width
-        worksheet.set_column(2, 2, 22) #col C width
-        worksheet.set_column(3, 3, 11) #col D width
-        worksheet.set_column(4, 6, 53) #col E-G width
-        worksheet.freeze_panes('B4')
+    run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("rr20_financials_check", this_year=this_year, last_year=last_year, run_id=run_id)
+    timed = functools.partial(instrumentation.timed_call, metrics)
+    memo = functools.partial(check_cache.memoize, cache_dir=args.cache_dir, max_mb=args.cache_max_mb)
+
+    with instrumentation.profiled(args.profile, args.profile_file, "rr20_financials_check"):
+        # For each org, get the rows with the latest date_uploaded, which is their latest submitted report.
+        # 2022 data was only uploaded once so has slightly different schema
+        client = bigquery.Client()
+        rr20_financial = timed("rr20_financials", "load", get_bq_data, client, this_year, f"{bq_form_ref}_{bq_sheet_ref}")
+        logger.info(f"Got {this_year} data from blackcat_raw.{this_year}_{bq_form_ref}_{bq_sheet_ref}, with {len(rr20_financial)} rows.")
+
+        rr20_financial_2022 = timed("rr20_financials_lastyr", "load", get_bq_table, client, last_year, f"{bq_form_ref}_{bq_sheet_ref}")
+        logger.info(f"Got {last_year} data from blackcat_raw.{last_year}_{bq_form_ref}_{bq_sheet_ref}, with {len(rr20_financial_2022)} rows.")
+
+        allyears = timed("financials_allyears", "merge", combine_financial_data, rr20_financial, rr20_financial_2022)
+
+        ### Run validation checks on financial data
+        checks = []
+        for variable in FINANCIAL_VARIABLES:
+            checks.append(timed(f"financials_{variable}", "check", memo(financial_checks, f"financials_{variable}"),
+                                allyears, variable, this_year, last_year, logger))
+        v_equ_totals = timed("financials_equal_totals", "check", memo(equal_totals, "financials_equal_totals"), this_year, allyears, logger)
+        v_cap_expenses = timed("financials_rr20f_001c", "check", memo(rr20f_001c, "financials_rr20f_001c"), allyears, this_year, logger)
+
+        # Run validation check against vehicle inventory
+        veh_inv = timed("inventory", "load", get_bq_table, client, this_year, "inventory_revenue_vehicles")
+        logger.info(f"Got {this_year} data from blackcat_raw.{this_year}_inventory_revenue_vehicles, with {len(veh_inv)} rows.")
+
+        rr20_financial_filled = timed("financials_filled", "derive", fill_financial_data, rr20_financial)
+        v_newfleet = timed("financials_rr20f_182", "check", memo(rr20f_182, "financials_rr20f_182"),
+                           veh_inv, rr20_financial_filled, this_year)
+
+        f_checks = timed("rr20_financials_checks", "merge", check_results.combine_results,
+                         checks + [v_equ_totals, v_cap_expenses, v_newfleet])
+
+        GCS_FILE_PATH_VALIDATED = f"gs://calitp-ntd-report-validation/validation_reports_{this_year}" 
+        timed("rr20_financials_report", "write", write_financials_report, f_checks,
+              f"{GCS_FILE_PATH_VALIDATED}/rr20_financials_check_report_{this_date}.xlsx")
+
+        # Save every check's results as Parquet and to BigQuery, if asked to
+        if args.results_dir or args.results_table:
+            check_names = ([f"financials_{variable}" for variable in FINANCIAL_VARIABLES]
+                           + ["financials_equal_totals", "financials_rr20f_001c", "financials_rr20f_182"])
+            timed("results", "write", results_sink.write_results, client, run_id, this_year,
+                  {name: "rr20_financials" for name in check_names}, results_dir=args.results_dir,
+                  results_table_id=args.results_table, logger=logger,
+                  **dict(zip(check_names, checks + [v_equ_totals, v_cap_expenses, v_newfleet])))
+    instrumentation.write_metrics(metrics, args.metrics_file)
 
     logger.info("Finished running checks on RR-20 financial data!")
 
 if __name__ == "__main__":
     main()
-
-
-
-    
-    
\ No newline at end of file
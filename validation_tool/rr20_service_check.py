@@ -1,52 +1,42 @@
+from argparse import ArgumentParser
 from google.cloud import bigquery
+from data_sources import get_bq_data, get_bq_table, get_orgs, share_categories, group_codes, join_tables
 import pandas as pd
-import numpy as np
 import datetime
-import logging
+import functools
+
+import check_cache
+import check_results
+import instrumentation
+import report_writer
+import results_sink
+import validation_logging
 
 '''Script for checking RR-20 NTD report for Service Data. 
 Grabs data from BigQuery "raw" tables for "this year" and "last year". 
-Will write validated data into two places:
+Will write validated data into:
 - a folder called "gs://calitp-ntd-report-validation/validation_reports_2023"
-- BigQuery tables
+- with --results_table and --results_dir, BigQuery tables: every check's results, with the run's id, are loaded into
+  e.g. validation_results and also written as Parquet (see results_sink.py)
 
 To run from command line navigate to folder. Type: 
 python rr20_service_check.py           
+Per-stage timings, row counts and memory are written to rr20_service_check_metrics.json (see instrumentation.py).
+To also log every agency each check looks at, add --log_level DEBUG (see validation_logging.py).
 '''
 
+# Columns of the service check tables (see check_results.py)
+SERVICE_RESULT_COLUMNS = ["Organization", "name_of_check", "mode", "value_checked", "check_status", "Description"]
 
-def get_bq_data(client, year, tablename):
-    bq_data_query = f"""SELECT * FROM 
-          (select *,
-          RANK() OVER(PARTITION BY Organization_Legal_Name ORDER BY date_uploaded DESC) rank_date 
-        from `cal-itp-data-infra.blackcat_raw.{year}_{tablename}`) s 
-        WHERE rank_date = 1;
-        """
-    
-    df = client.query(bq_data_query).to_dataframe()
-    df = df.drop_duplicates().drop(['rank_date', 'date_uploaded'], axis=1)
-    return df
-
-
-def write_to_log(logfilename):
-    '''
-    Creates a logger object that outputs to a log file, to the filename specified,
-    and also streams to console.
-    '''
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter(f'%(asctime)s:%(levelname)s: %(message)s',
-                                  datefmt='%y-%m-%d %H:%M:%S')
-    file_handler = logging.FileHandler(logfilename)
-    file_handler.setFormatter(formatter)
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
-
-    if not logger.hasHandlers():
-        logger.addHandler(file_handler)
-        logger.addHandler(stream_handler)
 
-    return logger
+def get_arguments():
+    parser = ArgumentParser(description="RR-20 service data checks")
+    results_sink.add_arguments(parser)
+    check_cache.add_arguments(parser)
+    instrumentation.add_arguments(parser, "rr20_service_check")
+    validation_logging.add_arguments(parser)
+    args = parser.parse_args()
+    return args
 
 
 def check_missing_servicedata(df):
@@ -56,7 +46,7 @@ def check_missing_servicedata(df):
     orgs_missing_data = df[mask]['Organization_Legal_Name'].unique()
     orgs_not_missing_data = list(set(agencies) - set(orgs_missing_data))
     
-    output = []
+    output = check_results.new_results(*SERVICE_RESULT_COLUMNS)
     for x in agencies:
         if x in orgs_missing_data:
             result = "fail"
@@ -68,24 +58,74 @@ def check_missing_servicedata(df):
             check_name = "RR20F-179: Missing service data check"
             mode = ""
             description = ""
-        output_line = {"Organization": x,
-                    "name_of_check" : check_name,
-                    "mode": mode,
-                        "value_checked": "Service data columns",
-                        "check_status": result,
-                        "Description": description}
-        output.append(output_line)
-    checks = pd.DataFrame(output).sort_values(by="Organization")
+        check_results.add_result(output, Organization=x, name_of_check=check_name, mode=mode,
+                                 value_checked="Service data columns", check_status=result,
+                                 Description=description)
+    checks = check_results.results_frame(output)
     
     return checks
 
 
+def ratio_result(variable, mode, value_thisyr, value_lastyr, threshold):
+    '''
+    The check status, check name and description of one mode in rr20_ratios(), from its values rounded to 2 decimals
+    (value_lastyr is 0 if the mode has no data last year). Also used by sql_checks.py.
+    '''
+    if (value_lastyr == 0) and (abs(value_thisyr - value_lastyr) >= threshold):
+        result = "fail"
+        check_name = f"{variable}"
+        description = check_results.describe("The {variable} for {mode} has changed from last year by > = {threshold}%, please provide a narrative justification.",
+                                             variable=variable, mode=mode, threshold=threshold*100)
+    elif (value_lastyr != 0) and abs((value_lastyr - value_thisyr)/value_lastyr) >= threshold:
+        result = "fail"
+        check_name = f"{variable}"
+        description = check_results.describe("The {variable} for {mode} has changed from last year by {change}%, please provide a narrative justification.",
+                                             variable=variable, mode=mode,
+                                             change=round(abs((value_lastyr - value_thisyr)/value_lastyr)*100, 1))
+    else:
+        result = "pass"
+        check_name = f"{variable}"
+        description = ""
+    return result, check_name, description
+
+
+def single_number_result(variable, mode, value_thisyr, value_lastyr, threshold=None):
+    '''The check status, check name and description of one mode in check_single_number(), as in ratio_result().'''
+    if (round(value_thisyr)==0 and round(value_lastyr) != 0) | (round(value_thisyr)!=0 and round(value_lastyr) == 0):
+        result = "fail"
+        check_name = f"{variable}"
+        description = check_results.describe("The {variable} for {mode} has changed either from or to zero compared to last year. Please provide a narrative justification.",
+                                             variable=variable, mode=mode)
+    # run only the above check on whether something changed from zero to non-zero, if no threshold is given
+    elif threshold==None:
+        result = "pass"
+        check_name = f"{variable}"
+        description = ""
+    # also check for pct change, if a threshold parameter is passed into function
+    elif (value_lastyr == 0) and (abs(value_thisyr - value_lastyr) >= threshold):
+        result = "fail"
+        check_name = f"{variable}"
+        description = check_results.describe("The {variable} for {mode} was 0 last year and has changed by > = {threshold}%, please provide a narrative justification.",
+                                             variable=variable, mode=mode, threshold=threshold*100)
+    elif (value_lastyr != 0) and abs((value_lastyr - value_thisyr)/value_lastyr) >= threshold:
+        result = "fail"
+        check_name = f"{variable}"
+        description = check_results.describe("The {variable} for {mode} has changed from last year by {change}%; please provide a narrative justification.",
+                                             variable=variable, mode=mode,
+                                             change=round(abs((value_lastyr - value_thisyr)/value_lastyr)*100, 1))
+    else:
+        result = "pass"
+        check_name = f"{variable}"
+        description = ""
+    return result, check_name, description
+
+
 def rr20_ratios(df, variable, threshold, this_year, last_year, logger):
     agencies = df['Organization_Legal_Name'].unique()
-    output = []
+    output = check_results.new_results(*SERVICE_RESULT_COLUMNS)
     for agency in agencies:
         agency_df = df[df['Organization_Legal_Name']==agency]
-        logger.info(f"Checking {agency} for {variable} info.")
+        logger.debug("Checking agency", extra={"agency": agency, "check": variable})
         if len(agency_df) > 0:
             
             # Check whether data for both years is present
@@ -102,44 +142,26 @@ def rr20_ratios(df, variable, threshold, this_year, last_year, logger):
                         value_lastyr = (round(agency_df[(agency_df['Mode']==mode)
                                           & (agency_df['Fiscal_Year'] == last_year)]
                                   [variable].unique()[0], 2))
-                        print(f"Value last yr = {value_lastyr}")
                     
-                    if (value_lastyr == 0) and (abs(value_thisyr - value_lastyr) >= threshold):
-                        result = "fail"
-                        check_name = f"{variable}"
-                        mode = mode
-                        description = (f"The {variable} for {mode} has changed from last year by > = {threshold*100}%, please provide a narrative justification.")
-                    elif (value_lastyr != 0) and abs((value_lastyr - value_thisyr)/value_lastyr) >= threshold:
-                        result = "fail"
-                        check_name = f"{variable}"
-                        mode = mode
-                        description = (f"The {variable} for {mode} has changed from last year by {round(abs((value_lastyr - value_thisyr)/value_lastyr)*100, 1)}%, please provide a narrative justification.")
-                    else:
-                        result = "pass"
-                        check_name = f"{variable}"
-                        mode = mode
-                        description = ""
-
-                    output_line = {"Organization": agency,
-                                   "name_of_check" : check_name,
-                                   "mode": mode,
-                                   "value_checked": f"{this_year} = {value_thisyr}, {last_year} = {value_lastyr}",
-                                   "check_status": result,
-                                   "Description": description}
-                    output.append(output_line)
+                    result, check_name, description = ratio_result(variable, mode, value_thisyr, value_lastyr, threshold)
+
+                    check_results.add_result(output, Organization=agency, name_of_check=check_name, mode=mode,
+                                             value_checked=f"{this_year} = {value_thisyr}, {last_year} = {value_lastyr}",
+                                             check_status=result, Description=description)
         else:
-            logger.info(f"There is no data for {agency}")
-    checks = pd.DataFrame(output).sort_values(by="Organization")
+            logger.debug("There is no data for agency", extra={"agency": agency, "check": variable})
+    checks = check_results.results_frame(output)
+    validation_logging.log_check_summary(logger, variable, checks, agencies)
     return checks
 
 
 def check_single_number(df, variable, this_year, last_year, logger, threshold=None,):
     agencies = df['Organization_Legal_Name'].unique()
-    output = []
+    output = check_results.new_results(*SERVICE_RESULT_COLUMNS)
     for agency in agencies:
 
         if len(df[df['Organization_Legal_Name']==agency]) > 0:
-            logger.info(f"Checking {agency} for {variable} info.")
+            logger.debug("Checking agency", extra={"agency": agency, "check": variable})
             # Check whether data for both years is present, if so perform prior yr comparison.
             if (len(df[(df['Organization_Legal_Name']==agency) & (df['Fiscal_Year']==this_year)]) > 0) \
                 & (len(df[(df['Organization_Legal_Name']==agency) & (df['Fiscal_Year']==last_year)]) > 0): 
@@ -160,181 +182,194 @@ def check_single_number(df, variable, this_year, last_year, logger, threshold=No
                                           & (df['Fiscal_Year'] == last_year)]
                                   [variable].unique()[0], 2))
                     
-                    if (round(value_thisyr)==0 and round(value_lastyr) != 0) | (round(value_thisyr)!=0 and round(value_lastyr) == 0):
-                        result = "fail"
-                        check_name = f"{variable}"
-                        mode = mode
-                        description = (f"The {variable} for {mode} has changed either from or to zero compared to last year. Please provide a narrative justification.")
-                    # run only the above check on whether something changed from zero to non-zero, if no threshold is given
-                    elif threshold==None:
-                        result = "pass"
-                        check_name = f"{variable}"
-                        mode = mode
-                        description = ""
-                        pass
-                    # also check for pct change, if a threshold parameter is passed into function
-                    elif (value_lastyr == 0) and (abs(value_thisyr - value_lastyr) >= threshold):
-                        result = "fail"
-                        check_name = f"{variable}"
-                        mode = mode
-                        description = (f"The {variable} for {mode} was 0 last year and has changed by > = {threshold*100}%, please provide a narrative justification.")
-                    elif (value_lastyr != 0) and abs((value_lastyr - value_thisyr)/value_lastyr) >= threshold:
-                        result = "fail"
-                        check_name = f"{variable}"
-                        mode = mode
-                        description = (f"The {variable} for {mode} has changed from last year by {round(abs((value_lastyr - value_thisyr)/value_lastyr)*100, 1)}%; please provide a narrative justification.")                        
-                    else:
-                        result = "pass"
-                        check_name = f"{variable}"
-                        mode = mode
-                        description = ""
-
-                    output_line = {"Organization": agency,
-                           "name_of_check" : check_name,
-                                   "mode": mode,
-                            "value_checked": f"{this_year} = {value_thisyr}, {last_year} = {value_lastyr}",
-                            "check_status": result,
-                            "Description": description}
-                    output.append(output_line)
+                    result, check_name, description = single_number_result(variable, mode, value_thisyr, value_lastyr,
+                                                                           threshold)
+
+                    check_results.add_result(output, Organization=agency, name_of_check=check_name, mode=mode,
+                                             value_checked=f"{this_year} = {value_thisyr}, {last_year} = {value_lastyr}",
+                                             check_status=result, Description=description)
         else:
-            logger.info(f"There is no data for {agency}")
-    checks = pd.DataFrame(output).sort_values(by="Organization")
+            logger.debug("There is no data for agency", extra={"agency": agency, "check": variable})
+    checks = check_results.results_frame(output)
+    validation_logging.log_check_summary(logger, variable, checks, agencies)
     return checks
 
 
-def main():
-    # Set up the logger object
-    logger = write_to_log('rr20_servicechecks_log.log')
-    this_year=datetime.datetime.now().year
-    last_year = this_year-1
-    this_date=datetime.datetime.now().date().strftime('%Y-%m-%d') #for suffix on various files
 
-    #Load data from BigQuery:
-    # For each org, get the rows with the latest date_uploaded, which is their latest submitted report.
-    client = bigquery.Client()
-    rr20_service = get_bq_data(client, this_year, "rr20_service_data")
-    rr20_exp_by_mode = get_bq_data(client, this_year, "rr20_expenses_by_mode")
-    rr20_fin = get_bq_data(client, this_year, "rr20_financials__2")
-    rr20_fin2 = rr20_fin[['Organization_Legal_Name', 'Common_Name_Acronym_DBA', 'Fiscal_Year', 'Operating_Capital', 'Fare_Revenues']]
-    orgs_q = """SELECT * FROM `cal-itp-data-infra.blackcat_raw.2023_organizations`"""
-    orgs = client.query(orgs_q).to_dataframe().drop_duplicates().drop(['date_uploaded'], axis=1)
-
-    # 2022 data was only uploaded once so has slightly different schema
-    bq_2022_query = f"""SELECT * FROM `cal-itp-data-infra.blackcat_raw.{last_year}_rr20_service_data`"""
-    rr20_service_lastyr = client.query(bq_2022_query).to_dataframe().drop_duplicates()
-    exp_2022_query = f"""SELECT * FROM `cal-itp-data-infra.blackcat_raw.{last_year}_rr20_expenses_by_mode`"""
-    rr20_exp_by_mode_lastyr = client.query(exp_2022_query).to_dataframe().drop_duplicates()
-    fin_2022_query = f"""SELECT * FROM `cal-itp-data-infra.blackcat_raw.{last_year}_rr20_financials__2`"""
-    fin_2022 = client.query(fin_2022_query).to_dataframe().drop_duplicates()
-    
-    # Combine datasets into one, on which to run validation checks. Filter down to only subrecipients.
-    service_exp = (rr20_service.merge(orgs, left_on ='Organization_Legal_Name', right_on = 'Organization', 
-                          indicator=True).query('_merge == "both"').drop(columns=['_merge', 'Organization'])
-                          .merge(rr20_exp_by_mode, on = ['Organization_Legal_Name', 'Common_Name_Acronym_DBA', 'Fiscal_Year', 'Mode']))
-    data = service_exp.merge(rr20_fin2, on =['Organization_Legal_Name', 'Common_Name_Acronym_DBA', 'Fiscal_Year', 'Operating_Capital'],
-                          indicator=True).query('_merge == "both"').drop(columns=['_merge'])
-
-    data_lastyear = (rr20_service_lastyr.merge(orgs, left_on ='Organization_Legal_Name', right_on = 'Organization', 
-                            indicator=True).query('_merge == "both"').drop(columns=['_merge', 'Organization'])
-                            .merge(rr20_exp_by_mode_lastyr, on = ['Organization_Legal_Name', 'Fiscal_Year', 'Mode'])
-                .sort_values(by="Organization_Legal_Name"))
-        
-    # 2022: we use the "Common Name" from the service data, if empty then from the expenses table. If neither empty, still use from the service data
-    data_lastyear['Common_Name_Acronym_DBA'] = data_lastyear['Common_Name_Acronym_DBA_x'].combine_first(data_lastyear['Common_Name_Acronym_DBA_y'])
-    data_lastyear.drop(columns=['Common_Name_Acronym_DBA_x', 'Common_Name_Acronym_DBA_y'], inplace=True)
-    # Add in 2022 Fare Revenue data
-    data_all_lastyear = data_lastyear.merge(fin_2022, on =['Organization_Legal_Name', 'Fiscal_Year', 'Operating_Capital'],
-                          indicator=True).query('_merge == "both"').drop(columns=['_merge'])
-    data_all_lastyear['Common_Name_Acronym_DBA'] = data_all_lastyear['Common_Name_Acronym_DBA_x'].combine_first(data_all_lastyear['Common_Name_Acronym_DBA_y'])
-    data_all_lastyear.drop(columns=['Common_Name_Acronym_DBA_x', 'Common_Name_Acronym_DBA_y'], inplace=True)
-    data_all_lastyear = data_all_lastyear[['Organization_Legal_Name','Common_Name_Acronym_DBA','Fiscal_Year','Mode',
-                                           'Annual_VRM','Annual_VRH','Annual_UPT','Sponsored_UPT','VOMX','Operating_Capital',
-                                           'Total_Annual_Expenses_By_Mode','Fare_Revenues']]
+
+# The service dataset: the service data inner-joined with each of these tables, in order (see data_sources.join_tables()).
+# (table, columns joined on, the table's columns they match (None: the same names), the table's columns to add (None: all))
+SERVICE_JOINS = [
+    ("orgs", ["Organization_Legal_Name"], ["Organization"], []), # only subrecipients
+    ("exp_by_mode", ["Organization_Legal_Name", "Common_Name_Acronym_DBA", "Fiscal_Year", "Mode"], None, None),
+    ("fin", ["Organization_Legal_Name", "Common_Name_Acronym_DBA", "Fiscal_Year", "Operating_Capital"], None,
+     ["Fare_Revenues"]),
+]
+# Last year's tables were only uploaded once so have a slightly different schema. How they map onto SERVICE_JOINS:
+LASTYEAR_SCHEMA = {
+    # Not joined on. We use the "Common Name" from the service data, if empty then from the expenses table,
+    # then from the financials.
+    "coalesce": ["Common_Name_Acronym_DBA"],
+    "sort_before": ("fin", "Organization_Legal_Name"),
+    "columns": ['Organization_Legal_Name', 'Common_Name_Acronym_DBA', 'Fiscal_Year', 'Mode', 'Annual_VRM', 'Annual_VRH',
+                'Annual_UPT', 'Sponsored_UPT', 'VOMX', 'Operating_Capital', 'Total_Annual_Expenses_By_Mode', 'Fare_Revenues'],
+}
+
+
+def service_joins(schema):
+    '''SERVICE_JOINS for tables with the given schema: columns that are coalesced are not joined on, but are added.'''
+    coalesce = schema.get("coalesce", [])
+    return [(table, [key for key in keys if key not in coalesce],
+             [key for key in table_keys if key not in coalesce] if table_keys is not None else None,
+             table_columns + coalesce if table_columns and coalesce else table_columns)
+            for table, keys, table_keys, table_columns in SERVICE_JOINS]
+
+
+def join_service_year(rr20_service, rr20_exp_by_mode, rr20_fin, orgs, uploaded_once=False):
+    '''
+    One year's service dataset: its tables joined with SERVICE_JOINS, or as LASTYEAR_SCHEMA says for a year that was
+    only uploaded once. The tables must share their categories (see data_sources.share_categories()).
+    '''
+    tables = {"service": rr20_service, "orgs": orgs, "exp_by_mode": rr20_exp_by_mode, "fin": rr20_fin}
+    if uploaded_once:
+        return join_tables(tables, service_joins(LASTYEAR_SCHEMA), **LASTYEAR_SCHEMA)
+    return join_tables(tables, SERVICE_JOINS)
+
+
+def combine_service_data(rr20_service, rr20_exp_by_mode, rr20_fin, orgs,
+                         rr20_service_lastyr, rr20_exp_by_mode_lastyr, fin_lastyr):
+    '''
+    Combine datasets into one, on which to run validation checks. Filter down to only subrecipients.
+    Last year's tables were only uploaded once so have a slightly different schema (see LASTYEAR_SCHEMA).
+    '''
+    # The same categories in every table, so the joins below compare integer codes (see data_sources.share_categories())
+    (rr20_service, rr20_exp_by_mode, rr20_fin, orgs, rr20_service_lastyr, rr20_exp_by_mode_lastyr, fin_lastyr) = share_categories(
+        [rr20_service, rr20_exp_by_mode, rr20_fin, orgs, rr20_service_lastyr, rr20_exp_by_mode_lastyr, fin_lastyr],
+        ["Organization_Legal_Name", "Organization"], ["Common_Name_Acronym_DBA"], ["Mode"], ["Operating_Capital"])
+    data = join_service_year(rr20_service, rr20_exp_by_mode, rr20_fin, orgs)
+    data_all_lastyear = join_service_year(rr20_service_lastyr, rr20_exp_by_mode_lastyr, fin_lastyr, orgs, uploaded_once=True)
 
     # Combine 2022 & 2023
     allyears = pd.concat([data, data_all_lastyear], ignore_index = True)
+    return allyears
 
-    # Check for missing data in any of the service data columns. We do this before any other checks...
-    # ... because subsequent ones fill NAs with 0's 
-    missingdata_check = check_missing_servicedata(allyears)
 
-    # Calculate needed ratios, added as new columns
+def calculate_ratios(allyears):
+    '''
+    Calculate needed ratios, added as new columns. Fills NAs with 0's, so run check_missing_servicedata() on
+    the combined data first. Does not modify the frame passed in.
+    '''
+    allyears = allyears.copy()
     numeric_columns = allyears.select_dtypes(include=['number']).columns
     allyears[numeric_columns] = allyears[numeric_columns].fillna(value=0, inplace = False, axis=1)
     
     allyears1 = allyears[allyears['Operating_Capital']=="Operating"]
     # Cost per hr
-    allyears2 = (allyears1.groupby(['Organization_Legal_Name', 'Common_Name_Acronym_DBA','Mode', 'Fiscal_Year'], dropna=False)
+    allyears2 = (allyears1.groupby(group_codes(allyears1, ['Organization_Legal_Name', 'Common_Name_Acronym_DBA','Mode', 'Fiscal_Year']), dropna=False)
                        .apply(lambda x: x.assign(cost_per_hr=x['Total_Annual_Expenses_By_Mode']/ x['Annual_VRH']))
                            .reset_index(drop=True))
     # Miles per vehicle
-    allyears2 = (allyears2.groupby(['Organization_Legal_Name','Common_Name_Acronym_DBA', 'Mode', 'Fiscal_Year'], dropna=False)
+    allyears2 = (allyears2.groupby(group_codes(allyears2, ['Organization_Legal_Name','Common_Name_Acronym_DBA', 'Mode', 'Fiscal_Year']), dropna=False)
                  .apply(lambda x: x.assign(miles_per_veh=lambda x: x['Annual_VRM'].sum() / x['VOMX']))
                  .reset_index(drop=True))
     # Fare revenues
-    allyears2 = (allyears2.groupby(['Organization_Legal_Name','Common_Name_Acronym_DBA', 'Fiscal_Year'], dropna=False)
+    allyears2 = (allyears2.groupby(group_codes(allyears2, ['Organization_Legal_Name','Common_Name_Acronym_DBA', 'Fiscal_Year']), dropna=False)
                  .apply(lambda x: x.assign(fare_rev_per_trip=lambda x: x['Fare_Revenues'].sum() / x['Annual_UPT']))
                  .reset_index(drop=True))
     # Revenue Speed
-    allyears2 = (allyears2.groupby(['Organization_Legal_Name','Common_Name_Acronym_DBA', 'Fiscal_Year'], dropna=False)
+    allyears2 = (allyears2.groupby(group_codes(allyears2, ['Organization_Legal_Name','Common_Name_Acronym_DBA', 'Fiscal_Year']), dropna=False)
                  .apply(lambda x: x.assign(rev_speed=lambda x: x['Annual_VRM'] / x['Annual_VRH']))
                  .reset_index(drop=True))
     # Trips per hr
-    allyears2 = (allyears2.groupby(['Organization_Legal_Name','Common_Name_Acronym_DBA', 'Fiscal_Year'], dropna=False)
+    allyears2 = (allyears2.groupby(group_codes(allyears2, ['Organization_Legal_Name','Common_Name_Acronym_DBA', 'Fiscal_Year']), dropna=False)
                  .apply(lambda x: x.assign(trips_per_hr=lambda x: x['Annual_UPT'] / x['Annual_VRH']))
                  .reset_index(drop=True))
-    
+    return allyears2
+
+
+# The checks run on the ratios table, in report order: (variable, check function, threshold)
+SERVICE_CHECKS = [
+    ('cost_per_hr', rr20_ratios, .30),
+    ('miles_per_veh', rr20_ratios, .20),
+    ('Annual_VRM', check_single_number, .30),
+    ('fare_rev_per_trip', rr20_ratios, .25),
+    ('rev_speed', rr20_ratios, .15),
+    ('trips_per_hr', rr20_ratios, .30),
+    ('VOMX', check_single_number, None),
+]
+
+
+def service_report_sheets(rr20_checks):
+    """The report's sheets, for report_writer.write_report()."""
+    return [
+        {"sheet": "rr20_checks_full", "data": rr20_checks,
+         "subtitle": "Reduced Reporting RR-20: Validation Warnings", "subtitle_cells": "A2:C2",
+         "agency_response": True,
+         "column_widths": [(0, 0, 35), (1, 3, 22), (4, 4, 11), (5, 6, 53)]},
+    ]
+
+
+def write_service_report(rr20_checks, filename):
+    report_writer.write_report(filename, service_report_sheets(rr20_checks))
+
+
+def main():
+    args = get_arguments()
+    # Set up the logger object
+    logger = validation_logging.write_to_log('rr20_servicechecks_log.log', args.log_level)
+    this_year=datetime.datetime.now().year
+    last_year = this_year-1
+    this_date=datetime.datetime.now().date().strftime('%Y-%m-%d') #for suffix on various files
 
-    # Run validation checks
-    cph_checks = rr20_ratios(allyears2, 'cost_per_hr', .30, this_year, last_year, logger)
-    mpv_checks = rr20_ratios(allyears2, 'miles_per_veh', .20, this_year, last_year, logger)
-    vrm_checks = check_single_number(allyears2, 'Annual_VRM', this_year, last_year, logger, threshold=.30)
-    frpt_checks = rr20_ratios(allyears2, 'fare_rev_per_trip', .25, this_year, last_year, logger)
-    rev_speed_checks = rr20_ratios(allyears2, 'rev_speed', .15, this_year, last_year, logger)
-    tph_checks = rr20_ratios(allyears2, 'trips_per_hr', .30, this_year, last_year, logger)
-    voms0_check = check_single_number(allyears2, 'VOMX', this_year, last_year, logger)
-
-    # Combine checks into one table
-    rr20_checks = pd.concat([missingdata_check, cph_checks, mpv_checks, vrm_checks, 
-                             frpt_checks, rev_speed_checks, 
-                             tph_checks, voms0_check], ignore_index=True).sort_values(by="Organization")
-
-    GCS_FILE_PATH_VALIDATED = f"gs://calitp-ntd-report-validation/validation_reports_{this_year}" 
-    with pd.ExcelWriter(f"{GCS_FILE_PATH_VALIDATED}/rr20_service_check_report_{this_date}.xlsx") as writer:
-        rr20_checks.to_excel(writer, sheet_name="rr20_checks_full", index=False, startrow=2)
-
-        workbook = writer.book
-        worksheet = writer.sheets["rr20_checks_full"]
-        cell_highlight = workbook.add_format({
-            'fg_color': 'yellow',
-            'bold': True,
-            'border': 1
-        })
-        report_title = "NTD Data Validation Report"
-        title_format = workbook.add_format({
-                'bold': True,
-                'valign': 'center',
-                'align': 'left',
-                'font_color': '#1c639e',
-                'font_size': 15
-                })
-        subtitle = "Reduced Reporting RR-20: Validation Warnings"
-        subtitle_format = workbook.add_format({
-            'bold': True,
-            'align': 'left',
-            'font_color': 'black',
-            'font_size': 19
-            })
-        
-        worksheet.write('A1', report_title, title_format)
-        worksheet.merge_range('A2:C2', subtitle, subtitle_format)
-        worksheet.write('G3', 'Agency Response', cell_highlight)
-        worksheet.write('H3', 'Response Date', cell_highlight)
-        worksheet.set_column(0, 0, 35) #col A width
-        worksheet.set_column(1, 3, 22) #cols B-D width
-        worksheet.set_column(4, 4, 11) #col D width
-        worksheet.set_column(5, 6, 53) #col E-G width
-        worksheet.freeze_panes('B4')
+    run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("rr20_service_check", this_year=this_year, last_year=last_year, run_id=run_id)
+    timed = functools.partial(instrumentation.timed_call, metrics)
+    memo = functools.partial(check_cache.memoize, cache_dir=args.cache_dir, max_mb=args.cache_max_mb)
+
+    with instrumentation.profiled(args.profile, args.profile_file, "rr20_service_check"):
+        #Load data from BigQuery:
+        # For each org, get the rows with the latest date_uploaded, which is their latest submitted report.
+        client = bigquery.Client()
+        rr20_service = timed("rr20_service", "load", get_bq_data, client, this_year, "rr20_service_data")
+        rr20_exp_by_mode = timed("rr20_exp_by_mode", "load", get_bq_data, client, this_year, "rr20_expenses_by_mode")
+        rr20_fin = timed("rr20_financials", "load", get_bq_data, client, this_year, "rr20_financials__2")
+        orgs = timed("orgs", "load", get_orgs, client)
+
+        # 2022 data was only uploaded once so has slightly different schema
+        rr20_service_lastyr = timed("rr20_service_lastyr", "load", get_bq_table, client, last_year, "rr20_service_data")
+        rr20_exp_by_mode_lastyr = timed("rr20_exp_by_mode_lastyr", "load", get_bq_table, client, last_year, "rr20_expenses_by_mode")
+        fin_2022 = timed("rr20_financials_lastyr", "load", get_bq_table, client, last_year, "rr20_financials__2")
+
+        allyears = timed("service_allyears", "merge", combine_service_data, rr20_service, rr20_exp_by_mode, rr20_fin, orgs,
+                         rr20_service_lastyr, rr20_exp_by_mode_lastyr, fin_2022)
+
+        # Check for missing data in any of the service data columns. We do this before any other checks...
+        # ... because subsequent ones fill NAs with 0's 
+        missingdata_check = timed("service_missing_data", "check", memo(check_missing_servicedata, "service_missing_data"), allyears)
+
+        # Calculate needed ratios, added as new columns
+        allyears2 = timed("service_ratios", "derive", calculate_ratios, allyears)
+
+        # Run validation checks
+        checks = [missingdata_check]
+        for variable, check, threshold in SERVICE_CHECKS:
+            checks.append(timed(f"service_{variable}", "check", memo(check, f"service_{variable}"), allyears2, variable, this_year=this_year,
+                                last_year=last_year, logger=logger, threshold=threshold))
+
+        # Combine checks into one table
+        rr20_checks = timed("rr20_service_checks", "merge", check_results.combine_results, checks)
+
+        GCS_FILE_PATH_VALIDATED = f"gs://calitp-ntd-report-validation/validation_reports_{this_year}" 
+        timed("rr20_service_report", "write", write_service_report, rr20_checks,
+              f"{GCS_FILE_PATH_VALIDATED}/rr20_service_check_report_{this_date}.xlsx")
+
+        # Save every check's results as Parquet and to BigQuery, if asked to
+        if args.results_dir or args.results_table:
+            check_names = ["service_missing_data"] + [f"service_{variable}" for variable, _, _ in SERVICE_CHECKS]
+            timed("results", "write", results_sink.write_results, client, run_id, this_year,
+                  {name: "rr20_service" for name in check_names}, results_dir=args.results_dir,
+                  results_table_id=args.results_table, logger=logger, **dict(zip(check_names, checks)))
+    instrumentation.write_metrics(metrics, args.metrics_file)
 
     logger.info(f"RR-20 service data checks conducted on {this_date} is complete!")
 
@@ -0,0 +1,77 @@
+import ast
+import os
+
+'''Reads the pandera schemas in notebooks/schemas/ into plain python dicts, without importing pandera.
+Used by the synthetic data generator (synthetic_data.py) so the test data follows the same column names,
+dtypes and value ranges as the schemas, and by schema_validation.py to check incoming data against them.
+
+read_schema_spec("a30_vehicles") returns:
+    {"columns": {"VIN": {"dtype": "object", "nullable": False, "unique": True, "checks": []}, ...},
+     "strict": False, "coerce": True}
+where each check is e.g. {"check": "greater_than_or_equal_to", "value": 8.0} or {"check": "eq", "value": "CA"}.
+Checks written as lambdas come back as {"check": "custom", "value": <source code>}.
+'''
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "notebooks", "schemas")
+
+# schema name: (file in notebooks/schemas, name of the DataFrameSchema variable in that file)
+SCHEMA_FILES = {
+    "a10_inferred": ("a10_inferred_schema.py", "schema"),
+    "a30_inferred": ("a30_inferred_schema.py", "schema"),
+    "a30_vehicles": ("a30_vehicles_schema.py", "schema"),
+    "facilities_a10": ("facilities_a10_schema.py", "a10_schema"),
+}
+
+
+def _keywords(call):
+    return {k.arg: k.value for k in call.keywords}
+
+
+def _read_check(node):
+    if not isinstance(node, ast.Call):
+        return {"check": "custom", "value": ast.unparse(node)}
+    func = node.func
+    if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "Check":
+        values = [ast.literal_eval(a) for a in node.args] + [ast.literal_eval(v) for v in _keywords(node).values()]
+        return {"check": func.attr, "value": values[0] if len(values) == 1 else values}
+    return {"check": "custom", "value": ast.unparse(node)}
+
+
+def _read_column(call):
+    keywords = _keywords(call)
+    checks = keywords.get("checks")
+    return {
+        "dtype": ast.literal_eval(keywords["dtype"]) if "dtype" in keywords else None,
+        "nullable": ast.literal_eval(keywords["nullable"]) if "nullable" in keywords else False,
+        "unique": ast.literal_eval(keywords["unique"]) if "unique" in keywords else False,
+        "checks": [_read_check(c) for c in checks.elts] if isinstance(checks, ast.List) else [],
+    }
+
+
+def read_schema_spec(schema_name):
+    filename, variable = SCHEMA_FILES[schema_name]
+    with open(os.path.join(SCHEMA_DIR, filename)) as f:
+        tree = ast.parse(f.read())
+
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == variable for t in node.targets):
+            keywords = _keywords(node.value)
+            columns = {ast.literal_eval(name): _read_column(column)
+                       for name, column in zip(keywords["columns"].keys, keywords["columns"].values)}
+            strict = ast.literal_eval(keywords["strict"]) if "strict" in keywords else False
+            coerce = ast.literal_eval(keywords["coerce"]) if "coerce" in keywords else False
+            return {"columns": columns, "strict": strict, "coerce": coerce}
+    raise ValueError(f"No DataFrameSchema called {variable} in {filename}")
+
+
+def column_range(spec, column):
+    '''Returns (min, max) from a column's greater/less than checks, with None where there is no bound.'''
+    low = high = None
+    for check in spec["columns"][column]["checks"]:
+        if check["check"] in ("greater_than_or_equal_to", "greater_than", "ge", "gt"):
+            low = check["value"]
+        elif check["check"] in ("less_than_or_equal_to", "less_than", "le", "lt"):
+            high = check["value"]
+        elif check["check"] == "in_range":
+            low, high = check["value"][:2]
+    return low, high
@@ -0,0 +1,349 @@
+from argparse import ArgumentParser
+import pandas as pd
+import numpy as np
+import importlib.util
+import functools
+import time
+import os
+
+import schema_specs
+
+'''Checks incoming data against the pandera schemas in notebooks/schemas/, without pandera.
+Each schema is compiled once (see compile_schema()) into arrays of checks, so a table is checked in one vectorized pass:
+- dtype: with coerce (as in every schema), values that can not be converted to the column's dtype are failure cases
+- nullability: one isna() over every non-nullable column
+- uniqueness (e.g. VIN and RVI ID in a30_vehicles): every duplicated value, as pandera's report_duplicates="all".
+  Missing values are not counted as duplicates.
+- ranges: every greater/less than bound of every numeric column compared at once, as one matrix of values
+  against a row of lower bounds and a row of upper bounds (missing values are left to the nullability check)
+- eq / isin / notin checks and checks written as lambdas (run on the whole column, as pandera does)
+- columns in the schema missing from the table, and (for strict schemas) columns not in the schema.
+The schemas' index checks are not run: they are the row numbers of the file each schema was inferred from.
+
+validate() collects every failure case, like pandera's validate(lazy=True), in one table with pandera's columns
+(schema_context, column, check, failure_case, index). With lazy=False it raises a ValueError at the first failed check.
+For very large files, sample=N checks values (dtype, nullability, ranges, eq/isin) on N random rows only; the schema's
+columns and dtypes, uniqueness and lambda checks still use every row, as a sample can not show them.
+
+Used when raw data is loaded (see check_raw_data.py, which checks each sheet with a schema in INGESTION_SCHEMAS).
+To check a file, or to time the compiled checks against pandera (if installed), type e.g.:
+    python schema_validation.py --schema a30_vehicles --file data/A_30_Revenue_Vehicle_Report_9_1_2023.xlsx --sheet "A-30 (Rural) RVI"
+    python schema_validation.py --schema a30_vehicles --file data/A_30_Revenue_Vehicle_Report_9_1_2023.xlsx --sheet "A-30 (Rural) RVI" --benchmark --tile 100
+'''
+
+# Sheets of the BlackCat exports that are checked when they are loaded: sheet name: schema name (see schema_specs.py)
+INGESTION_SCHEMAS = {
+    "A-30 (Rural) RVI": "a30_vehicles",
+}
+FAILURE_COLUMNS = ["schema_context", "column", "check", "failure_case", "index"]
+
+# Bound checks: check name: (side, whether the bound itself passes)
+BOUNDS = {
+    "greater_than_or_equal_to": ("low", True), "ge": ("low", True),
+    "greater_than": ("low", False), "gt": ("low", False),
+    "less_than_or_equal_to": ("high", True), "le": ("high", True),
+    "less_than": ("high", False), "lt": ("high", False),
+}
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Check a file against a schema in notebooks/schemas")
+    parser.add_argument('--schema', choices=schema_specs.SCHEMA_FILES, required=True)
+    parser.add_argument('--file', required=True, help="Excel or CSV file to check")
+    parser.add_argument('--sheet', default=0, help="Sheet of an Excel file")
+    parser.add_argument('--sample', type=int, default=None, help="Only check the values of this many random rows")
+    parser.add_argument('--failures', default=None, help="CSV file to write the failure cases to")
+    parser.add_argument('--benchmark', action='store_true', help="Time the compiled checks (and pandera, if installed)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tile', type=int, default=1, help="Check the file's rows repeated this many times, to time a bigger file")
+    args = parser.parse_args()
+    return args
+
+
+# pandera's names for the checks with short names, as they appear in its failure cases
+CHECK_NAMES = {"eq": "equal_to", "ne": "not_equal_to", "ge": "greater_than_or_equal_to", "gt": "greater_than",
+               "le": "less_than_or_equal_to", "lt": "less_than"}
+
+
+def _label(check, value):
+    return f"{CHECK_NAMES.get(check, check)}({value})"
+
+
+def compile_schema(spec):
+    '''
+    A schema spec (see schema_specs.read_schema_spec()) as the arrays validate() checks a table with: the non-nullable
+    and unique columns, the dtype of each column, and one row each of lower and upper bounds for the numeric columns.
+    '''
+    columns = spec["columns"]
+    bounded = [column for column, column_spec in columns.items()
+               if any(check["check"] in BOUNDS or check["check"] == "in_range" for check in column_spec["checks"])]
+    bounds = {side: np.full(len(bounded), np.inf if side == "high" else -np.inf) for side in ["low", "high"]}
+    inclusive = {side: np.ones(len(bounded), dtype=bool) for side in ["low", "high"]}
+    labels = {side: [None] * len(bounded) for side in ["low", "high"]}
+    value_checks = [] # (column, label, function of a column's non-missing values returning True where they pass)
+    custom_checks = [] # (column, label, function of the whole column)
+    for column, column_spec in columns.items():
+        for check in column_spec["checks"]:
+            name, value = check["check"], check["value"]
+            if name in BOUNDS or name == "in_range":
+                i = bounded.index(column)
+                for side, passes, bound in ([(*BOUNDS[name], value)] if name in BOUNDS else
+                                            [("low", True, value[0]), ("high", True, value[1])]):
+                    bounds[side][i], inclusive[side][i] = bound, passes
+                    labels[side][i] = _label(name, bound if name in BOUNDS else ", ".join(map(str, value)))
+            elif name in ("eq", "equal_to"):
+                value_checks.append((column, _label(name, value), lambda x, value=value: x == value))
+            elif name in ("ne", "not_equal_to"):
+                value_checks.append((column, _label(name, value), lambda x, value=value: x != value))
+            elif name == "isin":
+                value_checks.append((column, _label(name, value), lambda x, value=value: np.isin(x, value)))
+            elif name == "notin":
+                value_checks.append((column, _label(name, value), lambda x, value=value: ~np.isin(x, value)))
+            elif name == "custom":
+                # e.g. Check(lambda x: round(x.sum()) % 1 == 0), from the schema file in this repo
+                custom_checks.append((column, value, eval(value, {"Check": lambda func, **kwargs: func, "np": np})))
+            else:
+                raise ValueError(f"Check {name} of {column} is not supported")
+    return {
+        "columns": list(columns),
+        "dtypes": {column: column_spec["dtype"] for column, column_spec in columns.items()},
+        "not_nullable": [column for column, column_spec in columns.items() if not column_spec["nullable"]],
+        "unique": [column for column, column_spec in columns.items() if column_spec["unique"]],
+        "bounded": bounded, "bounds": bounds, "inclusive": inclusive, "bound_labels": labels,
+        "value_checks": value_checks, "custom_checks": custom_checks,
+        "strict": spec.get("strict", False), "coerce": spec.get("coerce", False),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_schema(schema_name):
+    '''The compiled schema of a schema in notebooks/schemas (see schema_specs.SCHEMA_FILES), compiled once per process.'''
+    return compile_schema(schema_specs.read_schema_spec(schema_name))
+
+
+def _failures(schema_context, column, check, failure_cases, index):
+    return pd.DataFrame({"schema_context": schema_context, "column": column, "check": check,
+                         "failure_case": pd.Series(failure_cases, dtype=object).to_numpy(), "index": index})
+
+
+def _coerce(values, dtype):
+    '''
+    values converted to dtype, and where the conversion failed. Numbers are made ints as pandas' astype() makes them
+    (5.5 becomes 5), and stay floats if there are missing values.
+    '''
+    if dtype not in ("int64", "float64") or str(values.dtype) == dtype:
+        return values, np.zeros(len(values), dtype=bool)
+    numbers = pd.to_numeric(values, errors="coerce") if values.dtype == object else values.astype("float64")
+    failed = (numbers.isna() & values.notna()).to_numpy()
+    if dtype == "int64" and numbers.notna().all():
+        return numbers.astype("int64"), failed
+    return numbers.astype("float64"), failed
+
+
+def _check(df, schema, sample=None, seed=0):
+    '''Yields the failure cases of each failed check, as a table with FAILURE_COLUMNS, in the order they are checked.'''
+    # Columns
+    missing = [column for column in schema["columns"] if column not in df.columns]
+    if missing:
+        yield _failures("DataFrameSchema", None, "column_in_dataframe", missing, None)
+    if schema["strict"]:
+        extra = [column for column in df.columns if column not in schema["dtypes"]]
+        if extra:
+            yield _failures("DataFrameSchema", None, "column_in_schema", extra, None)
+
+    rows = df if sample is None or sample >= len(df) else df.sample(n=sample, random_state=seed)
+    index = rows.index.to_numpy()
+    present = [column for column in schema["columns"] if column in df.columns]
+
+    # Dtypes
+    values = {}
+    for column in present:
+        dtype = schema["dtypes"][column]
+        if dtype is None or str(rows[column].dtype) == dtype:
+            values[column] = rows[column]
+        elif schema["coerce"]:
+            values[column], failed = _coerce(rows[column], dtype)
+            if failed.any():
+                yield _failures("Column", column, f"coerce_dtype('{dtype}')", rows[column].to_numpy()[failed], index[failed])
+        else:
+            values[column] = rows[column]
+            yield _failures("Column", column, f"dtype('{dtype}')", [str(rows[column].dtype)], None)
+
+    # Nullability: one isna() over every non-nullable column
+    not_nullable = [column for column in schema["not_nullable"] if column in values]
+    if not_nullable and len(rows):
+        # On the values as loaded: values that could not be converted are already failure cases
+        nulls = rows[not_nullable].isna().to_numpy()
+        for j in np.flatnonzero(nulls.any(axis=0)):
+            null_rows = np.flatnonzero(nulls[:, j])
+            yield _failures("Column", not_nullable[j], "not_nullable", [None] * len(null_rows), index[null_rows])
+
+    # Uniqueness, on every row
+    for column in schema["unique"]:
+        if column in df.columns:
+            duplicated = (df[column].duplicated(keep=False) & df[column].notna()).to_numpy()
+            if duplicated.any():
+                yield _failures("Column", column, "field_uniqueness", df[column].to_numpy()[duplicated],
+                                df.index.to_numpy()[duplicated])
+
+    # Ranges: every bound of every numeric column at once
+    bounded = [i for i, column in enumerate(schema["bounded"]) if column in values]
+    if bounded and len(rows):
+        matrix = np.column_stack([pd.to_numeric(values[schema["bounded"][i]], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+                                  for i in bounded])
+        for side in ["low", "high"]:
+            bound, inclusive = schema["bounds"][side][bounded], schema["inclusive"][side][bounded]
+            if side == "low":
+                out = np.where(inclusive, matrix < bound, matrix <= bound)
+            else:
+                out = np.where(inclusive, matrix > bound, matrix >= bound)
+            for j in np.flatnonzero(out.any(axis=0)):
+                out_rows = np.flatnonzero(out[:, j])
+                yield _failures("Column", schema["bounded"][bounded[j]], schema["bound_labels"][side][bounded[j]],
+                                matrix[out_rows, j], index[out_rows])
+
+    # Other value checks, on the non-missing values
+    for column, label, check in schema["value_checks"]:
+        if column in values:
+            column_values = values[column]
+            passed = np.asarray(check(column_values.to_numpy()), dtype=bool) | column_values.isna().to_numpy()
+            if not passed.all():
+                yield _failures("Column", column, label, column_values.to_numpy()[~passed], index[~passed])
+
+    # Lambda checks, on the whole column
+    for column, label, check in schema["custom_checks"]:
+        if column in df.columns:
+            result = check(df[column])
+            if isinstance(result, pd.Series):
+                passed = result.fillna(False).to_numpy(dtype=bool)
+                if not passed.all():
+                    yield _failures("Column", column, label, df[column].to_numpy()[~passed], df.index.to_numpy()[~passed])
+            elif not bool(result):
+                yield _failures("Column", column, label, [False], None)
+
+
+def validate(df, schema, lazy=True, sample=None, seed=0):
+    '''
+    Checks df against a schema (a schema name, or a compile_schema() result) and returns every failure case,
+    as a table with FAILURE_COLUMNS (empty if df passes). With lazy=False, raises a ValueError at the first failed check.
+    With sample=N, values are only checked on N random rows (see above).
+    '''
+    schema_name = schema if isinstance(schema, str) else "schema"
+    schema = compiled_schema(schema) if isinstance(schema, str) else schema
+    failures = []
+    for failed in _check(df, schema, sample, seed):
+        if not lazy:
+            raise ValueError(f"{schema_name}: {failed['column'].iloc[0] or 'columns'} failed {failed['check'].iloc[0]} "
+                             f"({len(failed)} failure cases, e.g. {list(failed['failure_case'].head(5))})")
+        failures.append(failed)
+    if not failures:
+        return pd.DataFrame({column: pd.Series(dtype=object) for column in FAILURE_COLUMNS})
+    return pd.concat(failures, ignore_index=True)
+
+
+def summarize(failures):
+    '''Number of failure cases per column and check.'''
+    return (failures.groupby(["column", "check"], dropna=False, sort=False).size().rename("failure_cases").reset_index())
+
+
+def check_ingested_sheet(df, sheet, logger, failures_file=None):
+    '''
+    Checks a sheet of incoming data against its schema in INGESTION_SCHEMAS (if it has one) and logs a summary of
+    the failure cases, which are also written to failures_file (local or gs://) if given. Returns the failure cases,
+    or None if the sheet has no schema.
+    '''
+    schema_name = INGESTION_SCHEMAS.get(sheet)
+    if schema_name is None:
+        return None
+    failures = validate(df, schema_name)
+    if len(failures) == 0:
+        logger.info(f"{sheet} passed the {schema_name} schema checks ({len(df)} rows)",
+                    extra={"sheet": sheet, "schema": schema_name, "rows": len(df)})
+        return failures
+    for _, row in summarize(failures).iterrows():
+        logger.warning(f"{sheet}: {row['failure_cases']} failure cases of {row['check']} in {row['column']}",
+                       extra={"sheet": sheet, "schema": schema_name, "column": row["column"], "check": row["check"],
+                              "failure_cases": int(row["failure_cases"])})
+    if failures_file:
+        failures.to_csv(failures_file, index=False)
+    return failures
+
+
+def pandera_schema(schema_name):
+    '''The pandera DataFrameSchema itself, imported from its file in notebooks/schemas (needs pandera).'''
+    filename, variable = schema_specs.SCHEMA_FILES[schema_name]
+    module_spec = importlib.util.spec_from_file_location(f"schemas_{schema_name}", os.path.join(schema_specs.SCHEMA_DIR, filename))
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    return getattr(module, variable)
+
+
+def _best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def benchmark(df, schema_name, repeat=3, sample=None):
+    '''
+    Best time of repeat runs of the compiled checks (all rows, and sampled if sample is given) and of pandera's
+    validate(lazy=True) on df, with their numbers of failure cases. pandera's entries are None if it is not installed.
+    '''
+    compile_seconds, _ = _best_time(lambda: compile_schema(schema_specs.read_schema_spec(schema_name)), repeat)
+    seconds, failures = _best_time(lambda: validate(df, schema_name), repeat)
+    results = {"schema": schema_name, "rows": len(df), "compile_seconds": round(compile_seconds, 4),
+               "compiled_seconds": round(seconds, 4), "compiled_failure_cases": len(failures)}
+    if sample is not None:
+        sampled_seconds, sampled = _best_time(lambda: validate(df, schema_name, sample=sample), repeat)
+        results.update({"sample": sample, "sampled_seconds": round(sampled_seconds, 4),
+                        "sampled_failure_cases": len(sampled)})
+    try:
+        import pandera
+    except ImportError:
+        results.update({"pandera_seconds": None, "pandera_failure_cases": None})
+        return results
+
+    schema = pandera_schema(schema_name)
+
+    def run_pandera():
+        try:
+            schema.validate(df, lazy=True)
+            return 0
+        except pandera.errors.SchemaErrors as errors:
+            return len(errors.failure_cases)
+    pandera_seconds, pandera_failures = _best_time(run_pandera, repeat)
+    results.update({"pandera_seconds": round(pandera_seconds, 4), "pandera_failure_cases": pandera_failures,
+                    "speedup": round(pandera_seconds / seconds, 1)})
+    return results
+
+
+def main():
+    args = get_arguments()
+    if args.file.endswith(".csv"):
+        df = pd.read_csv(args.file, index_col=0) # as data_sources.load_a10_data() reads the A-10 extracts
+    else:
+        df = pd.read_excel(args.file, sheet_name=args.sheet)
+    if args.tile > 1:
+        df = pd.concat([df] * args.tile, ignore_index=True)
+
+    if args.benchmark:
+        results = benchmark(df, args.schema, repeat=args.repeat, sample=args.sample)
+        for key, value in results.items():
+            print(f"{key}: {value}")
+        if results["pandera_seconds"] is None:
+            print("pandera is not installed (pip install pandera), so only the compiled checks were timed")
+        return
+
+    failures = validate(df, args.schema, sample=args.sample)
+    print(f"{len(df)} rows, {len(failures)} failure cases")
+    if len(failures):
+        print(summarize(failures).to_string(index=False))
+    if args.failures:
+        failures.to_csv(args.failures, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+from argparse import ArgumentParser
+from types import SimpleNamespace
+from google.cloud import bigquery
+import pandas as pd
+import functools
+import datetime
+import time
+import os
+import re
+
+import check_results
+import data_sources
+import partitioned_tables
+import rr20_service_check
+import rr20_financials_check
+import validation_logging
+
+'''SQL pushdown for the year-over-year threshold checks: rr20_ratios, check_single_number (RR-20 service data) and
+financial_checks (RR-20 financials). Each check is compiled into one SQL statement that runs where the data is:
+- BigQuery, on the blackcat_raw tables, in production
+- DuckDB, on a local folder of {year}_{table}.parquet (or .csv) files, e.g. one written by synthetic_data.py,
+  in development and tests (DuckDB must be installed: pip install duckdb).
+The query does what the pandas checks do before they compare values: it takes each organization's latest
+submission, joins and combines the years (as rr20_service_check.combine_service_data() and calculate_ratios(), or
+rr20_financials_check.combine_financial_data() do), and returns one row per result, with that row's value for each year.
+Only those rows come back to Python, where they are rounded and classified by the same functions as the pandas checks
+(ratio_result(), single_number_result(), financial_result()), so the results are the same.
+
+An engine says where the queries run, as a dict that can be passed to worker processes:
+    {"dialect": "bigquery", "project": None}          (see bigquery_engine())
+    {"dialect": "duckdb", "data_dir": "synthetic_1x"} (see local_engine())
+With "partitioned": True, the RR-20 tables are read from the year-partitioned tables (see partitioned_tables.py), each
+year from its own partition.
+The check functions have the same names and keyword arguments as the pandas checks, with engine in place of df:
+    checks = sql_checks.rr20_ratios(engine, variable="cost_per_hr", threshold=.3, this_year=2023, last_year=2022,
+                                    logger=logger)
+
+To run them from validate.py instead of the pandas checks, type:
+    python validate.py --check_engine sql
+To compare them with the pandas checks on synthetic data, type:
+    python equivalence.py --candidate sql --datasets synthetic --scale 10x
+To run them on their own, and save the results as CSV, type e.g.:
+    python sql_checks.py --data_dir synthetic_1x --this_year 2023 --output sql_checks.csv
+
+Where the results can differ from the pandas checks':
+- The rows of one agency can be in another order. The pandas checks list its modes in the order BigQuery returned the
+  service data in, which is not fixed; here they are ordered by Common_Name_Acronym_DBA and mode.
+- When an agency reports the same mode twice in one year, the pandas checks take the value of the first row in their
+  table; the query takes the row with the first Common_Name_Acronym_DBA, and either row if those are the same too.
+- Sums of more than two values can differ in the last bit, which only matters for a value exactly halfway between
+  two rounded values.
+'''
+
+# What differs between the SQL of the engines
+DIALECTS = {
+    "bigquery": {"except": "EXCEPT", "divide": "IEEE_DIVIDE({}, {})"},
+    # Dividing doubles gives inf, -inf or NaN when dividing by 0, as in pandas and IEEE_DIVIDE()
+    "duckdb": {"except": "EXCLUDE", "divide": "CAST({} AS DOUBLE) / {}"},
+}
+
+SERVICE_TABLE = "rr20_service_data"
+EXP_BY_MODE_TABLE = "rr20_expenses_by_mode"
+FINANCIALS_TABLE = "rr20_financials__2"
+ORGS_YEAR, ORGS_TABLE = 2023, "organizations" # as in data_sources.get_orgs()
+
+# Numeric columns of the service dataset (filled with 0 by calculate_ratios()), and the ratios it adds to them
+NUMERIC_COLUMNS = ['Fiscal_Year', 'Annual_VRM', 'Annual_VRH', 'Annual_UPT', 'Sponsored_UPT', 'VOMX',
+                   'Total_Annual_Expenses_By_Mode', 'Fare_Revenues']
+RATIOS = {
+    "cost_per_hr": ("Total_Annual_Expenses_By_Mode", "Annual_VRH"),
+    "miles_per_veh": ("SUM(Annual_VRM) OVER (PARTITION BY Organization_Legal_Name, Common_Name_Acronym_DBA, Mode, Fiscal_Year)",
+                      "VOMX"),
+    "fare_rev_per_trip": ("SUM(Fare_Revenues) OVER (PARTITION BY Organization_Legal_Name, Common_Name_Acronym_DBA, Fiscal_Year)",
+                          "Annual_UPT"),
+    "rev_speed": ("Annual_VRM", "Annual_VRH"),
+    "trips_per_hr": ("Annual_UPT", "Annual_VRH"),
+}
+
+
+def get_arguments(this_year):
+    parser = ArgumentParser(description="Run the RR-20 threshold checks as SQL in BigQuery or DuckDB")
+    parser.add_argument('--this_year', type=int, default=this_year)
+    parser.add_argument('--last_year', type=int, default=None, help="Default: the year before --this_year")
+    parser.add_argument('--data_dir', default=None,
+                        help="Run in DuckDB on the {year}_{table}.parquet/.csv files in this folder, instead of in BigQuery")
+    parser.add_argument('--project', default=None, help="BigQuery project to run the queries in")
+    parser.add_argument('--output', default=None, help="CSV file to save every check's results to")
+    validation_logging.add_arguments(parser)
+    args = parser.parse_args()
+    if args.last_year is None:
+        args.last_year = args.this_year - 1
+    return args
+
+
+def bigquery_engine(project=None, partitioned=False):
+    return {"dialect": "bigquery", "project": project, "partitioned": partitioned}
+
+
+def local_engine(data_dir, partitioned=False):
+    return {"dialect": "duckdb", "data_dir": data_dir, "partitioned": partitioned}
+
+
+def engine_for(client, partitioned=False):
+    '''
+    The engine that queries the same data as client: DuckDB on the folder of a data_sources.LocalBigQueryClient,
+    otherwise BigQuery in the client's project.
+    '''
+    data_dir = getattr(client, "data_dir", None)
+    if data_dir is not None:
+        return local_engine(data_dir, partitioned)
+    return bigquery_engine(getattr(client, "project", None), partitioned)
+
+
+def table_ref(engine, year, table):
+    '''How a query refers to the table {year}_{table}, or to its year in the partitioned table.'''
+    if engine.get("partitioned") and table in partitioned_tables.PARTITIONED_TABLES:
+        year_column = partitioned_tables.YEAR_COLUMN
+        if engine["dialect"] == "bigquery":
+            source = partitioned_tables.table_ref(table)
+        else:
+            pattern = os.path.join(engine["data_dir"], table, "*", "*.parquet").replace("'", "''")
+            source = f"read_parquet('{pattern}', hive_partitioning = true)"
+        return (f"(SELECT * {DIALECTS[engine['dialect']]['except']} ({year_column}) FROM {source} "
+                f"WHERE {year_column} = {int(year)})")
+    if engine["dialect"] == "bigquery":
+        return f"`{data_sources.BQ_RAW_DATASET}.{year}_{table}`"
+    path = os.path.join(engine["data_dir"], f"{year}_{table}")
+    if os.path.exists(f"{path}.parquet"):
+        return "read_parquet('{}')".format(f"{path}.parquet".replace("'", "''"))
+    return "read_csv_auto('{}')".format(f"{path}.csv".replace("'", "''"))
+
+
+def _column(name):
+    if not re.fullmatch(r"\w+", name):
+        raise ValueError(f"Not a column name: {name!r}")
+    return name
+
+
+def latest_submission_sql(engine, year, table, columns=None):
+    '''
+    The rows of each organization's latest submission (the rows with its latest date_uploaded), as in
+    data_sources.get_bq_data(). With columns None, all columns but date_uploaded, without duplicate rows.
+    '''
+    ranked = f"""SELECT {', '.join(columns) if columns else '*'},
+            RANK() OVER(PARTITION BY Organization_Legal_Name ORDER BY date_uploaded DESC) rank_date
+          FROM {table_ref(engine, year, table)}"""
+    if columns:
+        return f"SELECT {', '.join(columns)} FROM ({ranked}) s WHERE rank_date = 1"
+    return f"SELECT DISTINCT * {DIALECTS[engine['dialect']]['except']} (rank_date, date_uploaded) FROM ({ranked}) s WHERE rank_date = 1"
+
+
+def service_ratios_sql(engine, this_year, last_year):
+    '''
+    WITH clauses that end in "ratios": the operating rows of the service dataset with the ratios, as
+    calculate_ratios(combine_service_data(...)) returns them. Tables are joined as in SERVICE_JOINS and LASTYEAR_SCHEMA;
+    a missing Common_Name_Acronym_DBA matches a missing one, as in data_sources.join_tables().
+    '''
+    divide = DIALECTS[engine["dialect"]]["divide"]
+    keys_match = lambda a, b, keys: " AND ".join(
+        f"{a}.{key} IS NOT DISTINCT FROM {b}.{key}" if key == "Common_Name_Acronym_DBA" else f"{a}.{key} = {b}.{key}"
+        for key in keys)
+    exp_columns = ", ".join(f"e.{column}" for column in ["Operating_Capital", "Total_Annual_Expenses_By_Mode"])
+    service_columns = ", ".join(f"s.{column}" for column in ["Fiscal_Year", "Mode", "Annual_VRM", "Annual_VRH", "Annual_UPT",
+                                                            "Sponsored_UPT", "VOMX"])
+    return f"""WITH
+    service AS ({latest_submission_sql(engine, this_year, SERVICE_TABLE)}),
+    exp_by_mode AS ({latest_submission_sql(engine, this_year, EXP_BY_MODE_TABLE)}),
+    fin AS ({latest_submission_sql(engine, this_year, FINANCIALS_TABLE)}),
+    service_lastyr AS (SELECT DISTINCT * FROM {table_ref(engine, last_year, SERVICE_TABLE)}),
+    exp_by_mode_lastyr AS (SELECT DISTINCT * FROM {table_ref(engine, last_year, EXP_BY_MODE_TABLE)}),
+    fin_lastyr AS (SELECT DISTINCT * FROM {table_ref(engine, last_year, FINANCIALS_TABLE)}),
+    orgs AS (SELECT DISTINCT * {DIALECTS[engine['dialect']]['except']} (date_uploaded) FROM {table_ref(engine, ORGS_YEAR, ORGS_TABLE)}),
+    allyears AS (
+        SELECT s.Organization_Legal_Name, s.Common_Name_Acronym_DBA, {service_columns}, {exp_columns}, f.Fare_Revenues
+        FROM service s
+        JOIN orgs o ON s.Organization_Legal_Name = o.Organization
+        JOIN exp_by_mode e ON {keys_match("s", "e", ["Organization_Legal_Name", "Common_Name_Acronym_DBA", "Fiscal_Year", "Mode"])}
+        JOIN fin f ON {keys_match("s", "f", ["Organization_Legal_Name", "Common_Name_Acronym_DBA", "Fiscal_Year"])}
+            AND e.Operating_Capital = f.Operating_Capital
+        UNION ALL
+        SELECT s.Organization_Legal_Name,
+            COALESCE(s.Common_Name_Acronym_DBA, e.Common_Name_Acronym_DBA, f.Common_Name_Acronym_DBA),
+            {service_columns}, {exp_columns}, f.Fare_Revenues
+        FROM service_lastyr s
+        JOIN orgs o ON s.Organization_Legal_Name = o.Organization
+        JOIN exp_by_mode_lastyr e ON {keys_match("s", "e", ["Organization_Legal_Name", "Fiscal_Year", "Mode"])}
+        JOIN fin_lastyr f ON {keys_match("s", "f", ["Organization_Legal_Name", "Fiscal_Year"])}
+            AND e.Operating_Capital = f.Operating_Capital
+    ),
+    operating AS (
+        SELECT Organization_Legal_Name, Common_Name_Acronym_DBA, Mode, Operating_Capital,
+            {', '.join(f'COALESCE({column}, 0) AS {column}' for column in NUMERIC_COLUMNS)}
+        FROM allyears
+        WHERE Operating_Capital = 'Operating'
+    ),
+    ratios AS (
+        SELECT *, {', '.join(f'{divide.format(numerator, denominator)} AS {ratio}'
+                             for ratio, (numerator, denominator) in RATIOS.items())}
+        FROM operating
+    )"""
+
+
+def service_check_sql(engine, variable, this_year, last_year):
+    '''
+    A query with a row for every mode an agency reported this year, for agencies with data for both years:
+    its value of variable this year and last year (value_lastyr is null and has_lastyr false if the mode was not
+    reported last year), and the number of agencies in the dataset.
+    '''
+    if variable not in RATIOS and variable not in NUMERIC_COLUMNS:
+        raise ValueError(f"{variable} is not a column of the service dataset or one of its ratios")
+    return f"""{service_ratios_sql(engine, this_year, last_year)},
+    check_values AS (
+        SELECT Organization_Legal_Name, Common_Name_Acronym_DBA, Mode, Fiscal_Year, {variable} AS value,
+            ROW_NUMBER() OVER (PARTITION BY Organization_Legal_Name, Mode, Fiscal_Year
+                               ORDER BY Common_Name_Acronym_DBA NULLS LAST) AS row_number
+        FROM ratios
+        WHERE Fiscal_Year IN ({int(this_year)}, {int(last_year)})
+    ),
+    both_years AS (
+        SELECT Organization_Legal_Name
+        FROM ratios
+        WHERE Organization_Legal_Name IS NOT NULL
+        GROUP BY Organization_Legal_Name
+        HAVING COUNT(CASE WHEN Fiscal_Year = {int(this_year)} THEN 1 END) > 0
+            AND COUNT(CASE WHEN Fiscal_Year = {int(last_year)} THEN 1 END) > 0
+    )
+    SELECT t.Organization_Legal_Name, t.Common_Name_Acronym_DBA, t.Mode, t.value AS value_thisyr,
+        l.value AS value_lastyr, l.Mode IS NOT NULL AS has_lastyr,
+        (SELECT COUNT(DISTINCT Organization_Legal_Name) FROM ratios) AS n_agencies
+    FROM check_values t
+    JOIN both_years b ON t.Organization_Legal_Name = b.Organization_Legal_Name
+    LEFT JOIN check_values l ON l.Organization_Legal_Name = t.Organization_Legal_Name AND l.Mode = t.Mode
+        AND l.Fiscal_Year = {int(last_year)} AND l.row_number = 1
+    WHERE t.Fiscal_Year = {int(this_year)} AND t.row_number = 1"""
+
+
+def financial_check_sql(engine, variable, this_year, last_year):
+    '''
+    A query with a row for every agency with financials for both years: the sum of the distinct values of variable
+    in each year (missing values count as 0), and the number of agencies with financials this year.
+    '''
+    variable = _column(variable)
+    columns = ["Organization_Legal_Name", "Fiscal_Year", variable]
+    return f"""WITH
+    financials AS (
+        SELECT Organization_Legal_Name, COALESCE(Fiscal_Year, 0) AS Fiscal_Year, COALESCE({variable}, 0) AS value
+        FROM ({latest_submission_sql(engine, this_year, FINANCIALS_TABLE, columns)}) s
+        UNION ALL
+        SELECT Organization_Legal_Name, COALESCE(Fiscal_Year, 0) AS Fiscal_Year, COALESCE({variable}, 0) AS value
+        FROM {table_ref(engine, last_year, FINANCIALS_TABLE)}
+    ),
+    sums AS (
+        SELECT Organization_Legal_Name, Fiscal_Year, SUM(DISTINCT value) AS value
+        FROM financials
+        WHERE Organization_Legal_Name IS NOT NULL AND Fiscal_Year IN ({int(this_year)}, {int(last_year)})
+        GROUP BY Organization_Legal_Name, Fiscal_Year
+    )
+    SELECT t.Organization_Legal_Name, t.value AS value_thisyr, l.value AS value_lastyr,
+        (SELECT COUNT(DISTINCT Organization_Legal_Name) FROM financials WHERE Fiscal_Year = {int(this_year)}) AS n_agencies
+    FROM sums t
+    JOIN sums l ON l.Organization_Legal_Name = t.Organization_Legal_Name AND l.Fiscal_Year = {int(last_year)}
+    WHERE t.Fiscal_Year = {int(this_year)}"""
+
+
+def run_sql(engine, query):
+    '''Runs a query with the engine and returns the result as a dataframe.'''
+    if engine["dialect"] == "bigquery":
+        return data_sources.run_query(bigquery.Client(project=engine.get("project")), query)
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("The duckdb engine needs duckdb: pip install duckdb")
+    connection = duckdb.connect()
+    try:
+        return connection.execute(query).df()
+    finally:
+        connection.close()
+
+
+def _values(column):
+    # numpy scalars, so they round and print as the values in the pandas checks' tables do
+    return list(column.array)
+
+
+def _n_agencies(rows):
+    # Only known from the result rows, so unknown (and left out of the log) if there are none
+    return int(rows["n_agencies"].iloc[0]) if len(rows) > 0 else None
+
+
+def _service_check(engine, variable, this_year, last_year, logger, rule):
+    query = service_check_sql(engine, variable, this_year, last_year)
+    logger.debug("Running query", extra={"check": variable, "query": query})
+    rows = run_sql(engine, query)
+    # By agency, then by mode (see above)
+    rows = rows.sort_values(["Organization_Legal_Name", "Common_Name_Acronym_DBA", "Mode"], kind="mergesort",
+                            na_position="last")
+    output = check_results.new_results(*rr20_service_check.SERVICE_RESULT_COLUMNS)
+    for agency, mode, value_thisyr, value_lastyr, has_lastyr in zip(
+            rows["Organization_Legal_Name"], rows["Mode"], _values(rows["value_thisyr"]), _values(rows["value_lastyr"]),
+            rows["has_lastyr"]):
+        value_thisyr = round(value_thisyr, 2)
+        value_lastyr = round(value_lastyr, 2) if has_lastyr else 0
+        result, check_name, description = rule(variable, mode, value_thisyr, value_lastyr)
+        check_results.add_result(output, Organization=agency, name_of_check=check_name, mode=mode,
+                                 value_checked=f"{this_year} = {value_thisyr}, {last_year} = {value_lastyr}",
+                                 check_status=result, Description=description)
+    checks = check_results.results_frame(output)
+    validation_logging.log_check_summary(logger, variable, checks, _n_agencies(rows))
+    return checks
+
+
+def rr20_ratios(engine, variable, threshold, this_year, last_year, logger):
+    '''rr20_service_check.rr20_ratios(), run in engine.'''
+    return _service_check(engine, variable, this_year, last_year, logger,
+                          functools.partial(rr20_service_check.ratio_result, threshold=threshold))
+
+
+def check_single_number(engine, variable, this_year, last_year, logger, threshold=None):
+    '''rr20_service_check.check_single_number(), run in engine.'''
+    return _service_check(engine, variable, this_year, last_year, logger,
+                          functools.partial(rr20_service_check.single_number_result, threshold=threshold))
+
+
+def financial_checks(engine, variable, this_year, last_year, logger):
+    '''rr20_financials_check.financial_checks(), run in engine.'''
+    query = financial_check_sql(engine, variable, this_year, last_year)
+    logger.debug("Running query", extra={"check": variable, "query": query})
+    rows = run_sql(engine, query)
+    output = check_results.new_results()
+    for agency, value_thisyr, value_lastyr in zip(rows["Organization_Legal_Name"], _values(rows["value_thisyr"]),
+                                                  _values(rows["value_lastyr"])):
+        value_thisyr = round(value_thisyr)
+        value_lastyr = round(value_lastyr)
+        result, check_name, description = rr20_financials_check.financial_result(variable, value_thisyr, value_lastyr,
+                                                                               this_year, last_year)
+        check_results.add_result(output, Organization=agency, name_of_check=check_name,
+                                 value_checked=f"{this_year} = {value_thisyr}, {last_year} = {value_lastyr}",
+                                 check_status=result, Description=description)
+    checks = check_results.results_frame(output)
+    validation_logging.log_check_summary(logger, variable, checks, _n_agencies(rows))
+    return checks
+
+
+# The pandas checks that have a SQL version
+SQL_CHECKS = {
+    rr20_service_check.rr20_ratios: rr20_ratios,
+    rr20_service_check.check_single_number: check_single_number,
+    rr20_financials_check.financial_checks: financial_checks,
+}
+
+
+def pushdown_graph(graph, engine):
+    '''
+    Replaces the check stages of a validate.py graph that have a SQL version with that version, run in engine.
+    They no longer take any input stages. Returns the graph.
+    '''
+    for name, stage in graph.items():
+        if stage["kind"] == "check" and stage["func"] in SQL_CHECKS:
+            graph[name] = {**stage, "func": SQL_CHECKS[stage["func"]], "inputs": {},
+                           "kwargs": {**stage["kwargs"], "engine": engine}}
+    return graph
+
+
+def _ignore_tables(sql_check, engine, df=None, **kwargs):
+    return sql_check(engine, **kwargs)
+
+
+def as_candidate(engine):
+    '''
+    The SQL checks as a candidate engine for equivalence.py: functions with the names and arguments of the pandas
+    checks, which leave out the table they are given and query engine instead.
+    '''
+    return SimpleNamespace(**{check.__name__: functools.partial(_ignore_tables, sql_check, engine)
+                              for check, sql_check in SQL_CHECKS.items()})
+
+
+def main():
+    this_year = datetime.datetime.now().year
+    args = get_arguments(this_year)
+    logger = validation_logging.write_to_log('sql_checks_log.log', args.log_level)
+    engine = local_engine(args.data_dir) if args.data_dir else bigquery_engine(args.project)
+
+    checks = {f"service_{variable}": (SQL_CHECKS[check], {"variable": variable, "threshold": threshold})
+              for variable, check, threshold in rr20_service_check.SERVICE_CHECKS}
+    checks.update({f"financials_{variable}": (financial_checks, {"variable": variable})
+                   for variable in rr20_financials_check.FINANCIAL_VARIABLES})
+    results = {}
+    timings = []
+    for name, (check, kwargs) in checks.items():
+        start = time.perf_counter()
+        results[name] = check(engine, this_year=args.this_year, last_year=args.last_year, logger=logger, **kwargs)
+        timings.append({"check": name, "rows": len(results[name]), "failed": int((results[name]["check_status"] == "fail").sum()),
+                        "seconds": round(time.perf_counter() - start, 3)})
+    logger.info(f"Ran {len(checks)} checks in {engine['dialect']}:\n{pd.DataFrame(timings).to_string(index=False)}")
+
+    if args.output:
+        pd.concat([df.assign(check=name) for name, df in results.items()], ignore_index=True).to_csv(args.output, index=False)
+        logger.info(f"Saved the results to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+import os
+
+import data_sources
+import schema_specs
+
+'''Generates synthetic NTD data for timing the validation checks at sizes larger than the California extracts in data/.
+
+At scale "1x" there are about as many organizations as in the real extracts (90). "10x" and "100x" multiply that,
+and "national" is about as many organizations as report to NTD nationwide (~2,700).
+Produces the same tables the checks read from BigQuery:
+    * {year}_rr20_service_data, {year}_rr20_expenses_by_mode, {year}_rr20_financials__2 for this year and last year
+      (last year's tables have no date_uploaded column, like the 2022 tables loaded with data_to_BQ.py), and for
+      earlier years too with --years (e.g. --years 5 for 2019 to 2023),
+    * {this_year}_inventory_revenue_vehicles, {this_year}_a30_a30_rural_rvi and 2023_organizations,
+and the A-10 extracts for this year and last year, as CSV files like those in data/.
+A-30 and A-10 columns follow the schemas in notebooks/schemas/ (names, dtypes, nullability, uniqueness and ranges).
+There are no schemas for the RR-20 or inventory tables, so those use the column names of the BigQuery tables.
+
+Some agencies get values that should fail a check (big year-over-year changes, zeros, totals that do not match,
+A-30 vehicles missing from the inventory), and some resubmitted this year, so the "latest submission" queries have
+older rows to drop.
+
+To write a dataset to a folder, navigate to folder and type e.g.:
+    python synthetic_data.py --scale 10x --output_dir synthetic_10x
+The folder can be read with LocalBigQueryClient(folder) in place of bigquery.Client(). See benchmark.py.
+'''
+
+BASE_ORGS = 90
+SCALES = {"1x": 1, "10x": 10, "100x": 100, "national": 30}
+ORGS_TABLE = "2023_organizations" # get_orgs() always reads this table
+
+RR20_MODES = ['Demand Response (DR) - (PT)', 'Demand Response (DR) - (DO)', 'Bus (MB) (Fixed Route) - (PT)',
+              'Bus (MB) (Fixed Route) - (DO)', 'Deviated Fixed Route (DF) - (PT)', 'Deviated Fixed Route (DF) - (DO)',
+              'Commuter Bus (CB) - (PT)', 'Commuter Bus (CB) - (DO)', 'Intercity Service (IC) - (DO)',
+              'University Service (US) - (PT)']
+RR20_MODE_SHARES = [.25, .2, .16, .08, .09, .07, .06, .05, .03, .01]
+
+# Funding columns of the RR-20 Financials - 2 sheet, in order. rr20f_001c() adds up everything from
+# Other_Directly_Generated_Funds to the last column.
+FINANCIAL_FUNDING_COLUMNS = [
+    'Other_Directly_Generated_Funds', 'Revenues_Accrued_Through_a_PT_Agreement', 'NonFederal_Funds',
+    'FTA_Metropolitan_Planning_5303', 'FTA_Urbanized_Area_Formula_Program_5307',
+    'FTA_Urbanized_Area_Program_Funds_Capital_Assistance_Spent_on_Operations_5307',
+    'ARRA_Urbanized_Area_Program_Funds_5307',
+    'ARRA_Urbanized_Area_Program_Funds_Capital_Assistance_Spent_on_Operations_5307',
+    'CARES_Act_Urbanized_Area_Program_Funds_5307', 'CRRSA_Act_Urbanized_Area_Program_Funds_5307',
+    'American_Rescue_Plan_Act_of_2021_Urbanized_Area_Program_Funds_5307', 'FTA_Clean_Fuels_Program_5308',
+    'FTA_Capital_Investment_Grants_5309', 'ARRA_Major_Capital_Investment_New_Starts_Funds_5309',
+    'American_Rescue_Plan_Act_of_2021_Fixed_Guideway_Capital_Investment_Grants_5303',
+    'FTA_Enhanced_Mobility_of_Seniors_and_Individuals_with_Disabilities_Formula_Program_5310',
+    'Capital_Assistance_Spent_on_Operations_5310',
+    'CRRSA_Act_Enhanced_Mobility_of_Seniors_and_Individuals_with_Disabilities_Program_Funds_5310',
+    'American_Rescue_Plan_Act_of_2021_Enhanced_Mobility_of_Seniors_and_Individuals_with_Disabilities_Program_Funds_5310',
+    'FTA_Formula_Grants_for_Rural_Areas_5311', 'Capital_Assistance_Spent_on_Operations_5311',
+    'FTA_ARRA_Other_than_Urbanized_Area_Program_Funds_5311',
+    'FTA_ARRA_Capital_Assistance_Spent_on_Operations_including_maintenance_expenses_5311',
+    'FTA_Tribal_Transit_Funds_5321', 'ARRA_Tribal_Transit_Funds_5311', 'CARES_Act_Rural_Area_Program_Funds_5311',
+    'CARES_Act_Public_Transportation_on_Indian_Reservations_Program_Funds_5311',
+    'CRRSA_Act_Rural_Area_Program_Funds_5311',
+    'CRRSA_Act_Public_Transportation_on_Indian_Reservations_Program_Funds_5321',
+    'American_Rescue_Plan_Act_of_2021_Rural_Area_Program_Funds_5311',
+    'American_Rescue_Plan_Act_of_2021_Public_Transportation_on_Indian_Reservations_Program_Funds_5321',
+    'FTA_Job_Access_and_Reverse_Commute_Formula_Program_5316', 'State_of_Good_Repair_5308',
+    'FTA_Bus_and_Bus_Facilities', 'ARRA_TIGGER_Greenhouse_Gas_and_Energy_Reduction', 'Other_FTA_Funds',
+    'Other_USDOT_Funds', 'Other_Federal_Funds']
+# The funding sources rural subrecipients actually use; the rest of the columns are left empty.
+FUNDING_SHARES = {'Other_Directly_Generated_Funds': .2, 'NonFederal_Funds': .3,
+                  'FTA_Formula_Grants_for_Rural_Areas_5311': .4, 'CARES_Act_Rural_Area_Program_Funds_5311': .1}
+
+VEHICLE_TYPES = {'CU - Cutaway Bus': (10, 25), 'BU - Bus': (14, 35), 'VN - Van': (8, 20), 'MV - Minivan': (8, 17)}
+VEHICLE_TYPE_SHARES = [.57, .25, .1, .08]
+VEHICLE_STATUSES = ['Active', 'InActive', 'Disposal Ready', 'Disposed', 'Backup', 'Spare']
+VEHICLE_STATUS_SHARES = [.82, .05, .05, .05, .02, .01]
+OWNERSHIP_TYPES = ['Owned outright by public agency (OOPA)', 'Owned outright by private entity (OOPE)', 'Other']
+FUNDING_SOURCES = ['Section 5311 – Statewide Rural Public Transit', 'State Aid',
+                   'Congestion Mitigation and Air Quality Improvement Program (CMAQ)',
+                   'Section 5310 – Elderly and Persons with Disabilities']
+A30_MODES = ['DR - Demand Response', 'MB - Bus', 'DR - Demand Response,MB - Bus', 'DF - Deviated Fixed Route']
+
+A10_ORGANIZATION_TYPES = ['City, County or Local Government Unit or Department of Transportation',
+                          'Independent Public Agency or Authority of Transit Service',
+                          'MPO, COG or Other Planning Agency', 'Tribe']
+A10_REPORTER_TYPES = ['Full Reporter', 'Reduced Reporter', 'Rural Reporter']
+A10_MODES = ['MB', 'DR', 'CB', 'FB']
+A10_OWNERSHIPS = ['Owned by Public Agency', 'Owned', 'Leased by PT Provider', 'Owned by PT Provider']
+
+
+def get_arguments():
+    parser = ArgumentParser(description="Generate synthetic NTD data")
+    parser.add_argument('--scale', choices=SCALES, default="1x")
+    parser.add_argument('--this_year', type=int, default=2023)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--years', type=int, default=2, help="Number of years of RR-20 tables, up to --this_year")
+    parser.add_argument('--output_dir', default="synthetic_data")
+    args = parser.parse_args()
+    return args
+
+
+def _pick(rng, values, n, p=None):
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size=n, p=p)]
+
+
+def _year_to_year(rng, n, outlier_share=.05, zero_share=.01):
+    '''Multipliers from last year to this year: mostly small changes, some big jumps and some zeros.'''
+    change = rng.lognormal(0, .08, n)
+    outliers = rng.random(n) < outlier_share
+    change[outliers] = rng.uniform(.3, 2.5, outliers.sum())
+    change[rng.random(n) < zero_share] = 0
+    return change
+
+
+def make_orgs(n_orgs):
+    return pd.DataFrame({"Organization": [f"Synthetic Transit Agency {i:05d}" for i in range(1, n_orgs + 1)]})
+
+
+def make_rr20_tables(rng, orgs, this_year, last_year, first_year=None):
+    '''
+    RR-20 Service Data, Expenses By Mode and Financials - 2 for every year from first_year (default: last year) to
+    this year. Returns {year: (service, expenses_by_mode, financials)}.
+    '''
+    first_year = last_year if first_year is None else first_year
+    names = orgs["Organization"].to_numpy()
+    dba = np.where(rng.random(len(names)) < .2, [f"STA {i}" for i in range(len(names))], None)
+
+    # Service data: one row per org and mode, in last year's values
+    n_modes = rng.choice([1, 2, 3], size=len(names), p=[.5, .35, .15])
+    org_index = np.repeat(np.arange(len(names)), n_modes)
+    modes = _pick(rng, RR20_MODES, len(org_index), p=RR20_MODE_SHARES)
+    service = pd.DataFrame({"Organization_Legal_Name": names[org_index], "Common_Name_Acronym_DBA": dba[org_index],
+                            "Mode": modes}).drop_duplicates(["Organization_Legal_Name", "Mode"], ignore_index=True)
+    n = len(service)
+    vrh = np.round(rng.lognormal(8, 1.1, n))
+    service["Annual_VRM"] = np.round(vrh * rng.uniform(12, 30, n))
+    service["Annual_VRH"] = vrh
+    service["Annual_UPT"] = np.round(vrh * rng.uniform(1, 8, n))
+    service["Sponsored_UPT"] = np.round(service["Annual_UPT"] * rng.uniform(0, .3, n) * (rng.random(n) < .6))
+    service["VOMX"] = np.maximum(1, np.round(vrh / 1500)).astype(float)
+    operating = np.round(vrh * rng.uniform(60, 160, n))
+    capital = np.round(operating * rng.uniform(0, .5, n) * (rng.random(n) < .3))
+    fare_share = rng.uniform(.02, .2, len(names))
+
+    def year_tables(rng, year, change):
+        year_service = service.copy()
+        numeric = ["Annual_VRM", "Annual_VRH", "Annual_UPT", "Sponsored_UPT"]
+        year_service[numeric] = np.round(year_service[numeric].to_numpy() * change[:, None])
+        year_service.insert(2, "Fiscal_Year", year)
+
+        # Expenses by mode: an Operating and a Capital row for every mode
+        year_operating = np.round(operating * change * rng.lognormal(0, .05, n))
+        expenses = pd.concat([
+            year_service[["Organization_Legal_Name", "Common_Name_Acronym_DBA", "Fiscal_Year", "Mode"]]
+            .assign(Operating_Capital=kind, Total_Annual_Expenses_By_Mode=amount)
+            for kind, amount in [("Capital", capital), ("Operating", year_operating)]], ignore_index=True)
+        expenses = expenses[["Organization_Legal_Name", "Common_Name_Acronym_DBA", "Fiscal_Year", "Operating_Capital",
+                             "Mode", "Total_Annual_Expenses_By_Mode"]].sort_values(
+                                 ["Organization_Legal_Name", "Mode", "Operating_Capital"], ignore_index=True)
+
+        # Financials: an Operating and a Capital row per org, funded from a few sources
+        totals = (expenses.groupby(["Organization_Legal_Name", "Common_Name_Acronym_DBA", "Fiscal_Year",
+                                    "Operating_Capital"], dropna=False, sort=True)
+                  ["Total_Annual_Expenses_By_Mode"].sum().reset_index()
+                  .rename(columns={"Total_Annual_Expenses_By_Mode": "Total_Annual_Expenses_by_Mode"}))
+        n_rows = len(totals)
+        expense_total = totals["Total_Annual_Expenses_by_Mode"].to_numpy()
+        revenues = expense_total.copy()
+        mismatched = rng.random(n_rows) < .03 # revenues expended should equal expenses
+        revenues[mismatched] = np.round(revenues[mismatched] * rng.uniform(.8, 1.2, mismatched.sum()))
+        totals["Total_Annual_Revenues_Expended"] = revenues.astype("int64")
+        totals["Total_Annual_Expenses_by_Mode"] = expense_total.astype("int64")
+        is_operating = (totals["Operating_Capital"] == "Operating").to_numpy()
+        org_fare_share = pd.Series(fare_share, index=names)[totals["Organization_Legal_Name"]].to_numpy()
+        totals["Fare_Revenues"] = np.where(is_operating, np.round(revenues * org_fare_share), 0.0)
+
+        to_fund = revenues - totals["Fare_Revenues"].to_numpy()
+        unfunded = rng.random(n_rows) < .03 # capital funding should add up to capital expenses
+        to_fund[unfunded] = np.round(to_fund[unfunded] * rng.uniform(.5, .95, unfunded.sum()))
+        funding = {column: np.full(n_rows, np.nan) for column in FINANCIAL_FUNDING_COLUMNS}
+        funded = 0
+        for column, share in FUNDING_SHARES.items():
+            funding[column] = np.round(to_fund * share)
+            funded = funded + funding[column]
+        funding['FTA_Formula_Grants_for_Rural_Areas_5311'] += to_fund - funded # rounding
+        financials = pd.concat([totals, pd.DataFrame(funding)], axis=1)
+        financials = financials[["Organization_Legal_Name", "Common_Name_Acronym_DBA", "Fiscal_Year", "Operating_Capital",
+                                 "Total_Annual_Revenues_Expended", "Total_Annual_Expenses_by_Mode", "Fare_Revenues",
+                                 *FINANCIAL_FUNDING_COLUMNS]]
+        return year_service, expenses, financials
+
+    tables = {}
+    for year, change in [(last_year, np.ones(n)), (this_year, _year_to_year(rng, n))]:
+        tables[year] = year_tables(rng, year, change)
+    # Earlier years, going back from last year, from their own generator (spawning it does not draw from rng), so every
+    # other table is the same however many years there are.
+    if first_year < last_year:
+        history_rng = rng.spawn(1)[0]
+        change = np.ones(n)
+        for year in range(last_year - 1, first_year - 1, -1):
+            change = change / _year_to_year(history_rng, n, zero_share=0)
+            tables[year] = year_tables(history_rng, year, change)
+    return tables
+
+
+def add_resubmissions(rng, df, org_col, resubmitted, upload_date):
+    '''
+    Adds a date_uploaded column. Orgs in resubmitted also get an older, different submission, which
+    the latest-submission queries in data_sources.get_bq_data() should drop.
+    '''
+    df = df.assign(date_uploaded=upload_date)
+    older = df[df[org_col].isin(resubmitted)].copy()
+    older["date_uploaded"] = upload_date - pd.Timedelta(days=14)
+    numeric = older.select_dtypes("float").columns
+    older[numeric] = np.round(older[numeric] * rng.uniform(.5, 1.5, (len(older), len(numeric))))
+    return pd.concat([df, older], ignore_index=True)
+
+
+def make_vehicle_tables(rng, orgs, this_year):
+    '''The revenue vehicle inventory and the A-30 (Rural) Revenue Vehicle Inventory reports.'''
+    names = orgs["Organization"].to_numpy()
+    n_vehicles = rng.poisson(35, len(names)) + 1
+    org_index = np.repeat(np.arange(len(names)), n_vehicles)
+    n = len(org_index)
+    vins = np.array([f"1SYN{i:013d}" for i in range(n)], dtype=object)
+
+    a30_spec = schema_specs.read_schema_spec("a30_inferred")
+    year_low, year_high = schema_specs.column_range(a30_spec, "Year of Manufacture")
+    seats_low, seats_high = schema_specs.column_range(a30_spec, "Seating Capacity")
+    life_low, life_high = schema_specs.column_range(a30_spec, "Useful Life Remaining")
+
+    vehicle_type = _pick(rng, list(VEHICLE_TYPES), n, p=VEHICLE_TYPE_SHARES)
+    service_years = pd.Series(vehicle_type).map({'CU - Cutaway Bus': 10, 'BU - Bus': 14,
+                                                  'VN - Van': 8, 'MV - Minivan': 8}).to_numpy()
+    vehicle_year = rng.integers(int(year_low), min(int(year_high), this_year) + 1, n)
+    seats = np.clip([rng.integers(*VEHICLE_TYPES[t]) for t in vehicle_type], seats_low, seats_high).astype(float)
+    in_service = (pd.to_datetime(pd.Series(vehicle_year + (rng.random(n) < .3)).astype(str) + "-01-01")
+                  + pd.to_timedelta(rng.integers(0, 365, n), unit="D"))
+    ownership = _pick(rng, OWNERSHIP_TYPES, n, p=[.95, .03, .02])
+
+    inventory = pd.DataFrame({
+        "Organization": names[org_index],
+        "VIN": vins,
+        "Funding_Program": _pick(rng, ['Section 5311', 'Section 5310', 'Section 5339'], n),
+        "Total_Cost": np.round(rng.uniform(60000, 450000, n), -2),
+        "Vehicle_Year": vehicle_year,
+        "Seating_Capacity": seats,
+        "Status": _pick(rng, VEHICLE_STATUSES, n, p=VEHICLE_STATUS_SHARES),
+        "In_Service_Date": in_service,
+        "Vehicle_Type": vehicle_type,
+        "Average_Estimated_Service_Years_When_New": service_years.astype(float),
+        "Ownership_Type": ownership,
+    })
+
+    # About half of the orgs file an A-30. It should list their active vehicles; some leave vehicles off,
+    # and some list vehicles that are not active in the inventory.
+    files_a30 = rng.random(len(names)) < .55
+    on_a30 = files_a30[org_index] & (((inventory["Status"] == "Active").to_numpy() & (rng.random(n) < .97))
+                                     | (rng.random(n) < .01))
+    a30 = inventory[on_a30].reset_index(drop=True)
+    m = len(a30)
+    a30_values = {
+        "Organization": a30["Organization"],
+        "Group Plan": np.full(m, np.nan),
+        "VIN": a30["VIN"],
+        "RVI ID": np.where(rng.random(m) < .15, [f"9R{i:08d}" for i in range(m)], None),
+        "ADA Accessible Vehicles (0/No 1/Yes)": _pick(rng, ["Yes", "No"], m, p=[.8, .2]),
+        "Vehicle Type Code": a30["Vehicle_Type"],
+        "Funding Source": _pick(rng, FUNDING_SOURCES, m),
+        "Avg. Estimated Service Years When New": a30["Average_Estimated_Service_Years_When_New"],
+        "Avg. Expected Service Years When New": a30["Average_Estimated_Service_Years_When_New"].astype("int64"),
+        "Year of Manufacture": a30["Vehicle_Year"],
+        "Useful Life Remaining": np.clip(a30["Average_Estimated_Service_Years_When_New"].astype("int64")
+                                         - (this_year - a30["Vehicle_Year"]), life_low, life_high).astype("int64"),
+        "Vehicle Length (ft.)": (a30["Seating_Capacity"] + 8).astype(int).astype(str),
+        "Seating Capacity": a30["Seating_Capacity"],
+        "Ownership Type": a30["Ownership_Type"],
+        "Modes Operated": _pick(rng, A30_MODES, m),
+    }
+    a30 = pd.DataFrame({column: a30_values[column] for column in a30_spec["columns"]})
+    a30 = a30.astype({column: spec["dtype"] for column, spec in a30_spec["columns"].items()})
+    return inventory, a30
+
+
+def make_a10(rng, orgs, this_year, last_year):
+    '''A-10 (stations and maintenance facilities) rows for this year and last year, following facilities_a10_schema.py.'''
+    a10_spec = schema_specs.read_schema_spec("facilities_a10")
+    state = [c["value"] for c in a10_spec["columns"]["State"]["checks"] if c["check"] == "eq"][0]
+    names = orgs["Organization"].to_numpy()
+    n_rows = rng.choice([1, 2, 3], size=len(names), p=[.4, .45, .15])
+    org_index = np.repeat(np.arange(len(names)), n_rows)
+    n = len(org_index)
+
+    base = pd.DataFrame({
+        "Agency": names[org_index],
+        "City": [f"City {i:05d}" for i in org_index],
+        "State": state,
+        "OrganizationType": _pick(rng, A10_ORGANIZATION_TYPES, len(names))[org_index],
+        "ReporterType": _pick(rng, A10_REPORTER_TYPES, len(names))[org_index],
+        "Mode": _pick(rng, A10_MODES, n),
+        "TOS": _pick(rng, ['PT', 'DO'], n, p=[.65, .35]),
+        "ownerships": _pick(rng, A10_OWNERSHIPS, n),
+    })
+    under_200 = rng.poisson(1.5, n).astype(float)
+    over_200 = (rng.poisson(.3, n) * (rng.random(n) < .3)).astype(float)
+    heavy = (rng.random(n) < .15).astype(float)
+    # Shared facilities are split between modes, so some agencies' totals are not whole numbers
+    shared = rng.random(len(names))[org_index] < .05
+    under_200[shared] = under_200[shared] + np.round(rng.uniform(.1, .9, shared.sum()), 2)
+
+    years = []
+    for year, change in [(last_year, np.ones(n)), (this_year, np.round(rng.lognormal(0, .3, n)))]:
+        year_df = base.assign(year=year)
+        year_df["Under200Vehicles"] = np.round(under_200 * change, 2)
+        year_df["200to300Vehicles"] = over_200
+        year_df["Over300Vehicles"] = 0.0
+        year_df["HeavyMaintenanceFacilities"] = heavy
+        year_df["TotalFacilities"] = year_df[["Under200Vehicles", "200to300Vehicles", "Over300Vehicles",
+                                              "HeavyMaintenanceFacilities"]].sum(axis=1).round(2)
+        year_df = year_df[list(a10_spec["columns"])].astype({c: s["dtype"] for c, s in a10_spec["columns"].items()})
+        years.append(year_df)
+    return {last_year: years[0], this_year: years[1]}
+
+
+def generate(scale="1x", this_year=2023, seed=0, n_years=2):
+    '''
+    Returns {"tables": {BigQuery table name: dataframe}, "a10": {year: dataframe}}, with BigQuery-safe
+    column names in the tables (see data_sources.make_name_bq_safe()). The RR-20 tables go back n_years years; the
+    years before this year are like last year (uploaded once, without date_uploaded).
+    '''
+    rng = np.random.default_rng(seed)
+    last_year = this_year - 1
+    orgs = make_orgs(BASE_ORGS * SCALES[scale])
+    upload_date = pd.Timestamp(f"{this_year}-10-01")
+
+    # Some orgs only started reporting this year, and some resubmitted their report
+    new_this_year = orgs["Organization"][rng.random(len(orgs)) < .03]
+    resubmitted = orgs["Organization"][rng.random(len(orgs)) < .1]
+
+    tables = {ORGS_TABLE: orgs.assign(date_uploaded=upload_date)}
+    rr20 = make_rr20_tables(rng, orgs, this_year, last_year, this_year - n_years + 1)
+    for year, year_tables in rr20.items():
+        for name, df in zip(["rr20_service_data", "rr20_expenses_by_mode", "rr20_financials__2"], year_tables):
+            if year == this_year:
+                df = add_resubmissions(rng, df, "Organization_Legal_Name", resubmitted, upload_date)
+            else:
+                df = df[~df["Organization_Legal_Name"].isin(new_this_year)].reset_index(drop=True)
+            tables[f"{year}_{name}"] = df
+
+    inventory, a30 = make_vehicle_tables(rng, orgs, this_year)
+    a30.columns = [data_sources.make_name_bq_safe(c) for c in a30.columns]
+    tables[f"{this_year}_inventory_revenue_vehicles"] = inventory
+    tables[f"{this_year}_a30_a30_rural_rvi"] = add_resubmissions(rng, a30, "Organization", [], upload_date)
+    return {"tables": tables, "a10": make_a10(rng, orgs, this_year, last_year)}
+
+
+def write_synthetic_data(data, output_dir):
+    '''
+    Writes each table to {output_dir}/{table}.parquet and the A-10 extracts to {output_dir}/{year}_a10_synthetic.csv.
+    Returns {year: A-10 file path}.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    for name, df in data["tables"].items():
+        df.to_parquet(os.path.join(output_dir, f"{name}.parquet"), index=False)
+    a10_files = {}
+    for year, df in data["a10"].items():
+        a10_files[year] = os.path.join(output_dir, f"{year}_a10_synthetic.csv")
+        df.to_csv(a10_files[year])
+    return a10_files
+
+
+def main():
+    args = get_arguments()
+    data = generate(args.scale, args.this_year, args.seed, args.years)
+    write_synthetic_data(data, args.output_dir)
+    for name, df in {**data["tables"], **{f"{y}_a10": df for y, df in data["a10"].items()}}.items():
+        print(f"{name}: {len(df)} rows")
+
+if __name__ == "__main__":
+    main()
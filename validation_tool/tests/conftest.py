@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts in validation_tool/ import each other by module name, as they do when run from that folder
+TOOL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOOL_DIR)
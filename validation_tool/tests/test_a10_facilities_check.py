@@ -0,0 +1,50 @@
+import os
+
+import pandas as pd
+import pytest
+
+import a10_facilities_check
+import data_sources
+from conftest import TOOL_DIR
+
+THIS_YEAR_FILE = os.path.join(TOOL_DIR, "data", "2021_a10_submitted_partialdata.csv")
+LAST_YEAR_FILE = os.path.join(TOOL_DIR, "data", "2020_a10_submitted_partialdata.csv")
+GEN_PURPOSE_COLUMNS = ['Under 200 Vehicles', '200 to 300 Vehicles', 'Over 300 Vehicles']
+
+
+@pytest.fixture(scope="module")
+def a10():
+    return data_sources.load_a10_data(THIS_YEAR_FILE, LAST_YEAR_FILE)
+
+
+@pytest.fixture(scope="module")
+def checks(a10):
+    return a10_facilities_check.facility_checks(a10, 2021, 2020)
+
+
+def _gen_purpose(a10, year):
+    rows = a10[a10["year"] == year]
+    return rows.groupby("Agency")[GEN_PURPOSE_COLUMNS].sum().sum(axis=1).round()
+
+
+def test_only_agencies_reporting_this_year_are_checked(a10, checks):
+    assert set(checks["Organization"]) == set(a10[a10["year"] == 2021]["Agency"])
+
+
+def test_gen_purpose_facilities_are_this_years(a10, checks):
+    expected = _gen_purpose(a10, 2021)
+    rows = checks[checks["value_checked"].str.startswith("Gen Purpose Facilities: ")]
+    values = rows["value_checked"].str.removeprefix("Gen Purpose Facilities: ").astype(float)
+    assert (values.to_numpy() == expected.loc[rows["Organization"]].to_numpy()).all()
+
+
+def test_comparison_to_last_year_uses_each_years_total(a10, checks):
+    this_year, last_year = _gen_purpose(a10, 2021), _gen_purpose(a10, 2020)
+    rows = checks[checks["name_of_check"] == "Comparison to last yr: Gen Purpose Facilities"]
+    assert len(rows) > 0
+    expected = pd.Series([f"{this_year[agency]:.0f} in 2021, {last_year[agency]:.0f} in 2020 (Gen Purpose Facilities)"
+                          for agency in rows["Organization"]], index=rows.index)
+    assert (rows["value_checked"].astype(str) == expected).all()
+    failed = rows["check_status"] == "fail"
+    assert (failed.to_numpy() == (this_year.loc[rows["Organization"]].to_numpy()
+                                  != last_year.loc[rows["Organization"]].to_numpy())).all()
@@ -0,0 +1,139 @@
+import gzip
+import json
+import os
+
+import aiohttp
+import pytest
+
+import api_fetch
+import api_standin
+import blackcat_api
+import instrumentation
+from conftest import TOOL_DIR
+
+YEAR_URL = "http://localhost:{port}/api/APIModules/GetNTDReportsByYear/BCG_CA/{{year}}"
+REPORT_URL = "http://localhost:{port}/api/APIModules/GetNTDReport/BCG_CA/{{year}}/{{report_id}}"
+
+
+@pytest.fixture(scope="module")
+def reports():
+    with open(os.path.join(TOOL_DIR, blackcat_api.FIXTURE)) as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def standin(reports):
+    servers = []
+
+    def serve(**kwargs):
+        server = api_standin.start(reports, **kwargs)
+        servers.append(server)
+        return server
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def fetch(requests, cache_dir, **kwargs):
+    '''api_fetch.fetch(), returning its paths and the counters it added.'''
+    with instrumentation.stage_timer(instrumentation.new_run("test"), "fetch", "load") as record:
+        paths = api_fetch.fetch(requests, str(cache_dir), backoff=0, **kwargs)
+    return paths, record
+
+
+def port(server):
+    return server.server_address[1]
+
+
+def report_requests(server, reports):
+    return [api_fetch.report_request(2023, report["ReportId"], blackcat_api.last_modified(report),
+                                     REPORT_URL.format(port=port(server))) for report in reports]
+
+
+def test_at_most_concurrency_requests_are_open(standin, reports, tmp_path):
+    server = standin(latency=0.1)
+    requests = [api_fetch.year_request(year, YEAR_URL.format(port=port(server))) for year in range(2012, 2024)]
+    paths, _ = fetch(requests, tmp_path, concurrency=3)
+
+    assert server.stats["requests"] == len(requests)
+    assert server.stats["max_in_flight"] == 3
+    with gzip.open(paths["year-2015"]) as f:
+        assert [report["ReportPeriod"] for report in json.load(f)] == [2015] * len(reports)
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_failed_requests_are_retried_after_retry_after(standin, reports, tmp_path, monkeypatch, status):
+    server = standin(fail_rate=0.5, seed=1, fail_status=status, retry_after="0")
+    waits = []
+    wait = api_fetch.retry_wait
+
+    def retry_wait(attempt, backoff, retry_after=None):
+        waits.append(retry_after)
+        return wait(attempt, backoff, retry_after)
+
+    monkeypatch.setattr(api_fetch, "retry_wait", retry_wait)
+    paths, record = fetch(report_requests(server, reports), tmp_path, retries=20)
+
+    assert len(paths) == len(reports)
+    assert server.stats["failed"] > 0
+    assert record["retries"] == server.stats["failed"] == len(waits)
+    assert set(waits) == {"0"}
+
+
+def test_retry_wait():
+    assert api_fetch.retry_wait(3, 0.5, "7") == 7.0
+    assert all(0 <= api_fetch.retry_wait(3, 0.5) <= 4 for _ in range(100))
+
+
+def test_other_errors_are_not_retried(standin, tmp_path):
+    server = standin()
+    request = {"url": f"http://localhost:{port(server)}/no/such/path", "name": "missing", "reuse": False}
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        fetch([request], tmp_path, retries=3)
+
+    assert error.value.status == 404
+    assert server.stats["requests"] == 1
+
+
+def test_reports_are_cached_by_id_and_last_modified(standin, reports, tmp_path):
+    server = standin()
+    requests = report_requests(server, reports)
+    first, record = fetch(requests, tmp_path)
+    assert record["cache_misses"] == len(reports)
+    stamp = "".join(character for character in blackcat_api.last_modified(reports[0]) if character.isalnum())
+    assert os.path.basename(first[requests[0]["name"]]) == f"report-{reports[0]['ReportId']}-{stamp}.json.gz"
+
+    modified = api_fetch.report_request(2023, reports[0]["ReportId"], "2024-01-02T15:04:05",
+                                        REPORT_URL.format(port=port(server)))
+    second, record = fetch(requests + [modified], tmp_path)
+    assert second[requests[0]["name"]] == first[requests[0]["name"]]
+    assert record["cache_hits"] == len(reports)
+    assert record["cache_misses"] == 1
+    assert server.stats["requests"] == len(reports) + 1
+
+    # A year's reports change without notice, so they are downloaded every time
+    year = api_fetch.year_request(2023, YEAR_URL.format(port=port(server)))
+    fetch([year], tmp_path)
+    _, record = fetch([year], tmp_path)
+    assert record.get("cache_hits") is None and record["cache_misses"] == 1
+
+
+def test_responses_are_moved_into_place_when_complete(standin, reports, tmp_path):
+    server = standin()
+    paths, _ = fetch(report_requests(server, reports), tmp_path)
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(path) for path in paths.values())
+    for report, path in zip(reports, paths.values()):
+        with gzip.open(path) as f:
+            assert json.load(f)["ReportId"] == report["ReportId"]
+
+
+def test_failed_responses_leave_no_file(standin, reports, tmp_path):
+    server = standin(fail_rate=1.0)
+    requests = report_requests(server, reports[:1])
+    with pytest.raises(aiohttp.ClientResponseError):
+        fetch(requests, tmp_path, retries=2)
+
+    assert os.listdir(tmp_path) == []
+    assert server.stats["requests"] == 3
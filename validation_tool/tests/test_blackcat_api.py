@@ -0,0 +1,112 @@
+import glob
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import blackcat_api
+from conftest import TOOL_DIR
+
+FIXTURE = os.path.join(TOOL_DIR, blackcat_api.FIXTURE)
+
+
+@pytest.fixture
+def reports():
+    with open(FIXTURE) as f:
+        return json.load(f)
+
+
+def write_source(path, reports):
+    with open(path, "w") as f:
+        json.dump(reports, f)
+    return str(path)
+
+
+def test_sync_flattens_every_table(tmp_path, reports):
+    raw_dir = str(tmp_path / "raw")
+    manifest = blackcat_api.sync(FIXTURE, raw_dir, batch_rows=50)
+
+    assert sorted(manifest["new"]) == sorted(report["ReportId"] for report in reports)
+    rural = [row for report in reports for row in report["NTDReportingRR20_Rural"]["Data"]]
+    assert manifest["rows"]["ntdreportingrr20_rural_data"] == len(rural)
+    table = blackcat_api.read_raw_table(raw_dir, "ntdreportingrr20_rural_data")
+    assert len(table) == len(rural)
+    # Nested {"id", "Text", "Value"} values are replaced by their Text
+    modes = blackcat_api.read_raw_table(raw_dir, "ntdreportingp50_data")["Mode"]
+    assert set(modes) == {row["Mode"]["Text"] for report in reports for row in report["NTDReportingP50"]["Data"]}
+    assert list(blackcat_api.read_raw_table(raw_dir, blackcat_api.REPORTS_TABLE).columns) == blackcat_api.REPORT_FIELDS
+
+
+def test_sync_types_columns(tmp_path):
+    raw_dir = str(tmp_path / "raw")
+    blackcat_api.sync(FIXTURE, raw_dir, batch_rows=50)
+
+    table = blackcat_api.read_raw_table(raw_dir, "ntdreportingrr20_rural_data")
+    assert str(table["ReportId"].dtype) == "int64"
+    assert str(table["OperationsExpended"].dtype) == "float64"
+    assert str(table["Item"].dtype) == "object"
+
+
+def test_second_sync_is_idempotent(tmp_path):
+    raw_dir = str(tmp_path / "raw")
+    blackcat_api.sync(FIXTURE, raw_dir, batch_rows=50)
+    first = blackcat_api.read_raw_table(raw_dir, "ntdreportingrr20_rural_data")
+    manifest = blackcat_api.sync(FIXTURE, raw_dir, batch_rows=50)
+
+    assert manifest["new"] == manifest["modified"] == manifest["removed"] == []
+    assert len(manifest["unchanged"]) == manifest["reports"]
+    assert sum(manifest["rows"].values()) == 0
+    assert blackcat_api.read_raw_table(raw_dir, "ntdreportingrr20_rural_data").equals(first)
+    assert len(os.listdir(os.path.join(raw_dir, blackcat_api.MANIFEST_DIR))) == 2
+
+
+def test_watermarks_skip_unchanged_reports(tmp_path, reports):
+    raw_dir = str(tmp_path / "raw")
+    blackcat_api.sync(write_source(tmp_path / "first.json", reports), raw_dir, batch_rows=50)
+    modified, removed = reports[0], reports[-1]
+    modified["ReportLastModifiedDate"] = "1/2/2024 3:04:05 PM"
+    modified["NTDReportingRR20_Rural"]["Data"] = modified["NTDReportingRR20_Rural"]["Data"][:1]
+    manifest = blackcat_api.sync(write_source(tmp_path / "second.json", reports[:-1]), raw_dir, batch_rows=50)
+
+    assert manifest["modified"] == [modified["ReportId"]]
+    assert manifest["removed"] == [removed["ReportId"]]
+    assert len(manifest["unchanged"]) == len(reports) - 2
+    assert manifest["rows"]["ntdreportingrr20_rural_data"] == 1
+    assert manifest["rows"][blackcat_api.REPORTS_TABLE] == 1
+    watermarks = blackcat_api.load_watermarks(raw_dir)
+    assert watermarks[modified["ReportId"]] == {"ReportId": modified["ReportId"],
+                                                "last_modified": "2024-01-02T15:04:05", "run_id": manifest["run_id"]}
+    table = blackcat_api.read_raw_table(raw_dir, "ntdreportingrr20_rural_data")
+    kept = [row for report in reports[1:-1] for row in report["NTDReportingRR20_Rural"]["Data"]]
+    assert len(table) == len(kept) + 1
+    assert (table["ReportId"] == modified["ReportId"]).sum() == 1
+    assert removed["ReportId"] not in set(table["ReportId"])
+
+
+def file_schemas(raw_dir, table):
+    return {str(pq.read_schema(file)) for file in glob.glob(os.path.join(raw_dir, table, "*.parquet"))}
+
+
+def test_every_batch_of_a_table_has_its_types(tmp_path):
+    raw_dir = str(tmp_path / "raw")
+    blackcat_api.sync(FIXTURE, raw_dir, batch_rows=3)
+
+    for table in os.listdir(raw_dir):
+        if not table.startswith("_"):
+            assert len(file_schemas(raw_dir, table)) == 1, table
+
+
+def test_columns_are_widened_across_batches(tmp_path):
+    rows = [{"Id": 1, "Value": None}, {"Id": 2, "Value": 3}, {"Id": 3, "Value": 4.5}, {"Id": 4, "Value": "n/a"}]
+    # One report per row, so each row is a batch of its own
+    reports = [{"ReportId": row["Id"], "ReportLastModifiedDate": "1/2/2024 3:04:05 PM", "Table": {"Data": [row]}}
+               for row in rows]
+    raw_dir = str(tmp_path / "raw")
+    blackcat_api.sync(write_source(tmp_path / "source.json", reports), raw_dir, batch_rows=1)
+
+    assert len(glob.glob(os.path.join(raw_dir, "table_data", "*.parquet"))) == 4
+    assert file_schemas(raw_dir, "table_data") == {str(pa.schema([("Id", pa.int64()), ("Value", pa.string())]))}
+    table = blackcat_api.read_raw_table(raw_dir, "table_data")
+    assert list(table["Value"]) == [None, "3", "4.5", "n/a"]
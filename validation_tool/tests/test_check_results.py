@@ -0,0 +1,35 @@
+import check_results
+
+
+def add(output, agency, status, description):
+    check_results.add_result(output, Organization=agency, name_of_check="check", value_checked="",
+                             check_status=status, Description=description)
+
+
+def test_descriptions_are_filled_in_once_per_template_and_values():
+    output = check_results.new_results()
+    template = "The {variable} for {mode} has changed from last year by {change}%, please provide a narrative justification."
+    for agency in ["B", "A", "C"]:
+        add(output, agency, "fail", check_results.describe(template, variable="VRM", mode="MB", change=12.5))
+    add(output, "D", "pass", "")
+    checks = check_results.results_frame(output)
+
+    assert list(checks["Organization"]) == ["A", "B", "C", "D"]
+    variable, mode, change = "VRM", "MB", 12.5
+    assert list(checks["Description"])[:3] == [f"The {variable} for {mode} has changed from last year by {change}%, "
+                                               "please provide a narrative justification."] * 3
+    assert list(checks["Description"].cat.categories) == ["", checks["Description"].iloc[0]]
+
+
+def test_combine_results_merges_sorted_tables_without_reordering_them():
+    first, second = check_results.new_results(), check_results.new_results()
+    for agency, status in [("A", "fail"), ("A", "pass"), ("C", "pass")]:
+        add(first, agency, status, "")
+    for agency, status in [("A", "warn"), ("B", "pass")]:
+        add(second, agency, status, "")
+    combined = check_results.combine_results([check_results.results_frame(first, sort_by=None),
+                                              check_results.results_frame(second, sort_by=None)])
+
+    assert list(zip(combined["Organization"], combined["check_status"])) == [
+        ("A", "fail"), ("A", "pass"), ("A", "warn"), ("B", "pass"), ("C", "pass")]
+    assert str(combined["check_status"].dtype) == "category"
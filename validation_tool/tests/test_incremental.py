@@ -0,0 +1,43 @@
+import pandas as pd
+
+import check_cache
+import check_results
+import incremental
+
+DATA = pd.DataFrame({"Organization_Legal_Name": ["A", "B"], "value": [1, 2]})
+# What count_check() names its rows, and the organizations it was called with; a test changes the name to stand in
+# for a change to the check's logic
+CHECK = {"name": "count", "calls": []}
+
+
+def count_check(df):
+    CHECK["calls"].append(sorted(df["Organization_Legal_Name"].unique()))
+    output = check_results.new_results()
+    for agency, rows in df.groupby("Organization_Legal_Name", sort=True):
+        check_results.add_result(output, Organization=agency, name_of_check=CHECK["name"], value_checked=str(len(rows)),
+                                 check_status="pass", Description="")
+    return check_results.results_frame(output)
+
+
+def run(state_dir):
+    return incremental.incremental_check("count", count_check, str(state_dir), df=DATA,
+                                         df_fingerprint=incremental.fingerprint(DATA))
+
+
+def test_unchanged_orgs_reuse_saved_results(tmp_path, monkeypatch):
+    monkeypatch.setitem(CHECK, "calls", [])
+    run(tmp_path)
+    rerun = run(tmp_path)
+    assert CHECK["calls"] == [["A", "B"]]
+    assert list(rerun["Organization"]) == ["A", "B"]
+
+
+def test_changed_check_code_runs_every_org_again(tmp_path, monkeypatch):
+    monkeypatch.setitem(CHECK, "calls", [])
+    run(tmp_path)
+    # New logic in the check's module gives it another code version, so the saved results are not reused
+    monkeypatch.setitem(CHECK, "name", "new logic")
+    monkeypatch.setattr(check_cache, "code_version", lambda func: "changed")
+    rerun = run(tmp_path)
+    assert CHECK["calls"] == [["A", "B"], ["A", "B"]]
+    assert list(rerun["name_of_check"].astype(str)) == ["new logic", "new logic"]
@@ -0,0 +1,56 @@
+import os
+
+import pyarrow.parquet as pq
+import pytest
+
+import check_cache
+import data_sources
+import instrumentation
+import partitioned_tables
+import synthetic_data
+import trend_checks
+
+YEARS = [2021, 2022, 2023]
+
+
+@pytest.fixture
+def client(tmp_path):
+    data_dir = str(tmp_path / "data")
+    synthetic_data.write_synthetic_data(synthetic_data.generate("1x", 2023, 0, len(YEARS)), data_dir)
+    for table in partitioned_tables.PARTITIONED_TABLES:
+        partitioned_tables.migrate_local(data_dir, table, YEARS)
+    return data_sources.LocalBigQueryClient(data_dir)
+
+
+def collect(client, state_dir):
+    '''The metric values of YEARS, and the years whose values were computed rather than reused.'''
+    with instrumentation.stage_timer(instrumentation.new_run("test"), "values", "load") as record:
+        values = trend_checks.collect_values(client, YEARS, 2023, str(state_dir))
+    return values, record.get("years_computed")
+
+
+def test_saved_years_are_reused(client, tmp_path):
+    first, computed = collect(client, tmp_path / "state")
+    assert computed == 3
+    second, computed = collect(client, tmp_path / "state")
+    assert computed == 1 # this year
+    assert second.equals(first)
+
+
+def test_changed_year_is_computed_again(client, tmp_path):
+    collect(client, tmp_path / "state")
+    # 2022 copied into the partitioned table again, with one row less
+    path = os.path.join(client.data_dir, "rr20_service_data", f"{partitioned_tables.YEAR_COLUMN}=2022", "part-0.parquet")
+    table = pq.read_table(path)
+    pq.write_table(table.slice(1), path)
+
+    values, computed = collect(client, tmp_path / "state")
+    assert computed == 2
+    assert values.equals(trend_checks.collect_values(client, YEARS, 2023))
+
+
+def test_changed_code_computes_every_year_again(client, tmp_path, monkeypatch):
+    collect(client, tmp_path / "state")
+    monkeypatch.setattr(check_cache, "code_version", lambda func: "changed")
+    _, computed = collect(client, tmp_path / "state")
+    assert computed == 3
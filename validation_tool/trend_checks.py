@@ -0,0 +1,388 @@
+from argparse import ArgumentParser
+from numpy.lib.stride_tricks import sliding_window_view
+from google.cloud import bigquery
+from data_sources import share_categories
+import pandas as pd
+import numpy as np
+import datetime
+import warnings
+import hashlib
+import fsspec
+import json
+
+import check_cache
+import check_results
+import data_sources
+import instrumentation
+import partitioned_tables
+import report_writer
+import results_sink
+import rr20_financials_check
+import rr20_service_check
+import validation_logging
+
+'''Multi-year trend checks on the RR-20: each agency's metrics this year against its own last --window years, instead
+of last year alone. A one-year check fails a bus service that dips one year and recovers the next twice; here:
+- "{metric}: {window}-year median" compares this year's value with the median of the window's years (at least
+  MIN_BASELINE_YEARS of them reported), with the metric's threshold in the one-year checks (SERVICE_CHECKS, or
+  DEFAULT_THRESHOLD), as rr20_service_check.ratio_result() compares it with last year's
+- "{metric}: growth" flags a compound annual growth rate (CAGR), from the first year of the window the agency
+  reported to this year, of CAGR_THRESHOLD or more either way: a slow, steady drift that no single year shows.
+The metrics are the service ratios and numbers of rr20_service_check.SERVICE_CHECKS (per organization and mode, the
+first row of a year, as rr20_ratios() takes it) and the financial variables of rr20_financials_check (per organization,
+the sum of the distinct values of a year, as financial_checks() takes it).
+
+Every year's metric values are one long table (organization, mode, metric, year, value). For the checks it is pivoted
+to one row per organization, mode and metric and one column per year, and the window of every year is a view of that
+array (numpy's sliding_window_view()), so the medians and growth rates of every year are computed at once, without
+a loop over agencies or years.
+A year's values only change while it is being reported, so they can be saved in a --state_dir (values/{year}.parquet).
+A run then reads the saved values of the earlier years, and only loads (from the year-partitioned tables, see
+partitioned_tables.py, in one query per table) and computes this year and any earlier year that is not saved yet.
+When next year's data arrives, only that year is loaded. Without --state_dir nothing is saved and every year of the
+window is loaded; scheduled runs pass STATE_DIR below. The trend results themselves are not kept as state: they are
+written to the report, and with --results_dir or --results_table to the results sink (see results_sink.py).
+Each year's values are saved with their version (values/{year}.json): a hash of the number of rows and the latest
+date_uploaded of the year in each RR-20 table, and of the code that computes the values (see values_versions()).
+Saved values whose version differs, after a late resubmission, a year copied into the partitioned tables again, or a
+change to the metrics (TREND_METRICS, SERVICE_CHECKS) or to how they are computed (e.g. calculate_ratios()), are
+computed again.
+
+To run from command line, navigate to folder and type e.g.:
+    python trend_checks.py --this_year 2023 --window 5 --state_dir gs://calitp-ntd-report-validation/trend_state
+To run it on synthetic data (written with synthetic_data.py --years 6, then partitioned_tables.py --data_dir), type e.g.:
+    python trend_checks.py --data_dir synthetic_1x --state_dir trend_state --output_dir reports
+and --full_run computes every year again.
+'''
+
+WINDOW = 5 # years before this one
+MIN_BASELINE_YEARS = 2 # years of the window an agency must have reported for a median
+CAGR_THRESHOLD = .15
+DEFAULT_THRESHOLD = .30 # for metrics without a threshold in the one-year checks
+STATE_DIR = "gs://calitp-ntd-report-validation/trend_state"
+OUTPUT_DIR = "gs://calitp-ntd-report-validation/validation_reports_{year}"
+VALUE_COLUMNS = ["Organization", "mode", "metric", "Fiscal_Year", "value"]
+TREND_RESULT_COLUMNS = rr20_service_check.SERVICE_RESULT_COLUMNS + ["Fiscal_Year"]
+
+# The RR-20 tables the metrics are computed from: {name: partitioned table}
+TABLES = {"service": "rr20_service_data", "exp_by_mode": "rr20_expenses_by_mode", "fin": "rr20_financials__2"}
+# The functions the metric values depend on, other than those in this file (see values_versions())
+VALUES_CODE = [rr20_service_check.calculate_ratios, rr20_financials_check.financial_checks,
+               partitioned_tables.year_rows, data_sources.apply_dtypes]
+
+# The metrics followed over the years: {metric: (the table it comes from, threshold of the change from the median)}
+TREND_METRICS = {
+    **{variable: ("service", threshold if threshold is not None else DEFAULT_THRESHOLD)
+       for variable, _, threshold in rr20_service_check.SERVICE_CHECKS},
+    **{variable: ("financials", DEFAULT_THRESHOLD) for variable in rr20_financials_check.FINANCIAL_VARIABLES},
+}
+
+
+def get_arguments(this_year):
+    parser = ArgumentParser(description="RR-20 multi-year trend checks")
+    parser.add_argument('--this_year', type=int, default=this_year)
+    parser.add_argument('--window', type=int, default=WINDOW, help="Number of earlier years to compare each year with")
+    parser.add_argument('--state_dir', default=None,
+                        help=f"Folder (local or gs://) to keep each year's metric values in, e.g. "
+                             f"{STATE_DIR}; default: nothing is kept")
+    parser.add_argument('--full_run', action='store_true', help="Compute every year's metric values again")
+    parser.add_argument('--data_dir', default=None,
+                        help="Read the partitioned tables from this local folder (see synthetic_data.py), not BigQuery")
+    parser.add_argument('--output_dir', default=None,
+                        help=f"Folder (local or gs://) to write the reports to; default: {OUTPUT_DIR} for --this_year")
+    results_sink.add_arguments(parser)
+    instrumentation.add_arguments(parser, "trend_checks")
+    validation_logging.add_arguments(parser)
+    args = parser.parse_args()
+    args.output_dir = args.output_dir or OUTPUT_DIR.format(year=args.this_year)
+    return args
+
+
+def load_years(client, years):
+    '''
+    The RR-20 tables of years, from the year-partitioned tables, in one query per table.
+    Returns {year: {"service", "exp_by_mode", "fin": that year's rows (see partitioned_tables.year_rows())}}.
+    '''
+    loaded = {name: partitioned_tables.get_years(client, tablename, years) for name, tablename in TABLES.items()}
+    return {year: {name: partitioned_tables.year_rows(df, year) for name, df in loaded.items()} for year in years}
+
+
+def _long_values(df, org_column, mode_column, metrics):
+    '''The metric columns of df (one row per organization, mode and year) as rows of VALUE_COLUMNS.'''
+    frames = [pd.DataFrame({"Organization": df[org_column].astype(str).to_numpy(),
+                            "mode": df[mode_column].astype(str).to_numpy() if mode_column else "",
+                            "metric": metric, "Fiscal_Year": df["Fiscal_Year"].astype("int64").to_numpy(),
+                            "value": df[metric].astype(float).to_numpy()}) for metric in metrics]
+    return pd.concat(frames, ignore_index=True)
+
+
+def service_values(service, exp_by_mode, fin, orgs, year):
+    '''
+    One year's service metrics, as rows of VALUE_COLUMNS: the service dataset of rr20_service_check (the year's tables
+    joined as combine_service_data() joins them), with its ratios, and the first row of each organization and mode.
+    '''
+    service, exp_by_mode, fin, orgs = share_categories(
+        [service, exp_by_mode, fin, orgs],
+        ["Organization_Legal_Name", "Organization"], ["Common_Name_Acronym_DBA"], ["Mode"], ["Operating_Capital"])
+    data = rr20_service_check.join_service_year(service, exp_by_mode, fin, orgs,
+                                                uploaded_once=partitioned_tables.uploaded_once("rr20_service_data", year))
+    ratios = rr20_service_check.calculate_ratios(data)
+    first = ratios.drop_duplicates(["Organization_Legal_Name", "Mode", "Fiscal_Year"])
+    metrics = [metric for metric, (source, _) in TREND_METRICS.items() if source == "service"]
+    return _long_values(first, "Organization_Legal_Name", "Mode", metrics)
+
+
+def financial_values(fin):
+    '''
+    One year's financial metrics, as rows of VALUE_COLUMNS (mode ""): per organization, the sum of the distinct values
+    of each variable, rounded, as rr20_financials_check.financial_checks() takes it.
+    '''
+    fin = fin.copy()
+    numeric_columns = fin.select_dtypes(include=['number']).columns
+    fin[numeric_columns] = fin[numeric_columns].fillna(0)
+    keys = ["Organization_Legal_Name", "Fiscal_Year"]
+    metrics = [metric for metric, (source, _) in TREND_METRICS.items() if source == "financials"]
+    sums = pd.concat([fin.drop_duplicates(keys + [metric]).groupby(keys, observed=True, sort=False)[metric].sum().round()
+                      for metric in metrics], axis=1).reset_index()
+    return _long_values(sums, "Organization_Legal_Name", None, metrics)
+
+
+def year_values(tables, orgs, year):
+    '''Every metric of one year (tables as load_years() returns them), as rows of VALUE_COLUMNS.'''
+    return pd.concat([service_values(tables["service"], tables["exp_by_mode"], tables["fin"], orgs, year),
+                      financial_values(tables["fin"])], ignore_index=True)
+
+
+def values_file(state_dir, year):
+    return f"{state_dir}/values/{year}.parquet"
+
+
+def version_file(state_dir, year):
+    return f"{state_dir}/values/{year}.json"
+
+
+def _exists(path):
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    return fs.exists(fs_path)
+
+
+def _read_version(path):
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    if not fs.exists(fs_path):
+        return None
+    with fs.open(fs_path, "r") as f:
+        return json.load(f)["version"]
+
+
+def _write_version(version, path):
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    with fs.open(f"{fs_path}.tmp", "w") as f:
+        json.dump({"version": version}, f)
+    fs.mv(f"{fs_path}.tmp", fs_path)
+
+
+def values_versions(client, years):
+    '''
+    The version of each year's metric values ({year: hash}): of the year's rows and latest date_uploaded in each of
+    TABLES (see partitioned_tables.year_versions()), in one small query per table, and of the code that computes them
+    (see check_cache.code_version()): this file, and the modules of VALUES_CODE.
+    '''
+    data = {name: partitioned_tables.year_versions(client, tablename, years) for name, tablename in TABLES.items()}
+    code = [check_cache.code_version(func) for func in [year_values] + VALUES_CODE]
+    return {year: hashlib.sha256(json.dumps({"data": {name: versions.get(year) for name, versions in data.items()},
+                                             "code": code}, sort_keys=True).encode()).hexdigest()
+            for year in years}
+
+
+def _write_parquet(df, path):
+    # Write to a temporary file and move it into place, as incremental.save_state() does
+    fs, fs_path = fsspec.core.url_to_fs(path)
+    fs.makedirs(fs_path.rsplit("/", 1)[0], exist_ok=True)
+    with fs.open(f"{fs_path}.tmp", "wb") as f:
+        df.to_parquet(f, index=False)
+    fs.mv(f"{fs_path}.tmp", fs_path)
+
+
+def collect_values(client, years, this_year, state_dir=None, full_run=False, logger=None):
+    '''
+    The metric values of years, as rows of VALUE_COLUMNS. The saved values of years before this_year are reused if
+    their version is the same (see values_versions()); this year and every other year are loaded in one query per
+    table, computed and saved.
+    '''
+    versions = values_versions(client, years) if state_dir else {}
+    saved = {}
+    stale = []
+    if state_dir and not full_run:
+        for year in years:
+            if year < this_year and _exists(values_file(state_dir, year)):
+                if _read_version(version_file(state_dir, year)) == versions[year]:
+                    saved[year] = pd.read_parquet(values_file(state_dir, year))
+                else:
+                    stale.append(year)
+    missing = [year for year in years if year not in saved]
+    if missing:
+        orgs = data_sources.get_orgs(client)
+        for year, tables in load_years(client, missing).items():
+            saved[year] = year_values(tables, orgs, year)
+            if state_dir:
+                _write_parquet(saved[year], values_file(state_dir, year))
+                _write_version(versions[year], version_file(state_dir, year))
+    if logger is not None:
+        logger.info(f"Metric values of {len(years)} years: {len(years) - len(missing)} reused, "
+                    f"{', '.join(map(str, missing)) or 'none'} computed"
+                    + (f" ({', '.join(map(str, stale))} changed since saved)" if stale else ""),
+                    extra={"years": years, "computed": missing, "changed": stale})
+    instrumentation.add_count("years_reused", len(years) - len(missing))
+    instrumentation.add_count("years_computed", len(missing))
+    return pd.concat([saved[year] for year in years], ignore_index=True)
+
+
+def trend_arrays(values, years, window=WINDOW, min_years=MIN_BASELINE_YEARS):
+    '''
+    The windows of every year in years, from values (rows of VALUE_COLUMNS, with the window's years before the first
+    of years). Returns the (organization, mode, metric) keys and {name: array of keys x years}: "value" (nan where not
+    reported), "median" of the window (nan with fewer than min_years reported), "first" (the window's first reported
+    value), "first_year" and "cagr" (nan where it cannot be computed: fewer than min_years, or a value <= 0).
+    '''
+    wide = values.pivot_table(index=["Organization", "mode", "metric"], columns="Fiscal_Year", values="value",
+                              aggfunc="first")
+    wide = wide.reindex(columns=range(min(years) - window, max(years) + 1))
+    matrix = wide.to_numpy(dtype=float)
+    # windows[:, i] is the window of the year in column i + window
+    windows = sliding_window_view(matrix[:, :-1], window, axis=1)
+    current = matrix[:, window:]
+    reported = ~np.isnan(windows)
+    enough = reported.sum(axis=2) >= min_years
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning) # windows with nothing reported
+        median = np.where(enough, np.nanmedian(windows, axis=2), np.nan)
+    first_index = reported.argmax(axis=2)
+    first = np.take_along_axis(windows, first_index[..., None], axis=2)[..., 0]
+    first_year = np.asarray(wide.columns)[:-1][np.arange(windows.shape[1])[None, :] + first_index]
+    span = window - first_index
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cagr = np.where(enough & (first > 0) & (current > 0), (current / first) ** (1 / span) - 1, np.nan)
+    columns = [list(wide.columns).index(year) - window for year in years]
+    arrays = {"value": current, "median": median, "first": first, "first_year": first_year, "cagr": cagr}
+    return wide.index.to_frame(index=False), {name: array[:, columns] for name, array in arrays.items()}
+
+
+def _for_mode(mode):
+    return f" for {mode}" if mode else ""
+
+
+def median_result(metric, mode, value, median, threshold, window):
+    '''The check status and description of one median row, as rr20_service_check.ratio_result() with the median for last year.'''
+    if (median == 0) and (abs(value - median) >= threshold):
+        return "fail", check_results.describe("The {metric}{for_mode} has changed from a median of 0 over the last "
+                                              "{window} years, please provide a narrative justification.",
+                                              metric=metric, for_mode=_for_mode(mode), window=window)
+    if (median != 0) and abs((median - value)/median) >= threshold:
+        return "fail", check_results.describe("The {metric}{for_mode} is {change}% from its median of the last "
+                                              "{window} years, please provide a narrative justification.",
+                                              metric=metric, for_mode=_for_mode(mode),
+                                              change=round(abs((median - value)/median)*100, 1), window=window)
+    return "pass", ""
+
+
+def growth_result(metric, mode, cagr, first_year, cagr_threshold):
+    '''The check status and description of one growth row.'''
+    if abs(cagr) >= cagr_threshold:
+        return "fail", check_results.describe("The {metric}{for_mode} has changed by {change}% a year since "
+                                              "{first_year}, please provide a narrative justification.",
+                                              metric=metric, for_mode=_for_mode(mode), change=round(cagr*100, 1),
+                                              first_year=first_year)
+    return "pass", ""
+
+
+def trend_results(values, years, window=WINDOW, min_years=MIN_BASELINE_YEARS, cagr_threshold=CAGR_THRESHOLD):
+    '''
+    The trend checks of every year in years (see above), as one table per metric: {metric: results with
+    TREND_RESULT_COLUMNS}, with a median row and a growth row for each organization and mode that reported that year
+    (where it has a median, and a growth rate).
+    '''
+    keys, arrays = trend_arrays(values, years, window, min_years)
+    rows, year_columns = np.nonzero(~np.isnan(arrays["value"]))
+    found = {column: keys[column].to_numpy()[rows] for column in keys.columns}
+    found["year"] = np.asarray(years)[year_columns]
+    found.update({name: array[rows, year_columns] for name, array in arrays.items()})
+
+    outputs = {metric: check_results.new_results(*TREND_RESULT_COLUMNS) for metric in TREND_METRICS}
+    for i in range(len(rows)):
+        metric, mode, year, value = found["metric"][i], found["mode"][i], int(found["year"][i]), found["value"][i]
+        if not np.isnan(found["median"][i]):
+            median = found["median"][i]
+            result, description = median_result(metric, mode, value, median, TREND_METRICS[metric][1], window)
+            check_results.add_result(outputs[metric], Organization=found["Organization"][i],
+                                     name_of_check=f"{metric}: {window}-year median", mode=mode,
+                                     value_checked=f"{year} = {round(value, 2)}, median = {round(median, 2)}",
+                                     check_status=result, Description=description, Fiscal_Year=year)
+        if not np.isnan(found["cagr"][i]):
+            first_year = int(found["first_year"][i])
+            result, description = growth_result(metric, mode, found["cagr"][i], first_year, cagr_threshold)
+            check_results.add_result(outputs[metric], Organization=found["Organization"][i],
+                                     name_of_check=f"{metric}: growth", mode=mode,
+                                     value_checked=f"{first_year} = {round(found['first'][i], 2)}, {year} = {round(value, 2)}",
+                                     check_status=result, Description=description, Fiscal_Year=year)
+    return {metric: check_results.results_frame(output) for metric, output in outputs.items()}
+
+
+def run_trends(client, this_year, window=WINDOW, state_dir=None, full_run=False, logger=None, metrics=None):
+    '''
+    This year's trend checks: {metric: results}. The metric values of every year of the window that was not saved yet
+    (or changed since) are saved in state_dir (see above).
+    '''
+    years = list(range(this_year - window, this_year + 1))
+    with instrumentation.stage_timer(metrics, "trend_values", "load") as record:
+        values = collect_values(client, years, this_year, state_dir, full_run, logger)
+        record["rows_out"] = len(values)
+    with instrumentation.stage_timer(metrics, "trend_checks", "check", rows_in=len(values)) as record:
+        checks = trend_results(values, [this_year], window)
+        record["rows_out"] = sum(len(results) for results in checks.values())
+    for metric, results in checks.items():
+        if logger is not None:
+            validation_logging.log_check_summary(logger, f"trend_{metric}", results, results["Organization"].nunique())
+    return checks
+
+
+def trend_report_sheets(trend_checks):
+    """The report's sheets, for report_writer.write_report()."""
+    return [
+        {"sheet": "rr20_trend_checks", "data": trend_checks.drop(columns="Fiscal_Year"),
+         "subtitle": "Reduced Reporting RR-20: Multi-year Trend Warnings", "subtitle_cells": "A2:C2",
+         "agency_response": True,
+         "column_widths": [(0, 0, 35), (1, 3, 22), (4, 4, 11), (5, 6, 53)]},
+    ]
+
+
+def main():
+    this_year = datetime.datetime.now().year
+    args = get_arguments(this_year)
+    logger = validation_logging.write_to_log('trend_checks_log.log', args.log_level)
+    this_date = datetime.datetime.now().date().strftime('%Y-%m-%d') #for suffix on various files
+    run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("trend_checks", this_year=args.this_year, window=args.window, run_id=run_id,
+                                      state_dir=args.state_dir, full_run=args.full_run)
+    if args.data_dir:
+        client = data_sources.LocalBigQueryClient(args.data_dir)
+    else:
+        client = bigquery.Client()
+
+    with instrumentation.profiled(args.profile, args.profile_file, "trend_checks"):
+        checks = run_trends(client, args.this_year, args.window, args.state_dir, args.full_run, logger, metrics)
+        trend_checks = check_results.combine_results(checks.values())
+        with instrumentation.stage_timer(metrics, "trend_report", "write"):
+            report_writer.write_report(f"{args.output_dir}/rr20_trend_check_report_{this_date}.xlsx",
+                                       trend_report_sheets(trend_checks))
+        if args.results_dir or args.results_table:
+            check_names = {f"trend_{metric}": results.drop(columns="Fiscal_Year") for metric, results in checks.items()}
+            with instrumentation.stage_timer(metrics, "results", "write"):
+                results_sink.write_results(None if args.data_dir else client, run_id, args.this_year,
+                                           {name: "rr20_trends" for name in check_names}, args.results_dir,
+                                           args.results_table if not args.data_dir else None, logger=logger,
+                                           **check_names)
+    instrumentation.write_metrics(metrics, args.metrics_file)
+    logger.info(f"RR-20 trend checks for {args.this_year} over {args.window} years are complete!")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from graphlib import TopologicalSorter
+from google.cloud import bigquery
+import pandas as pd
+import datetime
+import tempfile
+
+import agency_reports
+import check_cache
+import check_rules
+import check_results
+import data_sources
+import incremental
+import instrumentation
+import parallel_checks
+import partitioned_tables
+import results_sink
+import rr20_service_check
+import rr20_financials_check
+import sql_checks
+import voms_inventory_check
+import a10_facilities_check
+import validation_logging
+
+'''Runs the full suite of validation checks (RR-20 service, RR-20 financials, VOMS inventory, A-10 facilities) in one process.
+The run is a dependency graph of stages: each data source is loaded once, and every check that depends on it
+runs off that one copy. All reports are written at the end of the same run, and a table with how long each stage took
+is written to the log and, with row counts, bytes read and peak memory, to a metrics JSON file (see instrumentation.py).
+
+To run from command line, navigate to folder and type:
+    python validate.py
+To run only some of the reports (only the data sources they need are loaded), type e.g.:
+    python validate.py --reports rr20_service rr20_financials
+To write the reports to a local folder instead of GCS, type:
+    python validate.py --output_dir reports
+To also write every check's results as Parquet (partitioned by year and check) and load them into BigQuery, with
+the run's id (see results_sink.py), type e.g.:
+    python validate.py --results_dir gs://calitp-ntd-report-validation/validation_results --results_table cal-itp-data-infra.ntd_validation.validation_results
+To also write one report per agency (and an index of them), for liaisons to forward, type:
+    python validate.py --agency_reports
+To only re-check the organizations whose data changed since the last run, and reuse the last run's results for
+everyone else (see incremental.py), type:
+    python validate.py --state_dir gs://calitp-ntd-report-validation/validation_state_2023
+To save every check's results and return them when a check gets the same inputs again (see check_cache.py), type:
+    python validate.py --cache_dir .check_cache
+To run the year-over-year threshold checks as SQL where the data is (BigQuery), and only get their results back
+(see sql_checks.py), type:
+    python validate.py --check_engine sql
+To run the checks that are written as rules (see check_rules.py) in one batched pass per table, type:
+    python validate.py --check_engine rules
+To read the RR-20 tables from the year-partitioned tables (see partitioned_tables.py), one query per table for both
+years, type:
+    python validate.py --storage partitioned
+To run independent checks in parallel, in 4 worker processes, type:
+    python validate.py --jobs 4
+To also log every agency each check looks at (the log file has one JSON object per line; see validation_logging.py), type:
+    python validate.py --log_level DEBUG
+To also save a cProfile profile of the run (of the main process only, when --jobs > 1), type:
+    python validate.py --profile cprofile --profile_file validate.prof
+'''
+
+REPORTS = ['rr20_service', 'rr20_financials', 'voms', 'a10']
+CHECK_ENGINES = ['pandas', 'sql', 'rules']
+STORAGES = ['per_year', 'partitioned']
+OUTPUT_DIR = "gs://calitp-ntd-report-validation/validation_reports_{year}"
+
+
+def get_parser(this_year):
+    parser = ArgumentParser(description="Run all NTD validation checks")
+    parser.add_argument('--this_year', type=int, default=this_year)
+    parser.add_argument('--last_year', type=int, default=(this_year-1))
+    parser.add_argument('--reports', nargs='+', choices=REPORTS, default=REPORTS)
+    parser.add_argument('--check_engine', choices=CHECK_ENGINES, default='pandas',
+                        help="Run the checks in pandas, the ones that have a SQL version as SQL where the data is (see sql_checks.py), "
+                             "or the ones that have rules as batched rules (see check_rules.py)")
+    parser.add_argument('--storage', choices=STORAGES, default='per_year',
+                        help="Read the RR-20 tables from one BigQuery table per year, or from the year-partitioned tables "
+                             "(see partitioned_tables.py)")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of worker processes to run checks in")
+    parser.add_argument('--snapshot_dir', default=None, help="Folder for the input tables shared with workers (default: a temporary folder)")
+    parser.add_argument('--output_dir', default=None,
+                        help=f"Folder (local or gs://) to write the reports to; default: {OUTPUT_DIR} for --this_year")
+    parser.add_argument('--agency_reports', action='store_true',
+                        help="Also write one report per agency, and an index of them (see agency_reports.py)")
+    parser.add_argument('--agency_report_jobs', type=int, default=None,
+                        help="Number of worker processes to write agency reports in (default: number of CPUs)")
+    parser.add_argument('--state_dir', default=None,
+                        help="Folder (local or gs://) to keep each check's results in, to only re-check organizations "
+                             "whose data changed in the next run (see incremental.py)")
+    parser.add_argument('--full_run', action='store_true',
+                        help="With --state_dir, check every organization again (and save the results for the next run)")
+    parser.add_argument('--a10_data', default="data/2021_a10_submitted_partialdata.csv")
+    parser.add_argument('--a10_lastyr_data', default="data/2020_a10_submitted_partialdata.csv")
+    parser.add_argument('--a10_year', type=int, default=2021)
+    results_sink.add_arguments(parser)
+    check_cache.add_arguments(parser)
+    instrumentation.add_arguments(parser, "validate")
+    validation_logging.add_arguments(parser)
+    return parser
+
+
+def get_arguments(this_year, argv=None):
+    '''The options of a run, from the command line (or argv), with the defaults that depend on other options filled in.'''
+    args = get_parser(this_year).parse_args(argv)
+    args.output_dir = args.output_dir or OUTPUT_DIR.format(year=args.this_year)
+    args.run_id = None # set when the run starts
+    return args
+
+
+def default_arguments(this_year, **options):
+    '''
+    The options of a run with every default, and the given options (e.g. output_dir=...), for building a run's graph
+    from another script (see benchmark.py and equivalence.py).
+    '''
+    args = get_arguments(this_year, [])
+    for option, value in options.items():
+        if not hasattr(args, option):
+            raise ValueError(f"validate.py has no option {option}")
+        setattr(args, option, value)
+    return args
+
+
+def get_agencies(df, org_col='Organization'):
+    return df[org_col].unique()
+
+
+def combine_checks(**checks):
+    """Combine check tables into one, in the order they are passed in."""
+    return check_results.combine_results(checks.values())
+
+
+def build_graph(client, args, logger):
+    '''
+    Returns the stages of a run, as {stage name: {"func", "kind", "inputs", "kwargs"}}.
+    "inputs" maps a keyword argument of func to the name of the stage whose result is passed in.
+    '''
+    this_year = args.this_year
+    last_year = args.last_year
+    this_date = datetime.datetime.now().date().strftime('%Y-%m-%d') #for suffix on various files
+    graph = {}
+
+    def add(name, func, kind, inputs=None, **kwargs):
+        graph[name] = {"func": func, "kind": kind, "inputs": inputs or {}, "kwargs": kwargs}
+
+    ### Data sources - each is loaded once.
+    add("orgs", data_sources.get_orgs, "load", client=client)
+    rr20_tables = {"rr20_service": "rr20_service_data", "rr20_exp_by_mode": "rr20_expenses_by_mode",
+                   "rr20_financials": "rr20_financials__2"}
+    if args.storage == "partitioned":
+        # Both years of a table in one query, then split into the tables the per-year loaders return
+        for name, tablename in rr20_tables.items():
+            add(f"{name}_years", partitioned_tables.get_years, "load", client=client, tablename=tablename,
+                years=[this_year, last_year])
+            add(name, partitioned_tables.year_rows, "derive", inputs={"df": f"{name}_years"}, year=this_year)
+            add(f"{name}_lastyr", partitioned_tables.year_rows, "derive", inputs={"df": f"{name}_years"}, year=last_year)
+    else:
+        for name, tablename in rr20_tables.items():
+            add(name, data_sources.get_bq_data, "load", client=client, year=this_year, tablename=tablename)
+        # Last year's data was only uploaded once so has slightly different schema
+        for name, tablename in rr20_tables.items():
+            add(f"{name}_lastyr", data_sources.get_bq_table, "load", client=client, year=last_year, tablename=tablename)
+    add("inventory", data_sources.get_bq_table, "load", client=client, year=this_year, tablename="inventory_revenue_vehicles")
+    add("a30", data_sources.get_bq_data, "load", client=client, year=this_year, tablename="a30_a30_rural_rvi", org_col="Organization")
+    add("a10", data_sources.load_a10_data, "load", this_year_file=args.a10_data, last_year_file=args.a10_lastyr_data)
+
+    ### Combined datasets
+    add("service_allyears", rr20_service_check.combine_service_data, "derive",
+        inputs={"rr20_service": "rr20_service", "rr20_exp_by_mode": "rr20_exp_by_mode", "rr20_fin": "rr20_financials",
+                "orgs": "orgs", "rr20_service_lastyr": "rr20_service_lastyr",
+                "rr20_exp_by_mode_lastyr": "rr20_exp_by_mode_lastyr", "fin_lastyr": "rr20_financials_lastyr"})
+    add("service_ratios", rr20_service_check.calculate_ratios, "derive", inputs={"allyears": "service_allyears"})
+    add("financials_allyears", rr20_financials_check.combine_financial_data, "derive",
+        inputs={"rr20_financial": "rr20_financials", "rr20_financial_lastyr": "rr20_financials_lastyr"})
+    add("financials_filled", rr20_financials_check.fill_financial_data, "derive", inputs={"rr20_financial": "rr20_financials"})
+    add("a30_agencies", get_agencies, "derive", inputs={"df": "a30"})
+
+    ### Checks
+    # RR-20 service data. The missing data check runs on the data before NAs are filled with 0's.
+    service_checks = ["service_missing_data"]
+    add("service_missing_data", rr20_service_check.check_missing_servicedata, "check", inputs={"df": "service_allyears"})
+    for variable, check, threshold in rr20_service_check.SERVICE_CHECKS:
+        service_checks.append(f"service_{variable}")
+        add(f"service_{variable}", check, "check", inputs={"df": "service_ratios"},
+            variable=variable, this_year=this_year, last_year=last_year, logger=logger, threshold=threshold)
+
+    # RR-20 financial data
+    financials_checks = []
+    for variable in rr20_financials_check.FINANCIAL_VARIABLES:
+        financials_checks.append(f"financials_{variable}")
+        add(f"financials_{variable}", rr20_financials_check.financial_checks, "check", inputs={"df": "financials_allyears"},
+            variable=variable, this_year=this_year, last_year=last_year, logger=logger)
+    financials_checks += ["financials_equal_totals", "financials_rr20f_001c", "financials_rr20f_182"]
+    add("financials_equal_totals", rr20_financials_check.equal_totals, "check", inputs={"df": "financials_allyears"},
+        this_year=this_year, logger=logger)
+    add("financials_rr20f_001c", rr20_financials_check.rr20f_001c, "check", inputs={"df": "financials_allyears"},
+        this_year=this_year, logger=logger)
+    add("financials_rr20f_182", rr20_financials_check.rr20f_182, "check",
+        inputs={"inv_df": "inventory", "fin_df": "financials_filled"}, year=this_year)
+
+    # VOMS: A-30 vs. inventory vs. RR-20
+    voms_inputs = {"a30_data": "a30", "a30_agencies": "a30_agencies", "inventory_data": "inventory"}
+    add("voms_vins_all", voms_inventory_check.vins_all_checks, "check", inputs=voms_inputs)
+    add("voms_vins_mismatched", voms_inventory_check.partial_vin_checklist, "check", inputs=voms_inputs)
+    add("voms_totals", voms_inventory_check.check_totals, "check", inputs={**voms_inputs, "rr20_data": "rr20_service"},
+        rr20_org_col='Organization_Legal_Name')
+
+    # A-10 facilities
+    add("a10_facilities", a10_facilities_check.facility_checks, "check", inputs={"df": "a10"},
+        this_year=args.a10_year, last_year=args.a10_year - 1)
+
+    # Run the checks that have a SQL version where the data is
+    if args.check_engine == "sql":
+        sql_checks.pushdown_graph(graph, sql_checks.engine_for(
+            client, partitioned=args.storage == "partitioned"))
+    # Or run the checks that have rules in one pass per table
+    elif args.check_engine == "rules":
+        check_rules.rules_graph(graph)
+    # Reuse the saved results of checks whose inputs did not change
+    if args.cache_dir:
+        check_cache.memoize_graph(graph, args.cache_dir, args.cache_max_mb)
+    # Only re-check the organizations whose inputs changed since the last run
+    if args.state_dir:
+        incremental.make_incremental(graph, args.state_dir, full_run=args.full_run)
+
+    ### Combine checks and write reports
+    add("rr20_service_checks", combine_checks, "merge", inputs={x: x for x in service_checks})
+    add("rr20_financials_checks", combine_checks, "merge", inputs={x: x for x in financials_checks})
+
+    add("rr20_service_report", rr20_service_check.write_service_report, "write",
+        inputs={"rr20_checks": "rr20_service_checks"},
+        filename=f"{args.output_dir}/rr20_service_check_report_{this_date}.xlsx")
+    add("rr20_financials_report", rr20_financials_check.write_financials_report, "write",
+        inputs={"f_checks": "rr20_financials_checks"},
+        filename=f"{args.output_dir}/rr20_financials_check_report_{this_date}.xlsx")
+    add("voms_report", voms_inventory_check.write_voms_report, "write",
+        inputs={"full_vin_checklist": "voms_vins_all", "mismatched_vin_checklist": "voms_vins_mismatched",
+                "totals_checklist": "voms_totals"},
+        filename=f"{args.output_dir}/voms_check_report_{this_date}.xlsx")
+    add("a10_report", a10_facilities_check.write_facilities_report, "write",
+        inputs={"a10_checks": "a10_facilities"},
+        filename=f"{args.output_dir}/a10_facility_check_report_{this_date}.xlsx")
+
+    # Every check's results, also as Parquet and in BigQuery
+    if args.results_dir or args.results_table:
+        check_reports = {**{x: "rr20_service" for x in service_checks}, **{x: "rr20_financials" for x in financials_checks},
+                         **{x: "voms" for x in ["voms_vins_all", "voms_vins_mismatched", "voms_totals"]},
+                         "a10_facilities": "a10"}
+        check_reports = {x: report for x, report in check_reports.items() if report in args.reports}
+        add("results", results_sink.write_results, "write", inputs={x: x for x in check_reports},
+            client=client, run_id=args.run_id or results_sink.new_run_id(), year=this_year,
+            reports=check_reports, results_dir=args.results_dir, results_table_id=args.results_table,
+            check_years={"a10_facilities": args.a10_year}, logger=logger)
+
+    if args.agency_reports:
+        tables = [table for report, (_, report_tables) in agency_reports.AGENCY_REPORTS.items()
+                  if report in args.reports for table in report_tables]
+        add("agency_reports", agency_reports.write_agency_reports, "write", inputs={x: x for x in tables},
+            output_dir=args.output_dir, this_date=this_date, jobs=args.agency_report_jobs, logger=logger)
+    return graph
+
+
+def prune_graph(graph, targets):
+    """Keep only the targets and the stages they depend on."""
+    keep = set()
+    to_visit = list(targets)
+    while to_visit:
+        name = to_visit.pop()
+        if name not in keep:
+            keep.add(name)
+            to_visit.extend(graph[name]["inputs"].values())
+    return {name: stage for name, stage in graph.items() if name in keep}
+
+
+def run_graph(graph, logger, jobs=1, snapshot_dir=None, metrics=None):
+    '''
+    Runs every stage once, after the stages it depends on. A result is dropped as soon as
+    the last stage that uses it has run. Each stage's timing, rows in and out, bytes read and peak memory
+    are added to metrics (see instrumentation.py), and returned as a table.
+    With jobs > 1, check stages are sent to a pool of that many worker processes as soon as their inputs
+    are ready. Each input table they need is written once as a snapshot in snapshot_dir (a temporary folder
+    if not given), which workers memory-map by name (see parallel_checks.py). Every other stage runs in this
+    process. Results are kept by stage name, so reports come out the same as with jobs=1.
+    '''
+    sorter = TopologicalSorter({name: set(stage["inputs"].values()) for name, stage in graph.items()})
+    sorter.prepare()
+    n_consumers = {name: 0 for name in graph}
+    for stage in graph.values():
+        for dependency in set(stage["inputs"].values()):
+            n_consumers[dependency] += 1
+
+    results = {}
+    snapshots = set() # names of results written as snapshots for the workers
+    records = []
+    running = {} # future: stage name
+
+    def finish(name, result, record):
+        stage = graph[name]
+        logger.info(f"Ran {stage['kind']} stage {name} in {record['seconds']:.2f}s",
+                    extra={key: record[key] for key in ["stage", "kind", "seconds", "rows_in", "rows_out"]})
+        records.append(record)
+        if metrics is not None:
+            metrics["stages"].append(record)
+
+        if n_consumers[name] > 0:
+            results[name] = result
+        for dependency in set(stage["inputs"].values()):
+            n_consumers[dependency] -= 1
+            if n_consumers[dependency] == 0:
+                del results[dependency]
+                if dependency in snapshots:
+                    data_sources.remove_snapshot(snapshot_dir, dependency)
+                    snapshots.remove(dependency)
+        sorter.done(name)
+
+    pool = None
+    temporary_dir = None
+    if jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=jobs, initializer=validation_logging.init_worker,
+                                   initargs=validation_logging.worker_initargs())
+        if snapshot_dir is None:
+            temporary_dir = tempfile.TemporaryDirectory(prefix="validate_snapshots_")
+            snapshot_dir = temporary_dir.name
+    try:
+        while sorter.is_active():
+            for name in sorter.get_ready():
+                stage = graph[name]
+                if pool is not None and stage["kind"] == "check":
+                    snapshot_inputs = {}
+                    inputs = {}
+                    for arg, dependency in stage["inputs"].items():
+                        if isinstance(results[dependency], pd.DataFrame):
+                            if dependency not in snapshots:
+                                data_sources.write_snapshot(snapshot_dir, dependency, results[dependency])
+                                snapshots.add(dependency)
+                            snapshot_inputs[arg] = dependency
+                        else:
+                            inputs[arg] = results[dependency]
+                    future = pool.submit(parallel_checks.run_stage, name, stage["kind"], stage["func"], snapshot_dir,
+                                         snapshot_inputs, inputs, stage["kwargs"])
+                    running[future] = name
+                else:
+                    inputs = {arg: results[dependency] for arg, dependency in stage["inputs"].items()}
+                    with instrumentation.stage_timer(None, name, stage["kind"],
+                                                     rows_in=instrumentation.count_rows(*inputs.values())) as record:
+                        result = stage["func"](**inputs, **stage["kwargs"])
+                        record["rows_out"] = instrumentation.count_rows(result) if result is not None else None
+                    finish(name, result, record)
+
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result, record = future.result()
+                    finish(running.pop(future), result, record)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        for name in snapshots:
+            data_sources.remove_snapshot(snapshot_dir, name)
+        if temporary_dir is not None:
+            temporary_dir.cleanup()
+
+    return instrumentation.stages_table({"stages": records})
+
+
+def main():
+    this_year = datetime.datetime.now().year
+    args = get_arguments(this_year)
+    # Set up the logger object
+    logger = validation_logging.write_to_log('validate_log.log', args.log_level)
+
+    args.run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("validate", this_year=args.this_year, last_year=args.last_year,
+                                      reports=args.reports, jobs=args.jobs, check_engine=args.check_engine, run_id=args.run_id,
+                                      state_dir=args.state_dir, full_run=args.full_run)
+    client = bigquery.Client()
+    graph = build_graph(client, args, logger)
+    targets = [f"{report}_report" for report in args.reports] + (["agency_reports"] if args.agency_reports else [])
+    if args.results_dir or args.results_table:
+        targets.append("results")
+    graph = prune_graph(graph, targets)
+    with instrumentation.profiled(args.profile, args.profile_file, "validate"):
+        stages = run_graph(graph, logger, jobs=args.jobs, snapshot_dir=args.snapshot_dir, metrics=metrics)
+    instrumentation.write_metrics(metrics, args.metrics_file)
+
+    by_kind = pd.DataFrame(metrics["totals_by_kind"])
+    logger.info(f"Per-stage metrics:\n{stages.drop(columns='pid').to_string(index=False)}")
+    logger.info(f"Total by stage type:\n{by_kind.to_string(index=False)}")
+    logger.info(f"Metrics saved to {args.metrics_file}")
+    logger.info(f"Validation run for {', '.join(args.reports)} is complete!")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+import logging
+import atexit
+import queue
+import json
+
+'''Logging for the validation scripts. write_to_log() returns the "validation" logger, which only puts records on a queue;
+a background thread (a QueueListener) formats them and writes them to the log file, as one JSON object per line,
+and to the console, as readable text. Checks therefore never wait on a flush to disk or the terminal, and logging
+calls no longer show up in profiles.
+
+Per-agency detail is logged at DEBUG, so it is dropped (before any formatting) unless a script is run with
+--log_level DEBUG. Each check logs one summary line at INFO instead (see log_check_summary()).
+Fields passed with extra= are written as their own keys in the JSON lines:
+    logger.info("Loaded table", extra={"table": "rr20_service_data", "rows": 1200})
+
+When checks run in worker processes (validate.py --jobs N), call worker_initargs() in the main process and pass
+init_worker and those arguments to the pool, so the workers' records go to the same listener.
+'''
+
+LOGGER_NAME = "validation"
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+CONSOLE_FORMAT = '%(asctime)s:%(levelname)s: %(message)s'
+DATE_FORMAT = '%y-%m-%d %H:%M:%S'
+
+# Attributes every LogRecord has; anything else on a record came from extra=.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+_handlers = []
+_listeners = []
+_worker_queue = None
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats a record as one line of JSON: time, level, logger, message and any extra fields.'''
+    def format(self, record):
+        line = {"time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+                "level": record.levelname,
+                "logger": record.name,
+                "message": record.getMessage()}
+        line.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+def add_arguments(parser):
+    '''Adds the --log_level option to a script's argument parser.'''
+    parser.add_argument('--log_level', choices=LOG_LEVELS, default='INFO',
+                        help="DEBUG also logs a line for every agency each check looks at")
+    return parser
+
+
+def _start_listener(log_queue):
+    listener = QueueListener(log_queue, *_handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return listener
+
+
+def _stop_listeners():
+    # Stopping a listener writes out every record still on its queue.
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def write_to_log(logfilename, level='INFO'):
+    '''
+    Returns the "validation" logger, logging at level (a name or number) as JSON lines to logfilename
+    and as text to the console, both through a queue. Only the first call in a process sets up the handlers;
+    later calls just set the level.
+    '''
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    if not _handlers:
+        file_handler = logging.FileHandler(logfilename)
+        file_handler.setFormatter(JsonFormatter())
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT, datefmt=DATE_FORMAT))
+        _handlers.extend([file_handler, stream_handler])
+
+        log_queue = queue.SimpleQueue()
+        _start_listener(log_queue)
+        atexit.register(_stop_listeners)
+        logger.addHandler(QueueHandler(log_queue))
+        logger.propagate = False
+    return logger
+
+
+def worker_initargs():
+    '''
+    Arguments for init_worker(), for a process pool: a queue that worker processes can put records on,
+    written out by the same handlers as this process's records.
+    '''
+    global _worker_queue
+    logger = logging.getLogger(LOGGER_NAME)
+    if not _handlers:
+        return (None, logger.level)
+    if _worker_queue is None:
+        _worker_queue = multiprocessing.Queue()
+        _start_listener(_worker_queue)
+    return (_worker_queue, logger.level)
+
+
+def init_worker(log_queue, level):
+    '''Process pool initializer: sends the worker's "validation" records to the main process's queue.'''
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.handlers.clear()
+    logger.setLevel(level)
+    logger.propagate = False
+    if log_queue is not None:
+        logger.addHandler(QueueHandler(log_queue))
+
+
+def log_check_summary(logger, check_name, checks, agencies=None):
+    '''
+    Logs one INFO line for a finished check: how many agencies it looked at (agencies is a list of them, or their number),
+    rows it returned and how many failed.
+    '''
+    status_col = next((col for col in ["check_status", "check_result"] if col in checks.columns), None)
+    failed = int((checks[status_col] == "fail").sum()) if status_col is not None else 0
+    fields = {"check": check_name, "rows": len(checks), "failed": failed}
+    if agencies is not None:
+        fields["agencies"] = agencies if isinstance(agencies, int) else len(agencies)
+    message = f"Ran {check_name} check: {failed} of {len(checks)} rows failed"
+    if agencies is not None:
+        message += f" ({fields['agencies']} agencies)"
+    logger.info(f"{message}.", extra=fields)
@@ -1,6 +1,14 @@
 from argparse import ArgumentParser
-import pandas as pd
+from google.cloud import bigquery
+from data_sources import load_excel_data
 import datetime
+import functools
+
+import check_cache
+import check_results
+import instrumentation
+import results_sink
+import report_writer
 
 '''This file loads 3 datasets (A-30, RR-20 Service data, Revenue Vehicle Inventory) that originate from Black Cat.
 To run from command line, navigate to folder: 
@@ -9,6 +17,10 @@ To run from command line, navigate to folder:
                                 --rev_vehicle_inventory_data <filepath> 
                                 --a30_data <filepath> 
                                 --rr20_service_data <filepath>
+* To also write every check's results as Parquet and load them into BigQuery, add --results_dir and --results_table
+  (see results_sink.py).
+* Per-stage timings, row counts and memory are written to voms_inventory_check_metrics.json. To also save a profile,
+  add --profile cprofile (see instrumentation.py).
             
 Performs 3 checks:
 * Check 1. Compare each A-30 vehicle's VIN to inventory ensure that all vehicles in the lists are the same.
@@ -24,22 +36,19 @@ def get_arguments():
     parser.add_argument('--rev_vehicle_inventory_data', default="data/RevenueVehicles_9_2_2023.xlsx")
     parser.add_argument('--a30_data', default="data/A_30_Revenue_Vehicle_Report_9_1_2023.xlsx")
     parser.add_argument('--rr20_service_data', default="data/NTD_Annual_Report_Rural_2022.xlsx")
+    results_sink.add_arguments(parser)
+    check_cache.add_arguments(parser)
+    instrumentation.add_arguments(parser, "voms_inventory_check")
 
     args = parser.parse_args()
     return args
 
 
-def load_excel_data(filename, sheetname):
-    df = pd.read_excel(filename, sheet_name=sheetname,
-                            index_col=None)
-    return df
-
-
 def vins_all_checks(a30_data, a30_agencies, inventory_data):
     """ Compare A-30 VIN list with inventory VIN list (active vehicles).
         Returns full list of all A-30 VINS and whether they match inventory"""
     
-    output = []
+    output = check_results.new_results("Organization", "VIN", "check_status", "Description")
     for agency in a30_agencies:
         if len(a30_data[a30_data['Organization']==agency]) > 0:
             vins_a30 = a30_data[a30_data['Organization']==agency]['VIN'].unique()
@@ -54,13 +63,10 @@ def vins_all_checks(a30_data, a30_agencies, inventory_data):
                     description = f"{v} not an active vehicle in the inventory. Investigate."
                     result = "N"
 
-                output_line = {"Organization": agency,
-                            "VIN": v,
-                            "check_status": result,
-                            "Description": description}
-                output.append(output_line)
+                check_results.add_result(output, Organization=agency, VIN=v, check_status=result,
+                                         Description=description)
         
-    full_vin_checklist = pd.DataFrame(output).sort_values(by="Organization")
+    full_vin_checklist = check_results.results_frame(output)
     return full_vin_checklist
 
 
@@ -68,7 +74,7 @@ def partial_vin_checklist(a30_data, a30_agencies, inventory_data):
     """ Compare A-30 VIN list with inventory VIN list (active vehicles).
         Returns ONLY those that do not match."""
     
-    output = []
+    output = check_results.new_results("Organization", "VIN", "check_status", "Description")
     for agency in a30_agencies:
         if len(a30_data[a30_data['Organization']==agency]) > 0:
             vins_a30 = a30_data[a30_data['Organization']==agency]['VIN'].unique() #will list only active ins
@@ -80,22 +86,21 @@ def partial_vin_checklist(a30_data, a30_agencies, inventory_data):
                     description = f"Not an active vehicle in this org's inventory. Investigate."
                     result = "N"
                     
-                    output_line = {"Organization": agency,
-                            "VIN": v,
-                            "check_status": result,
-                            "Description": description}
-                    output.append(output_line)
+                    check_results.add_result(output, Organization=agency, VIN=v, check_status=result,
+                                             Description=description)
                 else:
                     pass
     
-    mismatched_vin_checklist = pd.DataFrame(output).sort_values(by="Organization")
+    mismatched_vin_checklist = check_results.results_frame(output)
     return mismatched_vin_checklist
 
 
-def check_totals(a30_data, a30_agencies, inventory_data, rr20_data):
-    """Compare total reported vehicles across RR-20, A-30, inventory list"""
+def check_totals(a30_data, a30_agencies, inventory_data, rr20_data, rr20_org_col='Organization Legal Name'):
+    """Compare total reported vehicles across RR-20, A-30, inventory list.
+       rr20_org_col is 'Organization Legal Name' in the Excel extract, 'Organization_Legal_Name' in BigQuery."""
 
-    output = []
+    output = check_results.new_results("Organization", "n_a30_vehicles", "n_rr20_VOMS", "n_active_inventory",
+                                       "check_result", "Description")
     for agency in a30_agencies:
         if len(a30_data[a30_data['Organization']==agency]) > 0:
             a30_n = a30_data[a30_data['Organization']==agency]['VIN'].nunique()
@@ -106,8 +111,8 @@ def check_totals(a30_data, a30_agencies, inventory_data, rr20_data):
             inv_n = inventory_data[(inventory_data['Organization'] == agency) \
             & (inventory_data['Status']=='Active')]['VIN'].nunique()
         
-        if len(rr20_data[rr20_data['Organization Legal Name']==agency]) > 0:
-            rr20_n = rr20_data[rr20_data['Organization Legal Name']==agency]['VOMX'].sum()
+        if len(rr20_data[rr20_data[rr20_org_col]==agency]) > 0:
+            rr20_n = rr20_data[rr20_data[rr20_org_col]==agency]['VOMX'].sum()
             rr20_n = round(rr20_n)
 
             if (a30_n <= inv_n) & (rr20_n <= inv_n) & (a30_n >= rr20_n):
@@ -120,99 +125,76 @@ def check_totals(a30_data, a30_agencies, inventory_data, rr20_data):
                 result = "fail"
                 description = "Total VOMS is greater than total A-30 vehicles reported. Please clarify"
 
-            output_line = {"Organization": agency,
-                        "n_a30_vehicles": a30_n,
-                        "n_rr20_VOMS": rr20_n,
-                        "n_active_inventory": inv_n,
-                        "check_result": result,
-                        "Description": description}
-            output.append(output_line)
-    totals_checklist = pd.DataFrame(output)
+            check_results.add_result(output, Organization=agency, n_a30_vehicles=a30_n, n_rr20_VOMS=rr20_n,
+                                     n_active_inventory=inv_n, check_result=result, Description=description)
+    totals_checklist = check_results.results_frame(output, sort_by=None)
     
     return totals_checklist
 
 
+def voms_report_sheets(full_vin_checklist, mismatched_vin_checklist, totals_checklist):
+    """The report's sheets, for report_writer.write_report()."""
+    subtitle1 = "VOMS Inventory Vehicle Check: Validation Warnings"
+    subtitle2 = "VOMS RR-20 & A-30 check"
+    return [
+        {"sheet": "vin_check_full", "data": full_vin_checklist,
+         "subtitle": subtitle1, "subtitle_cells": "A2:D2",
+         "column_widths": [(0, 0, 35), (1, 2, 20), (3, 3, 53)]},
+        {"sheet": "vin_check_fails_only", "data": mismatched_vin_checklist,
+         "subtitle": subtitle1, "subtitle_cells": "A2:D2",
+         "agency_response": True,
+         "column_widths": [(0, 0, 35), (1, 2, 20), (3, 5, 53)]},
+        {"sheet": "totals_check", "data": totals_checklist,
+         "subtitle": subtitle2, "subtitle_cells": "A2:B2",
+         "agency_response": True,
+         "column_widths": [(0, 0, 35), (1, 4, 18), (5, 7, 53)]},
+    ]
+
+
+def write_voms_report(full_vin_checklist, mismatched_vin_checklist, totals_checklist, filename):
+    """Write all 3 checks to one Excel file, in different sheets.
+    We also add a few more columns for Liaisions to manually track agency responses."""
+    report_writer.write_report(filename, voms_report_sheets(full_vin_checklist, mismatched_vin_checklist, totals_checklist))
+
+
 def main():
     this_year=datetime.datetime.now().year
     this_date=datetime.datetime.now().date().strftime('%Y-%m-%d') #for suffix on various files
     #Load data:
     args = get_arguments()
-    rev_vehicle_inventory = load_excel_data(args.rev_vehicle_inventory_data, "Revenue Vehicles")
-    a30 = load_excel_data(args.a30_data, "A-30 (Rural) RVI")
-    rr20 = load_excel_data(args.rr20_service_data, "Service Data")
-
-    #List of agencies with A-30 data
-    a30_agencies = a30['Organization'].unique()
-
-    # Generate the 3 typesof VOMS checks:
-    full_vin_checklist = vins_all_checks(a30, a30_agencies, rev_vehicle_inventory)
-    mismatched_vin_checklist = partial_vin_checklist(a30, a30_agencies, rev_vehicle_inventory)
-    totals_checklist = check_totals(a30, a30_agencies, rev_vehicle_inventory, rr20)
-
-    # Write them all to one Excel file, in different sheets:
-    ## We also add a few more columns for Liaisions to manually track agency responses.
-    GCS_FILE_PATH_VALIDATED = f"gs://calitp-ntd-report-validation/validation_reports_{this_year}" 
-    with pd.ExcelWriter(f"{GCS_FILE_PATH_VALIDATED}/voms_check_report_{this_date}.xlsx") as writer:
-   
-        full_vin_checklist.to_excel(writer, sheet_name="vin_check_full", index=False, startrow=2)
-        mismatched_vin_checklist.to_excel(writer, sheet_name="vin_check_fails_only", index=False, startrow=2)
-        totals_checklist.to_excel(writer, sheet_name="totals_check", index=False, startrow=2)
-        
-        workbook = writer.book
-        worksheet1 = writer.sheets["vin_check_full"]
-        worksheet2 = writer.sheets["vin_check_fails_only"]
-        worksheet3 = writer.sheets["totals_check"]
-        cell_highlight = workbook.add_format({
-            'fg_color': 'yellow',
-            'bold': True,
-            'border': 1
-        })
-        
-        report_title = "NTD Data Validation Report"
-        title_format = workbook.add_format({
-                'bold': True,
-                'valign': 'center',
-                'align': 'left',
-                'font_color': '#1c639e',
-                'font_size': 15
-                })
-        subtitle1 = "VOMS Inventory Vehicle Check: Validation Warnings"
-        subtitle2 = "VOMS RR-20 & A-30 check"
-        subtitle_format = workbook.add_format({
-            'bold': True,
-            'align': 'left',
-            'font_color': 'black',
-            'font_size': 19
-            })
-
-        # Column width and format - sheet 1
-        worksheet1.set_column(0, 0, 35) #col A width
-        worksheet1.set_column(1, 2, 20) #cols B-C width
-        worksheet1.set_column(3, 3, 53) #col D width
-        worksheet1.write('A1', report_title, title_format)
-        worksheet1.merge_range('A2:D2', subtitle1, subtitle_format)
-        worksheet1.freeze_panes('B4')
-        
-        # Column width and format - sheet 2
-        worksheet2.set_column(0, 0, 35) #col A width
-        worksheet2.set_column(1, 2, 20) #cols B-C width
-        worksheet2.set_column(3, 5, 53) #cols D-F width
-        worksheet2.write('E3', 'Agency Response', cell_highlight)
-        worksheet2.write('F3', 'Response Date', cell_highlight)
-        worksheet2.write('A1', report_title, title_format)
-        worksheet2.merge_range('A2:D2', subtitle1, subtitle_format)
-        worksheet2.freeze_panes('B4')
-
-        
-        # Column width and format - sheet 3
-        worksheet3.set_column(0, 0, 35) #col A width
-        worksheet3.set_column(1, 4, 18) #cols B-E width
-        worksheet3.set_column(5, 7, 53) #cols F-H width
-        worksheet3.write('G3', 'Agency Response', cell_highlight)
-        worksheet3.write('H3', 'Response Date', cell_highlight)
-        worksheet3.write('A1', report_title, title_format)
-        worksheet3.merge_range('A2:B2', subtitle2, subtitle_format)
-        worksheet3.freeze_panes('B4')
+    run_id = results_sink.new_run_id()
+    metrics = instrumentation.new_run("voms_inventory_check", this_year=this_year, run_id=run_id)
+    timed = functools.partial(instrumentation.timed_call, metrics)
+    memo = functools.partial(check_cache.memoize, cache_dir=args.cache_dir, max_mb=args.cache_max_mb)
+
+    with instrumentation.profiled(args.profile, args.profile_file, "voms_inventory_check"):
+        rev_vehicle_inventory = timed("inventory", "load", load_excel_data, args.rev_vehicle_inventory_data, "Revenue Vehicles")
+        a30 = timed("a30", "load", load_excel_data, args.a30_data, "A-30 (Rural) RVI")
+        rr20 = timed("rr20_service", "load", load_excel_data, args.rr20_service_data, "Service Data")
+
+        #List of agencies with A-30 data
+        a30_agencies = a30['Organization'].unique()
+
+        # Generate the 3 typesof VOMS checks:
+        full_vin_checklist = timed("voms_vins_all", "check", memo(vins_all_checks, "voms_vins_all"),
+                                   a30, a30_agencies, rev_vehicle_inventory)
+        mismatched_vin_checklist = timed("voms_vins_mismatched", "check", memo(partial_vin_checklist, "voms_vins_mismatched"),
+                                         a30, a30_agencies, rev_vehicle_inventory)
+        totals_checklist = timed("voms_totals", "check", memo(check_totals, "voms_totals"), a30, a30_agencies, rev_vehicle_inventory, rr20)
+
+        # Write them all to one Excel file, in different sheets:
+        GCS_FILE_PATH_VALIDATED = f"gs://calitp-ntd-report-validation/validation_reports_{this_year}" 
+        timed("voms_report", "write", write_voms_report, full_vin_checklist, mismatched_vin_checklist, totals_checklist,
+              f"{GCS_FILE_PATH_VALIDATED}/voms_check_report_{this_date}.xlsx")
+
+        # Save every check's results as Parquet and to BigQuery, if asked to
+        if args.results_dir or args.results_table:
+            client = bigquery.Client() if args.results_table else None
+            timed("results", "write", results_sink.write_results, client, run_id, this_year,
+                  {name: "voms" for name in ["voms_vins_all", "voms_vins_mismatched", "voms_totals"]},
+                  results_dir=args.results_dir, results_table_id=args.results_table, voms_vins_all=full_vin_checklist,
+                  voms_vins_mismatched=mismatched_vin_checklist, voms_totals=totals_checklist)
+    instrumentation.write_metrics(metrics, args.metrics_file)
     
     print("VOMS check is complete!")
 